@@ -0,0 +1,109 @@
+"""
+Script Name:        compositeBenchmark.py
+
+Description:        Times DataProcessor.combinedDataSet against the original implementation
+                    (a Python set of dates, then np.sum over a new list for every component)
+                    by combining 20 synthetic daily datasets over 100 years. Results are checked
+                    against a plain pandas calendar-day shift, and against the original
+                    implementation on gap-free data (it can't combine datasets with gaps).
+
+                    Run from the repository root:
+
+                        python -m benchmarks.compositeBenchmark
+"""
+
+import numpy as np
+import pandas as pd
+from resources.modules.Miscellaneous import DataProcessor
+from resources.modules.Miscellaneous.DataStore import DataStore
+from benchmarks.resampleBenchmark import timeIt
+
+NUM_COMPONENTS = 20
+YEARS = 100
+
+
+def legacyCombinedValues(dataTable, combinationString):
+    """
+    The original combination loop, kept here as the reference implementation
+    """
+    IDs, CFs, LGs = DataProcessor.parseCompositeString(combinationString)
+    IDs = list(IDs)
+
+    dates = np.sort(list(set(dataTable.loc[(slice(None),IDs),'Value'].index.get_level_values(0).values)))
+    data = pd.Series([0 for i in dates], index=dates)
+
+    for i, ID in enumerate(IDs):
+        newData = dataTable.loc[(slice(None), ID), 'Value'].shift(LGs[i])
+        data = np.sum([data, CFs[i]*pd.Series(newData.values, index=newData.index.get_level_values(0))], axis=0)
+
+    return data
+
+
+def calendarShiftReference(dataTable, combinationString, dates):
+    """
+    A straightforward pandas version of the combination with lags in calendar days
+    """
+    IDs, CFs, LGs = DataProcessor.parseCompositeString(combinationString)
+    total = pd.Series(0.0, index=dates)
+    for ID, CF, LG in zip(IDs, CFs, LGs):
+        component = dataTable.xs(ID, level='DatasetInternalID')['Value']
+        total = total + CF * component.shift(LG, freq='D').reindex(dates)
+    return total.values
+
+
+def syntheticDataTable(numComponents = NUM_COMPONENTS, years = YEARS, missingFraction = 0.0, seed = 0):
+    """
+    Builds a long (Datetime, DatasetInternalID) dataTable of daily datasets. Missing days are dropped from the table.
+    """
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range(pd.Timestamp.now().normalize() - pd.DateOffset(years=years), pd.Timestamp.now().normalize(), freq='D')
+    frames = []
+    for ID in range(100000, 100000 + numComponents):
+        keep = rng.rand(len(dates)) >= missingFraction
+        index = pd.MultiIndex.from_arrays([dates[keep], np.full(keep.sum(), ID)], names=['Datetime', 'DatasetInternalID'])
+        frames.append(pd.DataFrame({'Value': rng.gamma(2, 50, keep.sum()), 'EditFlag': False}, index=index))
+    return pd.concat(frames).sort_index()
+
+
+def datasetTableFor(dataTable):
+    """
+    A minimal datasetTable for the synthetic datasets
+    """
+    IDs = dataTable.index.get_level_values('DatasetInternalID').unique()
+    return pd.DataFrame({'DatasetName': [str(i) for i in IDs], 'DatasetParameter': 'Streamflow', 'DatasetUnits': 'CFS',
+                         'DatasetExternalID': [str(i) for i in IDs], 'DatasetAgency': 'USGS'}, index=IDs)
+
+
+if __name__ == '__main__':
+
+    rng = np.random.RandomState(1)
+    IDs = list(range(100000, 100000 + NUM_COMPONENTS))
+    combinationString = 'C/{0}/{1}/{2}'.format(','.join(str(i) for i in IDs), ','.join('{0:.2f}'.format(c) for c in rng.uniform(-1, 1, NUM_COMPONENTS)), ','.join(str(l) for l in rng.randint(0, 10, NUM_COMPONENTS)))
+
+    for missingFraction in [0.0, 0.02]:
+
+        dataTable = syntheticDataTable(missingFraction = missingFraction)
+        datasetTable = datasetTableFor(dataTable)
+        store = DataStore.fromLongTable(dataTable)
+        print("{0} components x {1} years, {2:.0%} of days missing".format(NUM_COMPONENTS, YEARS, missingFraction))
+
+        null, new = DataProcessor.combinedDataSet(dataTable, datasetTable, combinationString)
+        np.testing.assert_allclose(calendarShiftReference(dataTable, combinationString, new.index), new['Value'].values, rtol=1e-10, equal_nan=True)
+        print("  new result matches the calendar-day reference")
+
+        try:
+            legacy = legacyCombinedValues(dataTable, combinationString)
+            np.testing.assert_allclose(np.asarray(legacy, dtype=float), new['Value'].values, rtol=1e-10, equal_nan=True)
+            print("  legacy result agrees")
+            tLegacy = timeIt(lambda: legacyCombinedValues(dataTable, combinationString), repeats=1)
+        except ValueError as E:
+            print("  legacy implementation fails on gappy data: {0}".format(str(E).split('.')[0]))
+            tLegacy = np.nan
+
+        tNew = timeIt(lambda: DataProcessor.combinedDataSet(dataTable, datasetTable, combinationString))
+        tStore = timeIt(lambda: DataProcessor.compositeValues(store, combinationString, store.dates[0], store.dates[-1]))
+        tSkip = timeIt(lambda: DataProcessor.compositeValues(store, combinationString, store.dates[0], store.dates[-1], 'skip'))
+        for label, t in [('legacy', tLegacy), ('combinedDataSet', tNew), ('compositeValues (store)', tStore), ('... with nanHandling=skip', tSkip)]:
+            if np.isfinite(t):
+                print("  {0:<26}{1:8.3f}s {2}".format(label, t, '' if label == 'legacy' or np.isnan(tLegacy) else '({0:.0f}x)'.format(tLegacy/t)))
+        print('')
@@ -0,0 +1,179 @@
+"""
+Script Name:        downloadBenchmark.py
+
+Description:        Runs the Data tab's download (downloadData.alternateThreadWorker, with its
+                    DownloadExecutor) end to end against the local mock agency server for 10,
+                    100 and 500 datasets, and reports the wall time, the peak RSS of the main
+                    process and of the download worker processes, the requests the server
+                    answered and the bytes it sent. The datasets are a mix of every dataloader
+                    (USGS, NRCS SNOTEL / SCAN / snow course, PRISM / NRCC, USBR, CPC and PDSI).
+                    No network access is needed.
+
+                    Each size runs in a fresh Python process (so the RSS numbers don't carry over),
+                    with the response cache off and the dataloaders' lookup tables in a temporary
+                    directory.
+
+                    Run from the repository root:
+
+                        python -m benchmarks.downloadBenchmark [--sizes 10 100 500] [--years 10] [--latency 0.05] [--bandwidth 5e6]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+from benchmarks.mockAgencyServer import MockAgencyServer, HOSTS
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows
+
+SIZES = [10, 100, 500]
+
+# Share of the datasets that use each kind of dataset
+DATASET_MIX = [
+    ('USGS',            0.40),
+    ('SNOTEL SWE',      0.12),
+    ('SNOTEL PRCP',     0.08),
+    ('SCAN SMS',        0.04),
+    ('SNOWCOURSE',      0.04),
+    ('PRISM',           0.10),
+    ('NRCC',            0.06),
+    ('USBR GP',         0.04),
+    ('USBR PN',         0.04),
+    ('CPC',             0.04),
+    ('PDSI',            0.04)]
+
+CPC_INDICES = ['nino3.4', 'pna', 'amo', 'pdo']
+
+
+def makeDataset(kind, i):
+    """
+    Returns the datasetTable entry for the i'th dataset of a kind
+    """
+    if kind == 'USGS':
+        return dict(DatasetType = 'STREAMGAGE', DatasetExternalID = '{0:08d}'.format(6000000 + i), DatasetAgency = 'USGS', DatasetParameter = 'Streamflow', DatasetUnits = 'CFS', DatasetDataloader = 'USGS_NWIS')
+    if kind in ['SNOTEL SWE', 'SNOTEL PRCP', 'SCAN SMS', 'SNOWCOURSE']:
+        datasetType, parameter, units = {'SNOTEL SWE': ('SNOTEL', 'Snow Water Equivalent', 'inches'), 'SNOTEL PRCP': ('SNOTEL', 'Precipitation', 'inches'),
+                                         'SCAN SMS': ('SCAN', 'Soil Moisture', 'pct'), 'SNOWCOURSE': ('SNOWCOURSE', 'Snow Water Equivalent', 'inches')}[kind]
+        return dict(DatasetType = datasetType, DatasetExternalID = str(300 + i), DatasetAgency = 'NRCS', DatasetParameter = parameter, DatasetUnits = units, DatasetDataloader = 'NRCS_WCC')
+    if kind in ['PRISM', 'NRCC']:
+        return dict(DatasetType = 'WATERSHED', DatasetExternalID = '1{0}{1:06d}'.format(i % 3, 3000 + i), DatasetAgency = kind, DatasetParameter = ['Precipitation', 'Temperature'][i % 2], DatasetUnits = ['inches', 'degF'][i % 2], DatasetDataloader = 'RCC_ACIS')
+    if kind in ['USBR GP', 'USBR PN']:
+        return dict(DatasetType = 'RESERVOIR', DatasetExternalID = 'RES{0}'.format(i), DatasetAgency = kind, DatasetParameter = 'Inflow', DatasetParameterCode = 'IN' if kind == 'USBR GP' else 'QD', DatasetUnits = 'CFS', DatasetDataloader = 'USBR')
+    if kind == 'CPC':
+        return dict(DatasetType = 'CLIMATE', DatasetExternalID = CPC_INDICES[i % len(CPC_INDICES)], DatasetAgency = 'CPC', DatasetParameter = 'Indice', DatasetUnits = 'Unitless', DatasetDataloader = 'CPC')
+    if kind == 'PDSI':
+        return dict(DatasetType = 'CLIMATE', DatasetExternalID = str(101 + i), DatasetAgency = 'NCEI', DatasetParameter = 'PDSI', DatasetUnits = 'Unitless', DatasetDataloader = 'PDSI')
+
+
+def makeDatasetTable(numDatasets):
+    """
+    Builds a datasetTable with numDatasets datasets in the DATASET_MIX proportions (at least one of each kind)
+    """
+    counts = {kind: max(1, int(round(share*numDatasets))) for kind, share in DATASET_MIX}
+    counts['USGS'] = max(1, numDatasets - sum(count for kind, count in counts.items() if kind != 'USGS'))
+
+    entries = []
+    for kind, share in DATASET_MIX:
+        for i in range(counts[kind]):
+            entry = makeDataset(kind, i)
+            entry['DatasetName'] = '{0} {1}'.format(kind, i)
+            entry['DatasetAdditionalOptions'] = {}
+            entries.append(entry)
+
+    return pd.DataFrame(entries, index = pd.Index(range(100000, 100000 + len(entries)), name = 'DatasetInternalID'))
+
+
+def peakRSSMegabytes(who):
+    """
+    Peak resident set size (MB) of this process ('self') or of its finished child processes ('children')
+    """
+    if resource is None:
+        return float('nan')
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss/(1024.0*1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def runDownload(numDatasets, serverURL, years, temporaryDirectory):
+    """
+    Downloads numDatasets datasets from the mock server with the Data tab's download worker (in this process)
+    """
+    from resources.modules.DataTab import httpEngine, downloadExecutor, downloadData
+    from resources.DataLoaders import NRCS_WCC, RCC_ACIS
+
+    # Send every agency's requests to the mock server, and keep the lookup tables out of resources/temp
+    httpEngine.configureCache(enabled = False)
+    httpEngine.configureHosts({host: serverURL for host in HOSTS})
+    NRCS_WCC.WSDL_CACHE_FILE = os.path.join(temporaryDirectory, 'nrcsWSDL.db')
+    NRCS_WCC.LOOKUP_TABLE_FILE = os.path.join(temporaryDirectory, 'nrcsStations.json')
+    RCC_ACIS.BBOX_TABLE_FILE = os.path.join(temporaryDirectory, 'hucBoundingBoxes.json')
+
+    datasets = makeDatasetTable(numDatasets)
+    endDate = pd.Timestamp.now().normalize()
+    startDate = endDate - pd.DateOffset(years = years)
+
+    # Run the worker on this thread, collecting what it sends back
+    executor = downloadExecutor.DownloadExecutor()
+    worker = downloadData.alternateThreadWorker(datasets, startDate, endDate, executor)
+    newData = []
+    events = []
+    worker.signals.returnNewData.connect(newData.append)
+    worker.signals.datasetStatus.connect(events.append)
+
+    start = time.perf_counter()
+    worker.run()
+    wallTime = time.perf_counter() - start
+    executor.shutdown(wait = True)
+
+    finished = [event for event in events if event['status'] != 'queued']
+
+    return {
+        'datasets':         len(datasets),
+        'seconds':          wallTime,
+        'downloaded':       sum(event['status'] == 'done' for event in finished),
+        'failed':           sum(event['status'] != 'done' for event in finished),
+        'rows':             int(sum(len(table) for table in newData)),
+        'rssMain':          peakRSSMegabytes('self'),
+        'rssWorkers':       peakRSSMegabytes('children')}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'End to end download benchmark against the mock agency server')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = SIZES, help = 'numbers of datasets to download')
+    parser.add_argument('--years', type = int, default = 10, help = 'years of data per dataset')
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'server latency per request (seconds)')
+    parser.add_argument('--bandwidth', type = float, default = None, help = 'server bandwidth per response (bytes per second, default unlimited)')
+    parser.add_argument('--run', type = int, default = None, help = argparse.SUPPRESS) # one size, in this process
+    parser.add_argument('--server', default = None, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # A single run, started by the loop below. The results go back as JSON.
+    if args.run is not None:
+        with tempfile.TemporaryDirectory() as temporaryDirectory:
+            print(json.dumps(runDownload(args.run, args.server, args.years, temporaryDirectory)))
+        sys.exit(0)
+
+    server = MockAgencyServer(args.latency, args.bandwidth).start()
+    print("Mock agency server: {0} (latency {1} s, bandwidth {2})".format(server.url, args.latency, 'unlimited' if args.bandwidth is None else '{0:g} B/s'.format(args.bandwidth)))
+    print("{0} years of data per dataset\n".format(args.years))
+    print("{0:>9}{1:>10}{2:>8}{3:>11}{4:>10}{5:>11}{6:>15}{7:>18}".format('Datasets', 'Wall (s)', 'Failed', 'Requests', 'MB sent', 'Rows', 'RSS main (MB)', 'RSS workers (MB)'))
+
+    for size in args.sizes:
+        server.resetCounts()
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.downloadBenchmark', '--run', str(size), '--server', server.url, '--years', str(args.years)],
+                                capture_output = True, text = True, cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        if output.returncode != 0:
+            print("{0:>9}  failed:\n{1}".format(size, output.stderr))
+            continue
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        print("{0:>9}{1:>10.2f}{2:>8}{3:>11}{4:>10.1f}{5:>11}{6:>15.0f}{7:>18.0f}".format(
+            result['datasets'], result['seconds'], result['failed'], sum(server.requestCounts().values()), server.bytesSent/1e6, result['rows'], result['rssMain'], result['rssWorkers']))
+
+    server.stop()
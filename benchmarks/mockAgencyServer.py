@@ -0,0 +1,370 @@
+"""
+Script Name:        mockAgencyServer.py
+
+Description:        A local stand-in for the agency web services that the dataloaders in
+                    resources/DataLoaders use (USGS NWIS, NRCS AWDB (SOAP), RCC ACIS, USBR,
+                    CPC / PSL and NCEI), so downloads can be benchmarked and tested offline.
+
+                    The static source files (the CPC / PSL indices and the climate division
+                    file) are replayed from benchmarks/sampleData, and the AWDB WSDL from
+                    benchmarks/fixtures. Per-station services (NWIS daily values, AWDB getData,
+                    ACIS GridData and the USBR endpoints) answer in the same layout as the real
+                    responses, with deterministic synthetic values for the stations and dates
+                    that were asked for. Each response waits 'latency' seconds and is sent at
+                    no more than 'bandwidth' bytes a second.
+
+                    The dataloaders are pointed at the server with httpEngine.configureHosts:
+
+                        server = MockAgencyServer(latency = 0.05).start()
+                        httpEngine.configureHosts(server.hostOverrides())
+
+                    or it can be run on its own:
+
+                        python -m benchmarks.mockAgencyServer --port 8765 --latency 0.05
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+import numpy as np
+import pandas as pd
+from benchmarks.parserBenchmark import nationalPDSIFile, readSample
+
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Hosts the dataloaders use
+USGS_HOST = 'waterservices.usgs.gov'
+NRCS_HOST = 'www.wcc.nrcs.usda.gov'
+ACIS_HOST = 'data.rcc-acis.org'
+USBR_HOST = 'www.usbr.gov'
+CPC_HOST = 'www.cpc.ncep.noaa.gov'
+PSL_HOST = 'www.esrl.noaa.gov'
+NCEI_HOST = 'www.ncdc.noaa.gov'
+NCEI_FILES_HOST = 'www1.ncdc.noaa.gov'
+HOSTS = [USGS_HOST, NRCS_HOST, ACIS_HOST, USBR_HOST, CPC_HOST, PSL_HOST, NCEI_HOST, NCEI_FILES_HOST]
+
+# The climate division file's name in the mock directory listing, and its size (about 344 divisions x 130 years)
+CLIMDIV_FILE = 'climdiv-pdsidv-v1.0.0-mock'
+CLIMDIV_ROWS = 45000
+
+# Soil moisture sensor depths (inches) at every mock SCAN / SNOTEL station
+SOIL_DEPTHS = [-2, -8, -20]
+
+SOAP_NAMESPACE = 'http://schemas.xmlsoap.org/soap/envelope/'
+AWDB_NAMESPACE = 'http://www.wcc.nrcs.usda.gov/ns/awdbWebService'
+
+# Bytes written between bandwidth checks
+CHUNK_SIZE = 65536
+
+
+def seedOf(*keys):
+    """
+    Returns a stable random seed for a station (the same station always gets the same data)
+    """
+    return zlib.crc32('|'.join(str(key) for key in keys).encode())
+
+
+def syntheticValues(dates, *keys, scale = 100.0):
+    """
+    Returns a seasonal series with noise for a station, one value per date
+    """
+    rng = np.random.RandomState(seedOf(*keys))
+    dayOfYear = (dates - dates.astype('datetime64[Y]')).astype(np.int64)
+    return np.round(scale*(1.2 + np.sin(2*np.pi*dayOfYear/365.25 + rng.uniform(0, 2*np.pi))) + rng.normal(0, scale/20, len(dates)), 2)
+
+
+def dayRange(startDate, endDate):
+    """
+    Returns the days from startDate to endDate (inclusive) as a datetime64[D] array
+    """
+    return np.arange(np.datetime64(startDate, 'D'), np.datetime64(endDate, 'D') + 1)
+
+
+def hucBoundingBox(huc):
+    """
+    A made up (but stable) bounding box for a HUC. HUCs in the same region are near each other.
+    """
+    region, subregion, basin = int(huc[:2]), int(huc[2:4]), int(huc[4:8])
+    west = -125.0 + (region % 18)*3.0 + (subregion % 10)*0.3 + (basin % 7)*0.04
+    south = 30.0 + (region // 6)*5.0 + (subregion // 10)*0.5 + (basin % 5)*0.05
+    return [round(west, 3), round(south, 3), round(west + 0.25, 3), round(south + 0.2, 3)]
+
+
+class MockAgencyServer(object):
+    """
+    A threaded HTTP server that answers for every agency host. Requests are routed on their Host header
+    (the dataloaders keep the real host in it when httpEngine redirects them).
+    """
+
+    def __init__(self, latency = 0.05, bandwidth = None, host = '127.0.0.1', port = 0):
+        self.latency = float(latency)
+        self.bandwidth = float(bandwidth) if bandwidth else None
+        self.countLock = threading.Lock()
+        self.counts = {} # host -> requests
+        self.bytesSent = 0
+        self.knownHUCs = set() # HUCs that have been looked up (the basins GridData can return)
+        self.staticFiles = {}
+        self.staticLock = threading.Lock()
+
+        server = self
+        class Handler(MockAgencyHandler):
+            mock = server
+        self.httpServer = ThreadingHTTPServer((host, port), Handler)
+        self.httpServer.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.httpServer.server_address[:2])
+
+    def hostOverrides(self):
+        """
+        Returns the httpEngine.configureHosts overrides that send every agency host to this server
+        """
+        return {host: self.url for host in HOSTS}
+
+    def start(self):
+        self.thread = threading.Thread(target = self.httpServer.serve_forever, name = 'mock-agency-server', daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+        return
+
+    def requestCounts(self):
+        with self.countLock:
+            return dict(self.counts)
+
+    def resetCounts(self):
+        with self.countLock:
+            self.counts = {}
+            self.bytesSent = 0
+        return
+
+    def count(self, host, numBytes):
+        with self.countLock:
+            self.counts[host] = self.counts.get(host, 0) + 1
+            self.bytesSent += numBytes
+        return
+
+    def staticFile(self, name, build):
+        """
+        Returns a replayed file's bytes (built once)
+        """
+        with self.staticLock:
+            if name not in self.staticFiles:
+                self.staticFiles[name] = build()
+            return self.staticFiles[name]
+
+    # ------------------------------------------------------------------
+    # Responses for each service. Each returns (status, content type, body bytes).
+    # ------------------------------------------------------------------
+
+    def respond(self, method, host, path, query, body):
+        if host == USGS_HOST and path.startswith('/nwis/dv'):
+            return self.nwisDailyValues(query)
+        if host == NRCS_HOST and method == 'GET':
+            return 200, 'text/xml', self.staticFile('wsdl', lambda: open(os.path.join(FIXTURE_DIRECTORY, 'awdbWebService.wsdl'), 'rb').read())
+        if host == NRCS_HOST:
+            return self.awdb(body)
+        if host == ACIS_HOST and path.startswith('/General/basin'):
+            return self.acisBasins(parse_qs(body.decode()))
+        if host == ACIS_HOST and path.startswith('/GridData'):
+            return self.acisGridData(json.loads(body))
+        if host == USBR_HOST and path.startswith('/gp-bin/arcread.pl'):
+            return self.usbrGreatPlains(query)
+        if host == USBR_HOST and path.startswith('/pn-bin/daily.pl'):
+            return self.usbrPacificNorthwest(query)
+        if host == CPC_HOST or host == PSL_HOST:
+            fileName = path.rsplit('/', 1)[-1]
+            if os.path.exists(os.path.join(os.path.dirname(FIXTURE_DIRECTORY), 'sampleData', fileName)):
+                return 200, 'text/plain', self.staticFile(fileName, lambda: readSample(fileName).encode())
+        if host == NCEI_HOST and path.startswith('/teleconnections/pdo/data.json'):
+            return 200, 'application/json', self.staticFile('pdo', self.pdoFile)
+        if host == NCEI_FILES_HOST and path.rstrip('/').endswith('/climdiv'):
+            return 200, 'text/html', '<html><body><a href="{0}">{0}</a></body></html>'.format(CLIMDIV_FILE).encode()
+        if host == NCEI_FILES_HOST and path.endswith(CLIMDIV_FILE):
+            return 200, 'text/plain', self.staticFile('climdiv', lambda: nationalPDSIFile(readSample('climdiv-pdsidv-sample'), CLIMDIV_ROWS).encode())
+
+        return 404, 'text/plain', b'Not found'
+
+    def nwisDailyValues(self, query):
+        """
+        NWIS daily values JSON for every site in 'sites='
+        """
+        dates = dayRange(query['startDT'][0], query['endDT'][0])
+        dateStrings = [str(date) + 'T00:00:00.000' for date in dates]
+        timeSeries = []
+        for site in query['sites'][0].split(','):
+            values = syntheticValues(dates, 'USGS', site)
+            records = ','.join('{{"value":"{0}","qualifiers":["A"],"dateTime":"{1}"}}'.format(value, date) for value, date in zip(values, dateStrings))
+            timeSeries.append(
+                '{{"sourceInfo":{{"siteName":"MOCK SITE {0}","siteCode":[{{"value":"{0}","network":"NWIS","agencyCode":"USGS"}}]}},'
+                '"variable":{{"variableCode":[{{"value":"00060"}}],"noDataValue":-999999.0}},'
+                '"values":[{{"value":[{1}],"qualifier":[{{"qualifierCode":"A"}}],"method":[{{"methodID":1}}]}}],'
+                '"name":"USGS:{0}:00060:00003"}}'.format(site, records))
+
+        return 200, 'application/json', ('{"name":"ns1:timeSeriesResponseType","value":{"timeSeries":[' + ','.join(timeSeries) + ']}}').encode()
+
+    def awdb(self, body):
+        """
+        Answers an AWDB SOAP call (getStations, getStationElements or getData)
+        """
+        operation = ElementTree.fromstring(body).find('{{{0}}}Body'.format(SOAP_NAMESPACE))[0]
+        name = operation.tag.split('}')[-1]
+        fields = {}
+        for child in operation:
+            fields.setdefault(child.tag.split('}')[-1], []).append(child)
+        text = lambda field: fields[field][0].text
+
+        returns = []
+        if name == 'getStations':
+            networks = [network.text for network in fields.get('networkCds', [])]
+            returns = ['<return>{0}:MT:{1}</return>'.format(escape(station.text), escape(network)) for station in fields.get('stationIds', []) for network in networks]
+
+        elif name == 'getStationElements':
+            elements = [('WTEQ', 'DAILY', None), ('PRCP', 'DAILY', None)] + [('SMS', 'DAILY', depth) for depth in SOIL_DEPTHS]
+            for elementCd, duration, depth in elements:
+                depthXML = '' if depth is None else '<heightDepth><value>{0}</value><unitCd>in</unitCd></heightDepth>'.format(depth)
+                returns.append('<return><elementCd>{0}</elementCd><duration>{1}</duration>{2}<stationTriplet>{3}</stationTriplet></return>'.format(elementCd, duration, depthXML, escape(text('stationTriplet'))))
+
+        elif name == 'getData':
+            duration = text('duration')
+            beginDate, endDate = pd.Timestamp(text('beginDate')), pd.Timestamp(text('endDate'))
+            if duration == 'SEMIMONTHLY':
+                dates = pd.date_range(beginDate, endDate, freq = 'SMS')
+                dates = dates[dates.month <= 6].values.astype('datetime64[D]')
+            else:
+                dates = dayRange(beginDate, endDate)
+            for triplet in fields['stationTriplets']:
+                values = syntheticValues(dates, 'NRCS', triplet.text, text('elementCd'), scale = 10.0)
+                valuesXML = ''.join('<values>{0}</values>'.format(value) for value in values)
+                datesXML = ''.join('<collectionDates>{0}</collectionDates>'.format(date) for date in dates) if duration == 'SEMIMONTHLY' else ''
+                returns.append('<return><stationTriplet>{0}</stationTriplet><duration>{1}</duration><beginDate>{2} 00:00:00</beginDate><endDate>{3} 00:00:00</endDate>{4}{5}</return>'.format(
+                    escape(triplet.text), duration, beginDate.date(), endDate.date(), datesXML, valuesXML))
+
+        envelope = ('<?xml version="1.0" encoding="UTF-8"?><soap:Envelope xmlns:soap="{0}"><soap:Body><ns2:{1}Response xmlns:ns2="{2}">{3}</ns2:{1}Response></soap:Body></soap:Envelope>'
+                    .format(SOAP_NAMESPACE, name, AWDB_NAMESPACE, ''.join(returns)))
+
+        return 200, 'text/xml; charset=utf-8', envelope.encode()
+
+    def acisBasins(self, form):
+        """
+        General/basin bounding boxes for the HUCs in 'id='
+        """
+        hucs = [huc for huc in form.get('id', [''])[0].split(',') if len(huc) == 8 and huc.isdigit()]
+        with self.countLock:
+            self.knownHUCs.update(hucs)
+
+        return 200, 'application/json', json.dumps({'meta': [{'id': huc, 'bbox': hucBoundingBox(huc)} for huc in hucs]}).encode()
+
+    def acisGridData(self, params):
+        """
+        GridData basin means for every known basin inside the requested bounding box
+        """
+        west, south, east, north = [float(coord) for coord in params['bbox'].split(',')]
+        with self.countLock:
+            hucs = sorted(huc for huc in self.knownHUCs if west <= hucBoundingBox(huc)[0] and hucBoundingBox(huc)[2] <= east and south <= hucBoundingBox(huc)[1] and hucBoundingBox(huc)[3] <= north)
+        dates = dayRange(datetime.strptime(params['sdate'], '%Y%m%d'), datetime.strptime(params['edate'], '%Y%m%d'))
+
+        columns = [{huc: syntheticValues(dates, 'ACIS', params['grid'], huc, element['name'], scale = 1.0) for huc in hucs} for element in params['elems']]
+        rows = [[str(date)] + [{huc: float(column[huc][i]) for huc in hucs} for column in columns] for i, date in enumerate(dates)]
+
+        return 200, 'application/json', json.dumps({'data': rows}).encode()
+
+    def usbrGreatPlains(self, query):
+        """
+        GP region arcread JSON
+        """
+        startDate = datetime(int(query['by'][0]), int(query['bm'][0]), int(query['bd'][0]))
+        endDate = datetime(int(query['ey'][0]), int(query['em'][0]), int(query['ed'][0]))
+        pcode = query['pa'][0].upper()
+        dates = dayRange(startDate, endDate)
+        values = syntheticValues(dates, 'USBR', query['st'][0], pcode)
+        data = [{'DATE': str(date), pcode: str(value)} for date, value in zip(dates, values)]
+
+        return 200, 'application/json', json.dumps({'SITE': {'SITE': query['st'][0], 'DATA': data}}).encode()
+
+    def usbrPacificNorthwest(self, query):
+        """
+        PN region daily CSV
+        """
+        startDate = datetime(int(query['year'][0]), int(query['month'][0]), int(query['day'][0]))
+        endDate = datetime(int(query['year'][-1]), int(query['month'][-1]), int(query['day'][-1]))
+        dates = dayRange(startDate, endDate)
+        values = syntheticValues(dates, 'USBR', query['station'][0], query['pcode'][0])
+        lines = ['DateTime,{0}_{1}'.format(query['station'][0], query['pcode'][0])] + ['{0},{1}'.format(date, value) for date, value in zip(dates, values)]
+
+        return 200, 'text/csv', ('\n'.join(lines) + '\n').encode()
+
+    def pdoFile(self):
+        """
+        NCEI's PDO JSON ('YYYYMM': 'value')
+        """
+        dates = pd.date_range('1854-01-01', pd.Timestamp.now(), freq = 'MS')
+        values = syntheticValues(dates.values.astype('datetime64[D]'), 'PDO', scale = 1.0)
+        return json.dumps({'description': {'title': 'Mock PDO'}, 'data': {date.strftime('%Y%m'): str(value) for date, value in zip(dates, values)}}).encode()
+
+
+class MockAgencyHandler(BaseHTTPRequestHandler):
+    """
+    Routes a request to the MockAgencyServer and sends the response at the server's latency and bandwidth
+    """
+    protocol_version = 'HTTP/1.1'
+    mock = None
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        parts = urlsplit(self.path)
+        host = self.headers.get('Host', '').split(':')[0]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+        try:
+            status, contentType, content = self.mock.respond(method, host, parts.path, parse_qs(parts.query), body)
+        except Exception as E:
+            status, contentType, content = 500, 'text/plain', str(E).encode()
+        self.mock.count(host, len(content))
+
+        time.sleep(self.mock.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        for start in range(0, len(content), CHUNK_SIZE):
+            chunk = content[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if self.mock.bandwidth is not None:
+                time.sleep(len(chunk)/self.mock.bandwidth)
+
+        return
+
+    def log_message(self, format, *args):
+        return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the agency web services')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'seconds before each response')
+    parser.add_argument('--bandwidth', type = float, default = None, help = 'bytes per second per response (default: unlimited)')
+    args = parser.parse_args()
+
+    server = MockAgencyServer(args.latency, args.bandwidth, port = args.port)
+    print("Mock agency server on {0}. Point the dataloaders at it with:".format(server.url))
+    print("    httpEngine.configureHosts({0})".format(server.hostOverrides()))
+    server.httpServer.serve_forever()
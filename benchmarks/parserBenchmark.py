@@ -0,0 +1,129 @@
+"""
+Script Name:        parserBenchmark.py
+
+Description:        Times the textParsers parsers for the CPC, AMO and PDSI files against the
+                    original dataloader parsing code (a pd.to_datetime call per line, and date
+                    strings built row by row), using the sample files in benchmarks/sampleData.
+                    The PDSI sample (6 climate divisions) is repeated with new division codes
+                    to the size of the national file. Results are checked against the original
+                    parsers.
+
+                    Run from the repository root:
+
+                        python -m benchmarks.parserBenchmark
+"""
+
+import os
+from io import StringIO
+import numpy as np
+import pandas as pd
+from resources.modules.DataTab import textParsers
+from benchmarks.resampleBenchmark import timeIt
+
+SAMPLE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sampleData')
+
+# Rows in the national climate division file
+PDSI_ROWS = 300000
+
+
+def readSample(fileName):
+    with open(os.path.join(SAMPLE_DIRECTORY, fileName), 'r') as readFile:
+        return readFile.read()
+
+
+def nationalPDSIFile(sample, numRows = PDSI_ROWS):
+    """
+    Repeats the sample's divisions under new (state, division) codes until the file has numRows rows
+    """
+    lines = sample.splitlines()
+    sampleDivisions = list(dict.fromkeys(line[:4] for line in lines))
+    copies = []
+    for i in range(int(np.ceil(numRows / len(lines)))):
+        for line in lines:
+            divisionNumber = i*len(sampleDivisions) + sampleDivisions.index(line[:4])
+            copies.append('{0:02d}{1:02d}'.format(divisionNumber // 90 + 1, divisionNumber % 90 + 1) + line[4:])
+    return '\n'.join(copies[:numRows]) + '\n'
+
+
+# ------------------------------------------------------------------
+# The original parsers, kept here as the reference implementations
+# ------------------------------------------------------------------
+
+def legacyNinoMonthly(text):
+    timestamps = []
+    anoms = []
+    for line in StringIO(text).readlines()[1:]:
+        values = line.split()
+        year = str(values[0])
+        month = '0'+str(values[1])
+        timestamps.append(pd.to_datetime(year + month[-2:] + '15', format='%Y%m%d'))
+        anoms.append(float(values[9]))
+    return pd.Series(anoms, index = timestamps)
+
+
+def legacyNinoWeekly(text):
+    timestamps = []
+    anoms = []
+    for line in StringIO(text).readlines()[4:]:
+        values = line.split('     ')
+        timestamps.append(pd.to_datetime(values[0]))
+        anoms.append(float(values[3][4:]))
+    return pd.Series(anoms, index = timestamps)
+
+
+def legacyAMO(text):
+    df = pd.read_csv(StringIO(text), skiprows=1, names=['year','1','2','3','4','5','6','7','8','9','10','11','12'], sep=r'\s+')
+    lastRow = df.index[df['year']=='AMO'].tolist()[0] -1
+    df = df[df.index<lastRow]
+    df = df.melt(id_vars=['year'],var_name='month')
+    dates = [str(df['year'][i])+'-'+str(df['month'][i]) for i in df.index]
+    df.set_index(pd.DatetimeIndex(pd.to_datetime(dates, format='%Y-%m')), inplace=True)
+    df.sort_index(inplace=True)
+    df['value'] = pd.to_numeric(df['value'])
+    df.replace(to_replace=-99.990, value=np.nan, inplace=True)
+    return df['value']
+
+
+def legacyPDSI(text, stationID):
+    df = pd.read_csv(StringIO(text), names=['code','1','2','3','4','5','6','7','8','9','10','11','12'], index_col=False, sep=r'\s+')
+    df['code'] = df['code'].astype(str)
+    li = [df['code'][i][:-6] for i in df.index]
+    yr = [int(df['code'][i][-4:]) for i in df.index]
+    df['divID'] = li
+    df['year'] = yr
+    df = df[df['divID'] == stationID]
+    del df['code']
+    df = df.melt(id_vars=['divID','year'], var_name='month')
+    dateList = [pd.to_datetime(str(df['year'][i]) + '-' + str(df['month'][i]), format='%Y-%m') for i in df.index]
+    df.set_index(pd.DatetimeIndex(dateList), inplace=True)
+    df.replace(to_replace=-99.99, value=np.nan, inplace=True)
+    df.sort_index(inplace=True)
+    return df['value']
+
+
+def sameSeries(a, b):
+    a, b = a.sort_index(), b.sort_index()
+    return len(a) == len(b) and np.array_equal(a.index.values.astype('datetime64[D]'), b.index.values.astype('datetime64[D]')) and np.allclose(a.values, b.values, equal_nan=True)
+
+
+if __name__ == '__main__':
+
+    ninoMonthly = readSample('sstoi.indices')
+    ninoWeekly = readSample('wksst8110.for')
+    amo = readSample('amon.us.long.data')
+    pdsi = nationalPDSIFile(readSample('climdiv-pdsidv-sample'))
+    print("PDSI file: {0} rows\n".format(PDSI_ROWS))
+
+    # The original PDSI code parses the whole file for each division, so time it for one division
+    cases = [
+        ('Nino 3.4 monthly',    lambda: legacyNinoMonthly(ninoMonthly),     lambda: textParsers.parseNinoMonthly(ninoMonthly)),
+        ('Nino 3.4 weekly',     lambda: legacyNinoWeekly(ninoWeekly),       lambda: textParsers.parseNinoWeekly(ninoWeekly)),
+        ('AMO',                 lambda: legacyAMO(amo),                     lambda: textParsers.parseYearByMonthTable(amo)),
+        ('PDSI (1 division)',   lambda: legacyPDSI(pdsi, '101'),            lambda: textParsers.parseClimateDivisions(pdsi)['101'])]
+
+    print("{0:<22}{1:>12}{2:>12}{3:>10}{4:>8}".format('File', 'Legacy (s)', 'New (s)', 'Speedup', 'Match'))
+    for name, legacy, new in cases:
+        match = sameSeries(legacy(), new())
+        legacyTime = timeIt(legacy, repeats = 1)
+        newTime = timeIt(new)
+        print("{0:<22}{1:>12.4f}{2:>12.4f}{3:>9.1f}x{4:>8}".format(name, legacyTime, newTime, legacyTime / newTime, str(match)))
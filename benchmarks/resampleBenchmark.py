@@ -0,0 +1,100 @@
+"""
+Script Name:        resampleBenchmark.py
+
+Description:        Times DataProcessor.resampleDataSet against the original per-period
+                    (IntervalIndex / .loc slice) implementation on a synthetic 100-year
+                    daily record, and checks that both return the same series.
+
+                    Run from the repository root:
+
+                        python -m benchmarks.resampleBenchmark
+"""
+
+import time
+import numpy as np
+import pandas as pd
+import isodate
+from datetime import datetime
+from resources.modules.Miscellaneous import DataProcessor
+
+RESAMPLE_STRINGS = ['R/1920-10-01/P1M/F1Y', 'R/1920-04-01/P3M/F1Y', 'R/1920-01-01/P1M/F1M', 'R/1920-02-01/P28D/F1Y', 'R/1920-01-01/P7D/F7D']
+METHODS = ['average', 'accumulation', 'max', 'min', 'first', 'last']
+
+
+def legacyResampleDataSet(dailyData, resampleString, resampleMethod):
+    """
+    The original loop-based resampler, kept here as the reference implementation.
+    """
+    today = datetime.now()
+    resampleData = pd.Series([], index = pd.DatetimeIndex([]), dtype=float)
+    firstDate = dailyData.index[0]
+    resampleList = resampleString.split('/')
+    startDate = datetime.strptime(resampleList[1], '%Y-%m-%d')
+    period = isodate.parse_duration(resampleList[2])
+    frequency = isodate.parse_duration(resampleList[3].replace('F', 'P'))
+
+    periods = []
+    tracker = startDate
+    while tracker <= today:
+        periods.append((tracker, tracker+period))
+        tracker += frequency
+
+    func = lambda x: np.nanmean(x) if resampleMethod == 'average' else (
+        np.nansum(x) if resampleMethod == 'accumulation' else (
+            x.iloc[0] if resampleMethod == 'first' else (
+                x.iloc[-1] if resampleMethod == 'last' else (
+                    np.max(x) if resampleMethod == 'max' else np.min(x)))))
+
+    for idx in pd.IntervalIndex.from_tuples(periods):
+        resampleData.loc[idx.left] = ( func(dailyData.loc[idx.left:idx.right]) if (idx.right >= firstDate and today >= idx.right) else np.nan )
+
+    return resampleData
+
+
+def syntheticRecord(years = 100, missingFraction = 0.02, seed = 0):
+    """
+    Builds a daily streamflow-like series with a few missing values
+    """
+    rng = np.random.RandomState(seed)
+    today = pd.Timestamp.now().normalize()
+    index = pd.date_range(today - pd.DateOffset(years=years), today, freq='D')
+    values = 500 + 400*np.sin(2*np.pi*index.dayofyear.values/365.25) + rng.gamma(2, 50, len(index))
+    values[rng.rand(len(index)) < missingFraction] = np.nan
+    return pd.Series(values, index=index, name='100101')
+
+
+def timeIt(func, repeats = 3):
+    """
+    Returns the best wall time of several runs
+    """
+    best = np.inf
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == '__main__':
+
+    dailyData = syntheticRecord()
+    print("Daily record: {0} days\n".format(len(dailyData)))
+    print("{0:<24}{1:<14}{2:>12}{3:>12}{4:>10}".format('Resample String', 'Method', 'Legacy (s)', 'New (s)', 'Speedup'))
+
+    totalLegacy = 0
+    totalNew = 0
+    for resampleString in RESAMPLE_STRINGS:
+        for method in METHODS:
+            legacy = legacyResampleDataSet(dailyData, resampleString, method)
+            new, code, msg = DataProcessor.resampleDataSet(dailyData, resampleString, method)
+            assert code == 0, msg
+            assert legacy.index.equals(new.index), "{0} {1}: indexes differ".format(resampleString, method)
+            np.testing.assert_allclose(legacy.values.astype(float), new.values, rtol=1e-10, equal_nan=True, err_msg="{0} {1}".format(resampleString, method))
+
+            tLegacy = timeIt(lambda: legacyResampleDataSet(dailyData, resampleString, method), repeats=1)
+            tNew = timeIt(lambda: DataProcessor.resampleDataSet(dailyData, resampleString, method))
+            totalLegacy += tLegacy
+            totalNew += tNew
+            print("{0:<24}{1:<14}{2:>12.4f}{3:>12.4f}{4:>9.0f}x".format(resampleString, method, tLegacy, tNew, tLegacy/tNew))
+
+    print("\nTotal: legacy {0:.2f}s, new {1:.3f}s ({2:.0f}x faster)".format(totalLegacy, totalNew, totalLegacy/totalNew))
@@ -36,6 +36,7 @@ warnings.filterwarnings('ignore')
 import time
 import argparse
 import resources.application as application
+from resources.modules.DataTab import httpEngine
 from datetime import datetime
 from PyQt5 import QtGui, QtWidgets, QtCore
 
@@ -60,11 +61,15 @@ if __name__ == '__main__':
     # Parse arguemnts
     parser = argparse.ArgumentParser()
     parser.add_argument('--splash','-s',help='Open program with splash screen',type=str, default='True')
+    parser.add_argument('--no-cache',help='Download all data from the servers, without using the local response cache',action='store_true')
     
     args = parser.parse_args()
 
     no_splash = args.splash
 
+    if args.no_cache:
+        httpEngine.configureCache(enabled = False)
+
     # Start up a splash screen while the application loads. (If 'no-splash' isn't specified)
     if no_splash == "True":
         splash_pic = QtGui.QPixmap('resources/GraphicalResources/splash.png')
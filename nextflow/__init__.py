@@ -0,0 +1,6 @@
+"""
+Script name:    nextflow
+Description:    Command line entry points for NextFlow that run without the GUI (no PyQt). See __main__.py:
+
+                    python -m nextflow refresh *.fcst --workers 16
+"""
@@ -0,0 +1,124 @@
+"""
+Script name:    __main__.py
+Description:    The headless NextFlow command line. 'refresh' updates the data in forecast files without
+                opening the GUI: each file is loaded, its datasets are downloaded (incrementally, like the
+                Data tab's 'Download / Update'), its imported files are re-read, its composites are
+                updated, and the file is written back. Files are refreshed in parallel on one shared set
+                of download workers, and a timing summary is printed at the end.
+
+                    python -m nextflow refresh forecasts/*.fcst --workers 16
+
+                Nothing here imports PyQt, so it can run on a server or from a scheduled task.
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import time
+import uuid
+import warnings
+warnings.filterwarnings('ignore')
+
+# The application's resource paths (e.g. 'resources/temp') are relative to the repository root
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def refresh(args):
+    """
+    Refreshes the forecast files and prints a summary. Returns the exit code (1 if any file failed).
+    """
+    from resources.modules.DataTab import downloadExecutor, httpEngine, refreshPipeline
+
+    if args.no_cache:
+        httpEngine.configureCache(enabled = False)
+    if args.offline:
+        httpEngine.configureCache(offline = True)
+
+    # One set of download workers (and one download session, so source files are shared) for every file
+    executor = downloadExecutor.DownloadExecutor(args.workers, args.processes, args.timeout)
+    sessionID = uuid.uuid4().hex
+
+    start = time.perf_counter()
+    summaries = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers = args.parallel_files) as filePool:
+        futures = {filePool.submit(refreshPipeline.refreshForecastFile, fileName, executor, args.full_resync, sessionID): fileName for fileName in args.files}
+        for future in concurrent.futures.as_completed(futures):
+            fileName = futures[future]
+            try:
+                summaries[fileName] = future.result()
+            except Exception as E:
+                summaries[fileName] = E
+            report(fileName, summaries[fileName], args.verbose)
+    executor.shutdown()
+    wallTime = time.perf_counter() - start
+
+    # Timing summary
+    refreshed = [summary for summary in summaries.values() if not isinstance(summary, Exception)]
+    print("\n{0:<40}{1:>10}{2:>12}{3:>8}{4:>10}{5:>10}".format('File', 'Datasets', 'Downloaded', 'Failed', 'Changed', 'Time (s)'))
+    for fileName in args.files:
+        summary = summaries[fileName]
+        name = os.path.basename(fileName)
+        if isinstance(summary, Exception):
+            print("{0:<40}  could not be refreshed: {1}".format(name, summary))
+            continue
+        print("{0:<40}{1:>10}{2:>12}{3:>8}{4:>10}{5:>10.1f}".format(name, summary['datasets'], summary['downloaded'], summary['failed'], summary['changed'], summary['seconds']))
+    print("\nRefreshed {0} of {1} files in {2:.1f} seconds ({3} datasets, {4} failed downloads)".format(
+        len(refreshed), len(summaries), wallTime, sum(summary['datasets'] for summary in refreshed), sum(summary['failed'] for summary in refreshed)))
+
+    return 0 if len(refreshed) == len(summaries) else 1
+
+
+def report(fileName, summary, verbose = False):
+    """
+    Prints a line as each file finishes (and its failed datasets, if verbose)
+    """
+    if isinstance(summary, Exception):
+        print("{0}: failed ({1})".format(fileName, summary))
+        return
+    print("{0}: {1} datasets, {2} failed, {3} values changed in {4:.1f} s".format(fileName, summary['datasets'], summary['failed'], summary['changed'], summary['seconds']))
+    if verbose:
+        for datasetID, error in summary['errors'].items():
+            print("    dataset {0}: {1}".format(datasetID, error))
+        for compositeID, reason in summary['skipped'].items():
+            print("    composite {0} was not updated because {1}".format(compositeID, reason))
+
+    return
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(prog = 'python -m nextflow', description = 'NextFlow without the GUI')
+    commands = parser.add_subparsers(dest = 'command')
+
+    refreshParser = commands.add_parser('refresh', help = 'download new data into forecast files and save them')
+    refreshParser.add_argument('files', nargs = '+', help = 'forecast (.fcst) files (wildcards are expanded)')
+    refreshParser.add_argument('--workers', type = int, default = 8, help = 'download threads (default 8)')
+    refreshParser.add_argument('--processes', type = int, default = 2, help = 'download processes for parsing-heavy dataloaders (default 2)')
+    refreshParser.add_argument('--parallel-files', type = int, default = 4, help = 'files refreshed at once (default 4)')
+    refreshParser.add_argument('--timeout', type = float, default = 600, help = 'seconds before a download is given up on (default 600)')
+    refreshParser.add_argument('--full-resync', action = 'store_true', help = 'download the whole period of record instead of only recent data')
+    refreshParser.add_argument('--no-cache', action = 'store_true', help = 'download everything from the servers, without the local response cache')
+    refreshParser.add_argument('--offline', action = 'store_true', help = 'only use data in the local response cache')
+    refreshParser.add_argument('--verbose', '-v', action = 'store_true', help = 'list the datasets that failed')
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    # Expand wildcards (Windows shells don't), then work from the repository root
+    files = []
+    for pattern in args.files:
+        matches = sorted(glob.glob(pattern))
+        files.extend(matches if matches != [] else [pattern])
+    args.files = list(dict.fromkeys(os.path.abspath(fileName) for fileName in files))
+    os.chdir(ROOT_DIRECTORY)
+    sys.path.insert(0, ROOT_DIRECTORY)
+
+    return refresh(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,10 +5,15 @@
 # Function takes the stationDict entry for the station in question
 # along with datetime formatted dates and returns a datatable with columns (date, data)
 
-import requests
 import pandas as pd
-from io import StringIO
 import numpy as np
+from resources.modules.DataTab import httpEngine, sessionArtifacts, textParsers
+
+# Parsing the CPC text files takes longer than downloading them, so this dataloader runs on the download process pool
+EXECUTOR = 'process'
+
+# The source files always hold the whole record, so every download gets the whole period of record
+INCREMENTAL = False
 
 
 def dataLoader(stationDict, startDate, endDate):
@@ -25,132 +30,101 @@ def dataLoader(stationDict, startDate, endDate):
     DatasetExternalID: nino3.4
     """
 
-    # Figure out which indice we are downloading
-    stationNum = stationDict['DatasetExternalID']
-
-    # Grab the ENSO Nino3.4 data (SST and Anom)
-    if stationNum == 'nino3.4':
-
-        # We'll get as much weekly data as we can, then backfill with monthly data
-        # Here are the relevant URLs
-        urlMonth = 'http://www.cpc.ncep.noaa.gov/data/indices/sstoi.indices'
-        urlWeek = 'http://www.cpc.ncep.noaa.gov/data/indices/wksst8110.for'
-
-        # Get the data
-        dataMonth = requests.get(urlMonth)
-        dataWeek = requests.get(urlWeek)
-
-        # Process the monthly data
-        dataMonth = StringIO(dataMonth.content.decode('utf-8'))
-        dataMonth = dataMonth.readlines()
-        timestamps = []
-        anoms = []
-        for line in dataMonth[1:]:
-            values = line.split()
-            year = str(values[0])
-            month = '0'+str(values[1])
-            timestamps.append(pd.to_datetime(year + month[-2:] + '15', format='%Y%m%d'))
-            anoms.append(float(values[9]))
-
-        dfMonth = pd.DataFrame(np.array(anoms).T, index = timestamps, columns = ['Nino3.4 ANOM | Indice | degC'])
-
-        # Process the weekly data
-        dataWeek = StringIO(dataWeek.content.decode('utf-8'))
-        dataWeek = dataWeek.readlines()
-        timestamps = []
-        anoms = []
-        for line in dataWeek[4:]:
-            values = line.split('     ')
-            timestamps.append(pd.to_datetime(values[0]))
-            anoms.append(float(values[3][4:]))
-
-        dfWeek = pd.DataFrame(np.array(anoms).T, index = timestamps, columns = ['Nino3.4 ANOM | Indice | degC'])
-
-        # Merge the 2 datasets, keeping all the weekly data and cutting some monthly
-        dfMonth = dfMonth[dfMonth.index < dfWeek.index[0]]
-
-        dfCombined = pd.concat([dfMonth, dfWeek]).resample('D').mean()
-        dfCombined = dfCombined.fillna(method='ffill')
-        dfCombined = dfCombined[dfCombined.index >= startDate]
-
-        df = pd.DataFrame(index = pd.date_range(startDate, endDate))
-        df = pd.concat([df, dfCombined], axis = 1)
-        df = df[df.index >= startDate]
-        df = df[df.index <= endDate]
-        
-        # Return the correct dataset
-        return df
-
-    # Otherwise, we'll grab the PNA dataset
-    elif stationNum == 'pna':
-        url = "http://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.pna.monthly.b5001.current.ascii"
-        dataMonth = pd.read_csv(url, names = ['year','month','PNA | Indice'], sep='\s+')
-        dataMonth['day'] = len(dataMonth.index)*[1]
-        datetimes = pd.to_datetime(dataMonth[['year','month','day']])
-        dataMonth.set_index(pd.DatetimeIndex(datetimes), inplace=True)
-        del dataMonth['year'], dataMonth['month'], dataMonth['day']
-        dataMonth = dataMonth.resample('D').mean()
-        dataMonth = dataMonth.fillna(method='ffill')
-        dataMonth = dataMonth[dataMonth.index >= startDate]
-        df = pd.DataFrame(index = pd.date_range(startDate, endDate))
-        df = pd.concat([df, dataMonth], axis = 1)
-        return df
-
-    elif stationNum == 'amo':
-        """
-        AMO Index"""
-        url = 'https://www.esrl.noaa.gov/psd/data/correlation/amon.us.long.data'
-        df = pd.read_csv(url, skiprows=1, names=['year','1','2','3','4','5','6','7','8','9','10','11','12'], sep='\s+')
-        lastRow = df.index[df['year']=='AMO'].tolist()[0] -1
-        df = df[df.index<lastRow]
-        df = df.melt(id_vars=['year'],var_name='month')
-        dates = [str(df['year'][i])+'-'+str(df['month'][i]) for i in df.index]
-        df.set_index(pd.DatetimeIndex(pd.to_datetime(dates, format='%Y/%m')), inplace=True)
-        df.sort_index(inplace=True)
-        df['value'] = pd.to_numeric(df['value'])
-        df.replace(to_replace=-99.990, value=np.nan, inplace=True)
-        df = pd.DataFrame(df['value'])
-        df = df.asfreq('D')
-        df.fillna(method='ffill',inplace=True)
-        df = df[df.index>=startDate]
-        df = df[df.index<=endDate]
-
-        return df
-
-
-    # elif stationNum == 5:
-    #     """
-    #     Mauna Loa CO2 Trend
-    #     """
-    #     url = 'ftp://aftp.cmdl.noaa.gov/products/trends/co2/co2_mm_mlo.txt'
-    #     df = pd.read_csv(url, index_col=False, sep='\s+', comment='#', names=['year','month','time','average_molFrac','interpolated_molFrac','trend','days'])
-    #     dates = [str(df['year'][i])+'-'+str(df['month'][i]) for i in df.index]
-    #     df.set_index(pd.DatetimeIndex(pd.to_datetime(dates, format='%Y/%m')), inplace=True)
-    #     df = pd.DataFrame(df['trend'])
-    #     df = df.asfreq('D')
-    #     df.fillna(method='ffill',inplace=True)
-    #     df = df[df.index>=startDate]
-    #     df = df[df.index<=endDate]
-    #     return df
-
-    elif stationNum == 'pdo':
-        """
-        Pacific Multidecadal Oscillation (PDO)
-        """
-        url = "https://www.ncdc.noaa.gov/teleconnections/pdo/data.json"
-        response = requests.get(url)
-        response = response.json()
-        data = response['data']
-        dates = [pd.to_datetime(i, format='%Y%m') for i in list(data.keys())]
-        values = [float(val) for val in list(data.values())]
-        values = [np.nan if x == -99.99 else x for x in values]
-        df = pd.DataFrame(values, index=dates, columns=['PDO'])
-        df = df.asfreq('D')
-        df.fillna(method='ffill', inplace=True)
-        df = df[df.index>=startDate]
-        df = df[df.index<=endDate]
-        return df
-
-    else:
+    return sessionArtifacts.trimRecord(indiceRecord(stationDict), startDate, endDate)
+
+
+def batchDataLoader(datasets, startDates, endDate):
+    """
+    Loads every CPC dataset in the download. Each source file is only downloaded and parsed once.
+    """
+    return sessionArtifacts.loadFromArtifacts(datasets, startDates, endDate, indiceRecord)
+
+
+def indiceRecord(dataset):
+    """
+    Returns the whole record of a dataset's indice. Each indice is downloaded and parsed once per 
+    download session, and shared by every dataset that uses it.
+    """
+    stationNum = dataset['DatasetExternalID']
+    if stationNum not in INDICES:
         return pd.DataFrame()
-        
\ No newline at end of file
+
+    return sessionArtifacts.getArtifact('CPC ' + stationNum, INDICES[stationNum])
+
+
+def loadNino34():
+    """
+    Nino 3.4 anomaly. We'll get as much weekly data as we can, then backfill with monthly data.
+    """
+
+    # Here are the relevant URLs
+    urlMonth = 'http://www.cpc.ncep.noaa.gov/data/indices/sstoi.indices'
+    urlWeek = 'http://www.cpc.ncep.noaa.gov/data/indices/wksst8110.for'
+
+    # Get the data
+    dataMonth = httpEngine.run(httpEngine.get(urlMonth, agency = 'CPC'))
+    dataWeek = httpEngine.run(httpEngine.get(urlWeek, agency = 'CPC'))
+
+    # Process the monthly and weekly data
+    dfMonth = textParsers.parseNinoMonthly(dataMonth.content.decode('utf-8'))
+    dfWeek = textParsers.parseNinoWeekly(dataWeek.content.decode('utf-8'))
+
+    # Merge the 2 datasets, keeping all the weekly data and cutting some monthly
+    dfMonth = dfMonth[dfMonth.index < dfWeek.index[0]]
+    dfCombined = textParsers.toDaily(pd.concat([dfMonth, dfWeek]))
+
+    return dfCombined.to_frame('Nino3.4 ANOM | Indice | degC')
+
+
+def loadPNA():
+    """
+    Pacific North American Index
+    """
+    url = "http://www.cpc.ncep.noaa.gov/products/precip/CWlink/pna/norm.pna.monthly.b5001.current.ascii"
+    dataMonth = textParsers.parseYearMonthValue(httpEngine.run(httpEngine.get(url, agency = 'CPC')).text)
+
+    return textParsers.toDaily(dataMonth).to_frame('PNA | Indice')
+
+
+def loadAMO():
+    """
+    AMO Index
+    """
+    url = 'https://www.esrl.noaa.gov/psd/data/correlation/amon.us.long.data'
+    df = textParsers.parseYearByMonthTable(httpEngine.run(httpEngine.get(url, agency = 'NOAA PSL')).text)
+
+    return textParsers.toDaily(df).to_frame('value')
+
+
+# def loadCO2():
+#     """
+#     Mauna Loa CO2 Trend
+#     """
+#     url = 'ftp://aftp.cmdl.noaa.gov/products/trends/co2/co2_mm_mlo.txt'
+#     df = pd.read_csv(url, index_col=False, sep='\s+', comment='#', names=['year','month','time','average_molFrac','interpolated_molFrac','trend','days'])
+#     dates = textParsers.monthlyDates(df['year'].values, df['month'].values)
+#     df = pd.Series(df['trend'].values, index=pd.DatetimeIndex(dates))
+#     return textParsers.toDaily(df).to_frame('trend')
+
+
+def loadPDO():
+    """
+    Pacific Multidecadal Oscillation (PDO)
+    """
+    url = "https://www.ncdc.noaa.gov/teleconnections/pdo/data.json"
+    response = httpEngine.run(httpEngine.get(url, agency = 'NCEI'))
+    data = response.json()['data']
+    dates = pd.to_datetime(list(data.keys()), format='%Y%m')
+    values = np.array(list(data.values()), dtype=float)
+    values[values == textParsers.MISSING_VALUE] = np.nan
+    df = pd.Series(values, index=dates)
+
+    return textParsers.toDaily(df).to_frame('PDO')
+
+
+# The function that loads each indice
+INDICES = {
+    'nino3.4':  loadNino34,
+    'pna':      loadPNA,
+    'amo':      loadAMO,
+    'pdo':      loadPDO}
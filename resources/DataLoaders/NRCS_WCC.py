@@ -1,132 +1,288 @@
 # Script Name:      NRCS_WCC.py
 # Script Author:    Kevin Foley, Civil Engineer
 # Description:      A Dataloader for SNOTEL and Snowcourse data in xml/soap format.
-#                   Uses the SOAP protocol.
+#                   Uses the SOAP protocol. All of the NRCS datasets in a download are
+#                   requested together: one getData call per element / duration / depth
+#                   for every station that shares it.
 
 # Function takes the stationDict entry for the station in question
 # along with datetime formatted dates and returns a datatable with columns (date, data, flag)
 
 # Import libraries
+import json
+import os
+import threading
+import numpy as np
 import pandas as pd
-import requests
 from datetime import datetime
 from zeep import Client
-from decimal import Decimal
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
+from resources.modules.DataTab import httpEngine
+
+# The AWDB web service
+WSDL_URL = 'http://www.wcc.nrcs.usda.gov/awdbWebService/services?WSDL'
+
+# The WSDL and its schemas are cached on disk, so creating the client doesn't need the network
+WSDL_CACHE_FILE = 'resources/temp/nrcsWSDL.db'
+WSDL_CACHE_SECONDS = 30*24*3600
+
+# Station ID -> station triplets (e.g. '304' -> ['304:OR:SNTL']) and soil moisture depths, kept between sessions
+LOOKUP_TABLE_FILE = 'resources/temp/nrcsStations.json'
+
+# The HTTP engine agency that the SOAP requests count towards
+AGENCY = 'NRCS'
+
+# Most stations that are sent in one getData request
+MAX_STATIONS_PER_REQUEST = 50
+
+# Network code for each DatasetType
+NETWORKS = {'SNOTEL': 'SNTL', 'SNOWCOURSE': 'SNOW', 'SCAN': 'SCAN'}
+
+clientLock = threading.Lock()
+client = None
+lookupLock = threading.Lock()
+lookupTable = None
+
 
 def dataLoader(stationDict, startDate, endDate):
     """
-    This dataloader loads data from the NRCS's AWDB database. This database contains 
-    snow, precipitation, and soil moisture data for SNOTEL, SNOWCOURSE, and SCAN stations 
+    This dataloader loads data from the NRCS's AWDB database. This database contains
+    snow, precipitation, and soil moisture data for SNOTEL, SNOWCOURSE, and SCAN stations
     maintained by the NRCS. The "DatasetType" option specifies which of these three networks
     your station belongs to. The Dataset Parameter (e.g. Snow Water Equivalent) and Dataset ID
     (e.g. 304) options must be specified. Valid options for Parameter are:
-    "Snow Water Equivalent", 
+    "Snow Water Equivalent",
     "Precipitation",
     "Soil Moisture"
     DEFAULT OPTIONS
     DatasetType: SNOTEL
     """
- 
-    # Set up the soap service
-    NRCS = Client('http://www.wcc.nrcs.usda.gov/awdbWebService/services?WSDL')
-
-    # Get the station triplet
-    triplet = NRCS.service.getStations(
-        stationIds = stationDict['DatasetExternalID'],
-        networkCds = ["SNTL","SNOW","SCAN"],
-        logicalAnd = True
-    )
-    # Set the station parameters to download the data
+
+    # Download the single dataset as a batch of one
+    datasets = pd.DataFrame([stationDict])
+    frames = batchDataLoader(datasets, pd.Series(startDate, index = datasets.index), endDate)
+
+    return frames.get(datasets.index[0], pd.DataFrame())
+
+
+def batchDataLoader(datasets, startDates, endDate):
+    """
+    Downloads every NRCS dataset in the download at once. Datasets are grouped by element, duration
+    (and soil depth), and each group is requested with one getData call (per MAX_STATIONS_PER_REQUEST
+    stations), starting on the group's earliest start date.
+
+    Input:
+        datasets -> the datasets' rows in the datasetTable
+        startDates -> pd.Series of start dates indexed by DatasetInternalID
+        endDate -> the last date to download
+
+    Output:
+        frames -> dict of DatasetInternalID -> single column dataframe
+    """
+    NRCS = getClient()
+
+    # Look up the station triplets (only stations we haven't seen before go to the web service)
+    triplets = lookupTriplets(NRCS, datasets)
+
+    # Figure out what to request for each dataset: (element, duration, depth) -> [(datasetID, triplet, columnName)]
+    groups = {}
+    for datasetID, dataset in datasets.iterrows():
+        element = elementOf(dataset)
+        triplet = triplets.get(datasetID)
+        if element is None or triplet is None:
+            continue
+        elementCd, duration, unit = element
+
+        # Soil moisture stations report at several depths. We use the shallowest one.
+        depth = None
+        columnName = 'SNOTEL | ' + str(dataset['DatasetName']) + ' | ' + dataset['DatasetParameter'] + ' | ' + unit
+        if elementCd == 'SMS':
+            depths = soilDepths(NRCS, triplet)
+            if depths == []:
+                continue
+            depth = depths[0]
+            columnName = 'SNOTEL | ' + str(dataset['DatasetName']) + ' | ' + dataset['DatasetParameter'] + ' | ' + str(depth) + ' in. | ' + unit
+
+        groups.setdefault((elementCd, duration, depth), []).append((datasetID, triplet, columnName))
+
+    # Request each group's stations together and split the results back into datasets
+    frames = {}
+    for (elementCd, duration, depth), members in groups.items():
+        groupStartDate = min(startDates[datasetID] for datasetID, _, _ in members)
+        uniqueTriplets = list(dict.fromkeys(triplet for _, triplet, _ in members))
+
+        for i in range(0, len(uniqueTriplets), MAX_STATIONS_PER_REQUEST):
+            request = dict(
+                stationTriplets = uniqueTriplets[i:i + MAX_STATIONS_PER_REQUEST],
+                elementCd = elementCd,
+                ordinal = "1",
+                getFlags = 'true',
+                duration = duration,
+                beginDate = datetime.strftime(groupStartDate, '%Y-%m-%d'),
+                endDate = datetime.strftime(endDate, '%Y-%m-%d'),
+                alwaysReturnDailyFeb29 = 'false')
+            if depth is not None:
+                request['heightDepth'] = {"value": str(depth), "unitCd": 'in'}
+            data = NRCS.service.getData(**request)
+
+            # Each returned record belongs to one station triplet
+            seriesByTriplet = {record['stationTriplet']: recordToSeries(record, duration) for record in (data or [])}
+            for datasetID, triplet, columnName in members:
+                if triplet not in seriesByTriplet:
+                    continue
+                series = seriesByTriplet[triplet]
+                series = series[(series.index >= startDates[datasetID]) & (series.index <= endDate)]
+                frames[datasetID] = series.to_frame(columnName).round(3)
+
+    return frames
+
+
+class EngineTransport(Transport):
+    """
+    A zeep Transport that sends the SOAP requests (and the WSDL downloads) through the HTTP engine, so
+    they go through the NRCS concurrency and rate limits, are retried, count towards the download job's
+    RequestStats and stop when the job is cancelled, like every other request.
+    """
+
+    def get(self, address, params, headers):
+        return httpEngine.run(httpEngine.get(address, agency = AGENCY, params = params, headers = headers, timeout = self.operation_timeout))
+
+    def post(self, address, message, headers):
+        return httpEngine.run(httpEngine.post(address, agency = AGENCY, data = message, headers = headers, timeout = self.operation_timeout))
+
+    def _load_remote_data(self, url):
+        response = httpEngine.run(httpEngine.get(url, agency = AGENCY, timeout = self.load_timeout))
+        response.raise_for_status()
+        return response.content
+
+
+def getClient():
+    """
+    Returns the SOAP client. It's built once, using the HTTP engine and the on-disk WSDL cache.
+    """
+    global client
+    with clientLock:
+        if client is None:
+            os.makedirs(os.path.dirname(WSDL_CACHE_FILE), exist_ok = True)
+            transport = EngineTransport(
+                cache = SqliteCache(path = WSDL_CACHE_FILE, timeout = WSDL_CACHE_SECONDS),
+                timeout = httpEngine.REQUEST_TIMEOUT,
+                operation_timeout = httpEngine.REQUEST_TIMEOUT)
+            client = Client(WSDL_URL, transport = transport)
+        return client
+
+
+def elementOf(stationDict):
+    """
+    Returns the (elementCd, duration, unit) for a dataset, or None if the parameter isn't supported
+    """
     if stationDict['DatasetParameter'] == 'Snow Water Equivalent':
-        soilFlag = False
-        param_db_name = 'WTEQ'
-        param_unit = 'inches'
-        if stationDict['DatasetType'] == 'SNOTEL':
-            duration = 'DAILY'
-        elif stationDict['DatasetType'] == 'SNOWCOURSE':
-            duration = 'SEMIMONTHLY'
-        else:
-            pass
+        if stationDict['DatasetType'] == 'SNOWCOURSE':
+            return 'WTEQ', 'SEMIMONTHLY', 'inches'
+        return 'WTEQ', 'DAILY', 'inches'
 
     elif stationDict['DatasetParameter'] == 'Precipitation':
-        soilFlag = False
-        param_db_name = 'PRCP'
-        param_unit = 'inches'
-        duration = 'DAILY'
+        return 'PRCP', 'DAILY', 'inches'
 
-    
     elif stationDict['DatasetParameter'] == 'Soil Moisture':
-        soilFlag = True
-        param_db_name = 'SMS'
-        param_unit = 'pct'
-
-    # If the parameter is a soil moisture, we need to get all the depths
-        elements = NRCS.service.getStationElements(
-            stationTriplet = triplet[0]
-        )
-        soil_depths = []
-        for e in elements:
-            if e['elementCd'] == 'SMS':
-                soil_depths.append(float(e['heightDepth']['value']))
-        soil_depths = list(set(soil_depths))
+        return 'SMS', 'DAILY', 'pct'
 
+    return None
+
+
+def loadLookupTable():
+    """
+    Returns the station lookup table, reading it from disk the first time
+    """
+    global lookupTable
+    if lookupTable is None:
+        try:
+            with open(LOOKUP_TABLE_FILE, 'r') as readFile:
+                lookupTable = json.load(readFile)
+        except (OSError, ValueError):
+            lookupTable = {}
+        lookupTable.setdefault('triplets', {})
+        lookupTable.setdefault('soilDepths', {})
+    return lookupTable
+
+
+def saveLookupTable():
+    """
+    Writes the station lookup table to disk
+    """
+    os.makedirs(os.path.dirname(LOOKUP_TABLE_FILE), exist_ok = True)
+    temporaryPath = LOOKUP_TABLE_FILE + '.tmp'
+    with open(temporaryPath, 'w') as writeFile:
+        json.dump(lookupTable, writeFile, indent = 1)
+    os.replace(temporaryPath, LOOKUP_TABLE_FILE)
+
+    return
+
+
+def lookupTriplets(NRCS, datasets):
+    """
+    Returns the station triplet for each dataset. Stations that aren't in the lookup table are looked
+    up with a single getStations call.
+
+    Output:
+        triplets -> dict of DatasetInternalID -> station triplet (datasets without a triplet are left out)
+    """
+    with lookupLock:
+        table = loadLookupTable()['triplets']
+        stationIDs = [str(stationID) for stationID in datasets['DatasetExternalID']]
+        missing = sorted(set(stationID for stationID in stationIDs if stationID not in table))
+
+        if missing != []:
+            found = NRCS.service.getStations(
+                stationIds = missing,
+                networkCds = list(NETWORKS.values()),
+                logicalAnd = True) or []
+            for triplet in found:
+                table.setdefault(triplet.split(':')[0], [])
+                if triplet not in table[triplet.split(':')[0]]:
+                    table[triplet.split(':')[0]].append(triplet)
+            saveLookupTable()
+
+    # Pick the triplet in the dataset's network (a station ID can be used in more than one network)
+    triplets = {}
+    for (datasetID, dataset), stationID in zip(datasets.iterrows(), stationIDs):
+        candidates = table.get(stationID, [])
+        if candidates == []:
+            continue
+        network = NETWORKS.get(dataset['DatasetType'])
+        triplets[datasetID] = next((triplet for triplet in candidates if triplet.split(':')[-1] == network), candidates[0])
+
+    return triplets
+
+
+def soilDepths(NRCS, triplet):
+    """
+    Returns the soil moisture sensor depths at a station, shallowest first (from the lookup table if we've seen the station before)
+    """
+    with lookupLock:
+        table = loadLookupTable()['soilDepths']
+        if triplet not in table:
+            elements = NRCS.service.getStationElements(stationTriplet = triplet)
+            table[triplet] = sorted(set(float(e['heightDepth']['value']) for e in elements if e['elementCd'] == 'SMS'), key = abs)
+            saveLookupTable()
+        return table[triplet]
+
+
+def recordToSeries(record, duration):
+    """
+    Converts one station's getData record into a pandas Series
+    """
+    values = np.array([np.nan if value is None else float(value) for value in (record['values'] or [])], dtype=float)
+
+    # Snowcourse data comes with the dates it was collected on, daily data with a start and end date
+    if duration == 'SEMIMONTHLY':
+        index = pd.to_datetime(record['collectionDates'])
+        series = pd.Series(values, index = index)
+        series = series[~series.index.duplicated(keep='last')]
+    elif record['beginDate'] is None or record['endDate'] is None:
+        return pd.Series([], index = pd.DatetimeIndex([]), dtype = float)
     else:
-        soilFlag = False
-        return 
-
-    # Create a dataframe to store the data
-    df = pd.DataFrame(index = pd.date_range(startDate, endDate)) # Create a dataframe to store values
-    
-    # Get all the data for SOIL stations and return in a dataframe
-    if soilFlag:
-        depth = str(soil_depths[0])
-        data = NRCS.service.getData(
-            stationTriplets = triplet[0],
-            elementCd = param_db_name,
-            ordinal = "1",
-            heightDepth = {
-                "value" : str(depth),
-                "unitCd" : 'in'
-            },
-            getFlags = 'true',
-            duration = 'DAILY',
-            beginDate = datetime.strftime(startDate, '%Y-%m-%d'),
-            endDate = datetime.strftime(endDate, '%Y-%m-%d'),
-            alwaysReturnDailyFeb29 = 'false')
-        actualStartDate = data[0]['beginDate']
-        actualEndDate = data[0]['endDate']
-        df2 = pd.DataFrame(index = pd.date_range(actualStartDate,actualEndDate))
-        df2['SNOTEL | ' + stationDict['DatasetName'] + ' | ' + stationDict['DatasetParameter'] + ' | ' + str(depth) + ' in. | ' + param_unit] = [pd.to_numeric(value, errors='coerce') for value in data[0]['values']]
-        df2 = df2[~df2.index.duplicated(keep='first')] # Remove duplicates from the dataset
-        df2 = df2[~df2.index.isnull()]
-        df = pd.concat([df, df2], axis = 1)
-        return df.round(3)
-
-    # Get all the data for SWE and PRECIP staitons and store in a dataframe
-    else:
-        data = NRCS.service.getData(
-            stationTriplets = triplet[0],
-            elementCd = param_db_name,
-            ordinal = "1",
-            getFlags = 'true',
-            duration = duration,
-            beginDate = datetime.strftime(startDate, '%Y-%m-%d'),
-            endDate = datetime.strftime(endDate, '%Y-%m-%d'),
-            alwaysReturnDailyFeb29 = 'false')
-        
-        if stationDict['DatasetType'] == 'SNOWCOURSE':
-            df2 = pd.DataFrame(index=pd.to_datetime(data[0]['collectionDates']))
-        else:
-            actualStartDate = data[0]['beginDate']
-            actualEndDate = data[0]['endDate']
-            if actualStartDate != None or actualEndDate != None:
-                df2 = pd.DataFrame(index = pd.date_range(actualStartDate,actualEndDate))
-            else:
-                df2 = pd.DataFrame()
-        values = [pd.to_numeric(value, errors='coerce') for value in data[0]['values']]
-        df2['SNOTEL | ' + stationDict['DatasetName'] + ' | ' + stationDict['DatasetParameter'] + ' | ' + param_unit] = values
-        df2 = df2[~df2.index.duplicated(keep='last')] # Remove duplicates from the dataset
-        df2 = df2[~df2.index.isnull()]
-        df = pd.concat([df, df2], axis = 1)
-
-        return df.round(3)
+        series = pd.Series(values, index = pd.date_range(pd.to_datetime(record['beginDate']).normalize(), periods = len(values)))
+
+    return series[~series.index.isnull()]
@@ -1,8 +1,12 @@
 import pandas as pd
-import numpy as np
-import requests
-from datetime import datetime
 from html.parser import HTMLParser
+from resources.modules.DataTab import httpEngine, sessionArtifacts, textParsers
+
+# Parsing the climate division file takes longer than downloading it, so this dataloader runs on the download process pool
+EXECUTOR = 'process'
+
+# The source files always hold the whole record, so every download gets the whole period of record
+INCREMENTAL = False
 
 """
 This dataloader loads Palmer Drought Severity Index data from the CPC.
@@ -22,38 +26,46 @@ def dataLoader(stationDict, startDate, endDate):
     DEFAULT OPTIONS
     """
 
-    # Get the info
-    stationID = stationDict['DatasetExternalID']
+    return sessionArtifacts.trimRecord(divisionRecord(stationDict), startDate, endDate)
+
+
+def batchDataLoader(datasets, startDates, endDate):
+    """
+    Loads every PDSI dataset in the download from a single download of the climate division file
+    """
+    return sessionArtifacts.loadFromArtifacts(datasets, startDates, endDate, divisionRecord)
+
+
+def divisionRecord(dataset):
+    """
+    Returns the whole record of a dataset's climate division. The national climate division file is
+    downloaded and split into divisions once per download session.
+    """
+    divisions = sessionArtifacts.getArtifact('PDSI divisions', loadDivisions)
+    if dataset['DatasetExternalID'] not in divisions:
+        return pd.DataFrame()
+
+    return divisions[dataset['DatasetExternalID']].to_frame('value')
+
+
+def loadDivisions():
+    """
+    Downloads the national climate division PDSI file and splits it up by division
+
+    Output:
+        divisions -> dict of division ID -> daily series
+    """
 
     # Find the correct link
     url = 'https://www1.ncdc.noaa.gov/pub/data/cirs/climdiv'
-    response = requests.get(url)
+    response = httpEngine.run(httpEngine.get(url, agency = 'NCEI'))
     parser = MyHTMLParser()
     parser.feed(response.text)
 
     # Get the data
     url = 'https://www1.ncdc.noaa.gov/pub/data/cirs/climdiv/{0}'.format(parser.link_extension)
 
-    df = pd.read_csv(url)
-
-    df = pd.read_csv(url, names=['code','1','2','3','4','5','6','7','8','9','10','11','12'], index_col=False, sep='\s+')
-    df['code'] = df['code'].astype(str)
-    li = [df['code'][i][:-6] for i in df.index]
-    yr = [int(df['code'][i][-4:]) for i in df.index]
-    df['divID'] = li
-    df['year'] = yr
-    df = df[df['divID'] == stationID]
-    del df['code']
-    df = df.melt(id_vars=['divID','year'], var_name=['month'])
-    dateList = [pd.to_datetime(str(df['year'][i]) + '-' + str(df['month'][i]), format='%Y-%m') for i in df.index]
-    df.set_index(pd.DatetimeIndex(dateList), inplace=True)
-    df = df[df.index >= startDate]
-    df = df[df.index <= endDate]
-    df.replace(to_replace=-99.99, value=np.nan, inplace=True)
-    del df['divID'], df['year'], df['month']
-    df.sort_index(inplace=True)
-    df = df.asfreq('D')
-    df.fillna(method='ffill',inplace=True)
-
-    return df
+    response = httpEngine.run(httpEngine.get(url, agency = 'NCEI'))
 
+    # Parse every division, and fill each one's monthly values forward to daily
+    return {divID: textParsers.toDaily(division) for divID, division in textParsers.parseClimateDivisions(response.text).items()}
@@ -1,93 +1,315 @@
 # Script Name:      PRISM_NRCC_RCC_ACIS.py
 # Script Author:    Kevin Foley, Civil Engineer
-# Description:      A Dataloader for PRISM and NRCC Gridded datasets.
+# Description:      A Dataloader for PRISM and NRCC Gridded datasets. All of the gridded
+#                   datasets in a download are requested together: basins that are near each
+#                   other share a GridData call, which returns both temperature and precipitation.
 
 # Function takes the stationDict entry for the station in question
 # along with datetime formatted dates and returns a datatable with columns (date, data)
 
 # Import libraries
+import asyncio
+import json
+import os
+import threading
 import pandas as pd
 import numpy as np
-import requests
 from datetime import datetime
-from PyQt5.QtWidgets import QMessageBox
+from resources.modules.DataTab import httpEngine
 
-def dataLoader(stationDict, startDate, endDate):
+BASIN_URL = "http://data.rcc-acis.org/General/basin"
+GRID_DATA_URL = "http://data.rcc-acis.org/GridData"
+
+# HUC -> bounding box [west, south, east, north], kept between sessions. Bounding boxes never change.
+BBOX_TABLE_FILE = 'resources/temp/hucBoundingBoxes.json'
+
+# The watersheds that the table is pre-populated with
+ADDITIONAL_DATASETS_FILE = 'resources/GIS/AdditionalDatasets.xlsx'
+
+# Most basins in one General/basin lookup and in one GridData request
+MAX_BASINS_PER_LOOKUP = 100
+MAX_BASINS_PER_REQUEST = 25
+
+# Largest combined bounding box (square degrees) and period (days) of one GridData request. Basins that
+# don't fit in one box go in another request, and longer periods are split up.
+MAX_BBOX_AREA = 16.0
+MAX_REQUEST_DAYS = 3653
+
+# ACIS grid number, element name and unit for each agency / parameter
+GRIDS = {'NRCC': '1', 'PRISM': '21'}
+ELEMENTS = {'Precipitation': ('pcpn', 'inches'), 'Temperature': ('avgt', 'degF')}
+
+# PRISM data starts in 1981
+PRISM_START_DATE = pd.to_datetime('1981-01-01')
+
+bboxFileLock = threading.Lock()
+bboxTable = None
+
+
+async def dataLoader(stationDict, startDate, endDate):
     """
     This dataloader loads watershed averaged data for PRISM and NRCC temperature
     and precipitation datasets. The required parameters are "Dataset ID",
-    "Dataset Parameter", and "Dataset Agency". The "Dataset ID" must be a 
+    "Dataset Parameter", and "Dataset Agency". The "Dataset ID" must be a
     valid 8-digit hydrologic unic code. "Dataset Parameter" must either be "Temperature"
     or "Precipitation". "Dataset Agency" must be either "NRCC" or "PRISM".
     DEFAULT OPTIONS
     """
 
-    # Get the stationID ( the HUC )
-    stationID = stationDict['DatasetExternalID']
+    # Download the single dataset as a batch of one
+    datasets = pd.DataFrame([stationDict])
+    frames = await batchDataLoader(datasets, pd.Series(startDate, index = datasets.index), endDate)
 
-    # Get the parameter Code
-    pcode = stationDict['DatasetParameter']
+    return frames.get(datasets.index[0], pd.DataFrame())
 
-    # Get the grid type
-    grid = stationDict['DatasetAgency']
 
-    # First, we need to get the Bounding Box associated with the HUC
+async def batchDataLoader(datasets, startDates, endDate):
+    """
+    Downloads every PRISM / NRCC dataset in the download at once. Datasets are grouped by grid, start
+    date and 2-digit HUC region, and the basins in each group are split into chunks of neighbouring basins
+    (up to MAX_BASINS_PER_REQUEST basins in at most MAX_BBOX_AREA square degrees). Each chunk is downloaded
+    with GridData calls over its combined bounding box (one per MAX_REQUEST_DAYS), for every element the
+    chunk needs. If a chunk's request fails, its basins are requested one at a time.
 
-    # Generate the POST request
-    baseUrl = "http://data.rcc-acis.org/General/basin"
+    Input:
+        datasets -> the datasets' rows in the datasetTable
+        startDates -> pd.Series of start dates indexed by DatasetInternalID
+        endDate -> the last date to download
 
-    # Set the parameters
-    params = {
-        "id":str(stationID),
-        "meta":"id,bbox"
-    }
+    Output:
+        frames -> dict of DatasetInternalID -> single column dataframe
+    """
+
+    # Get the bounding boxes for the basins
+    bboxes = await boundingBoxes(set(str(huc) for huc in datasets['DatasetExternalID']))
+
+    # Work out each dataset's grid, element and (clipped) start date
+    requestTable = pd.DataFrame({
+        'huc':      [str(huc) for huc in datasets['DatasetExternalID']],
+        'grid':     [GRIDS['NRCC'] if agency == 'NRCC' else GRIDS['PRISM'] for agency in datasets['DatasetAgency']],
+        'element':  [ELEMENTS['Precipitation' if parameter == 'Precipitation' else 'Temperature'][0] for parameter in datasets['DatasetParameter']],
+        'start':    pd.to_datetime(startDates[datasets.index].values)}, index = datasets.index)
+    requestTable.loc[requestTable['grid'] == GRIDS['PRISM'], 'start'] = requestTable.loc[requestTable['grid'] == GRIDS['PRISM'], 'start'].clip(lower = PRISM_START_DATE)
+    requestTable = requestTable[requestTable['huc'].isin(list(bboxes.keys()))]
+    requestTable['region'] = requestTable['huc'].str[:2]
+
+    # Split the groups into requests
+    gridRequests = []
+    for (grid, start, region), group in requestTable.groupby(['grid', 'start', 'region'], sort = False):
+        for chunk in basinChunks(sorted(set(group['huc'])), bboxes):
+            elements = sorted(set(group.loc[group['huc'].isin(chunk), 'element']))
+            gridRequests.append((grid, start, chunk, elements))
+
+    # Make the requests
+    results = await asyncio.gather(*[downloadChunk(grid, start, endDate, hucs, bboxes, elements) for grid, start, hucs, elements in gridRequests])
+
+    # Split the data back out into datasets
+    frames = {}
+    for (grid, start, hucs, elements), result in zip(gridRequests, results):
+        if result is None:
+            continue
+        selected = requestTable[(requestTable['grid'] == grid) & (requestTable['start'] == start) & requestTable['huc'].isin(hucs)]
+        for datasetID, row in selected.iterrows():
+            if row['huc'] not in result[row['element']].columns:
+                continue
+            dataset = datasets.loc[datasetID]
+            unit = ELEMENTS['Precipitation' if dataset['DatasetParameter'] == 'Precipitation' else 'Temperature'][1]
+            frames[datasetID] = result[row['element']][[row['huc']]].rename(columns = {row['huc']: dataset['DatasetAgency'] + ' | ' + row['huc'] + ' | ' + dataset['DatasetParameter'] + ' | ' + unit})
+
+    return frames
+
+
+def combinedBBox(bboxes):
+    """
+    Returns the bounding box [west, south, east, north] around a list of bounding boxes
+    """
+    bboxes = np.array(bboxes, dtype=float)
+
+    return [bboxes[:, 0].min(), bboxes[:, 1].min(), bboxes[:, 2].max(), bboxes[:, 3].max()]
+
+
+def basinChunks(hucs, bboxes):
+    """
+    Splits basins into chunks of neighbouring basins (west to east) of up to MAX_BASINS_PER_REQUEST basins,
+    whose combined bounding box is no bigger than MAX_BBOX_AREA square degrees
+    """
+    chunks = []
+    for huc in sorted(hucs, key = lambda huc: (bboxes[huc][0], bboxes[huc][1])):
+        if chunks != [] and len(chunks[-1]) < MAX_BASINS_PER_REQUEST:
+            west, south, east, north = combinedBBox([bboxes[other] for other in chunks[-1]] + [bboxes[huc]])
+            if (east - west)*(north - south) <= MAX_BBOX_AREA:
+                chunks[-1].append(huc)
+                continue
+        chunks.append([huc])
+
+    return chunks
+
+
+async def downloadChunk(grid, startDate, endDate, hucs, bboxes, elements):
+    """
+    Downloads a chunk of basins together. If that fails, each basin is requested on its own
+    (over its own bounding box), so one bad response doesn't lose every basin in the chunk.
+
+    Output:
+        data -> dict of element -> dataframe (one column per HUC), or None if nothing could be downloaded
+    """
+    data = await downloadBasins(grid, startDate, endDate, [bboxes[huc] for huc in hucs], elements)
+    if data is not None or len(hucs) == 1:
+        return data
+
+    results = await asyncio.gather(*[downloadBasins(grid, startDate, endDate, [bboxes[huc]], elements) for huc in hucs])
+    basinData = [(huc, result) for huc, result in zip(hucs, results) if result is not None]
+    if basinData == []:
+        return None
+
+    # Put the basins back together (each basin's own column from its response)
+    data = {}
+    for element in elements:
+        columns = [result[element][[huc]] for huc, result in basinData if huc in result[element].columns]
+        data[element] = pd.concat(columns, axis = 1) if columns != [] else pd.DataFrame()
+
+    return data
+
+
+async def downloadBasins(grid, startDate, endDate, bboxes, elements):
+    """
+    Downloads the basin averages for every basin in the combined bounding box, for each element. Periods
+    longer than MAX_REQUEST_DAYS are requested in parts.
+
+    Output:
+        data -> dict of element -> dataframe (one column per HUC), or None if a request failed
+    """
+    bbox = combinedBBox(bboxes)
+    periods = []
+    while startDate <= endDate:
+        periods.append((startDate, min(endDate, startDate + pd.Timedelta(days = MAX_REQUEST_DAYS - 1))))
+        startDate = periods[-1][1] + pd.Timedelta(days = 1)
+
+    results = await asyncio.gather(*[downloadBBox(grid, periodStart, periodEnd, bbox, elements) for periodStart, periodEnd in periods])
+    if results == [] or any(result is None for result in results):
+        return None
+
+    return {element: pd.concat([result[element] for result in results]) for element in elements}
+
+
+async def downloadBBox(grid, startDate, endDate, bbox, elements):
+    """
+    Downloads the basin averages for every basin in a bounding box with one GridData call
 
-    # Get the BBOX:
-    hucBBOX = requests.post(baseUrl, params).json()
-    hucBBOX = hucBBOX['meta'][0]['bbox']
-    hucBBOX = [str(coord) for coord in hucBBOX]
-
-    # Construct the data web service call
-    baseUrl = "http://data.rcc-acis.org/GridData"
-    if grid == 'NRCC':
-        gridNum = '1'
-    else:
-        gridNum = '21'
-        if startDate < pd.to_datetime('1981-01-01'):
-            startDate = pd.to_datetime('1981-01-01')
-
-    if pcode == 'Precipitation':
-        name = 'pcpn'
-        unit = 'inches'
-    else:
-        name = 'avgt'
-        unit = 'degF'
+    Output:
+        data -> dict of element -> dataframe (one column per HUC), or None if the request failed
+    """
     params = {
-        "bbox":",".join(hucBBOX),
+        "bbox":",".join(str(coord) for coord in bbox),
         "sdate":datetime.strftime(startDate, '%Y%m%d'),
         "edate":datetime.strftime(endDate, "%Y%m%d"),
-        "grid":gridNum,
+        "grid":grid,
         "elems": [{
-            "name": name,
+            "name": element,
             "area_reduce":"basin_mean"
-        }]
+        } for element in elements]
     }
 
     # Get the data
-    data = requests.post(baseUrl, json=params)
-    if data.status_code != 200:
-        return pd.DataFrame()
-    data = data.json() 
-
-    dataPoints = []
-    for i,datapoint in enumerate(data['data']):
-        if datapoint[1] != {}:
-            dataPoints.append(datapoint[1][stationID])
-        else:
-            dataPoints.append(np.nan)
-
-    # Parse into dataframe
-    df = pd.DataFrame(pd.to_numeric(dataPoints), columns=[grid + ' | ' + stationID + ' | ' + pcode + ' | ' + unit], index=pd.date_range(startDate, endDate))
-
-    # Return the data
-    return df
\ No newline at end of file
+    response = await httpEngine.post(GRID_DATA_URL, agency = 'ACIS', json = params)
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    if 'data' not in data:
+        return None
+
+    return parseGridData(data['data'], elements)
+
+
+def parseGridData(rows, elements):
+    """
+    Converts GridData's [date, {huc: value, ...}, {huc: value, ...}, ...] rows into a dataframe per
+    element. Days without data for a basin are NaN.
+    """
+    index = pd.DatetimeIndex(pd.to_datetime([row[0] for row in rows]))
+    frames = {}
+    for i, element in enumerate(elements):
+        df = pd.DataFrame.from_records([row[i + 1] if isinstance(row[i + 1], dict) else {} for row in rows], index = index)
+        frames[element] = df.apply(pd.to_numeric, errors = 'coerce')
+
+    return frames
+
+
+async def boundingBoxes(hucs):
+    """
+    Returns the bounding boxes for a set of HUCs from the bounding box table. HUCs that aren't in the table
+    are looked up with General/basin (along with every watershed in AdditionalDatasets.xlsx, the first time)
+    and added to the table.
+
+    Output:
+        bboxes -> dict of HUC -> [west, south, east, north] (HUCs that ACIS doesn't know are left out)
+    """
+    table = await asyncio.get_running_loop().run_in_executor(None, loadBBoxTable)
+    missing = set(huc for huc in hucs if huc not in table)
+
+    if missing != set():
+        if table == {}:
+            missing |= await asyncio.get_running_loop().run_in_executor(None, additionalDatasetHUCs)
+        missing = sorted(missing)
+        results = await asyncio.gather(*[lookupBoundingBoxes(missing[i:i + MAX_BASINS_PER_LOOKUP]) for i in range(0, len(missing), MAX_BASINS_PER_LOOKUP)])
+        for result in results:
+            table.update(result)
+        await asyncio.get_running_loop().run_in_executor(None, saveBBoxTable, dict(table))
+
+    return {huc: table[huc] for huc in hucs if huc in table}
+
+
+async def lookupBoundingBoxes(hucs):
+    """
+    Looks up the bounding boxes for a list of HUCs with one General/basin call
+    """
+    params = {
+        "id":",".join(hucs),
+        "meta":"id,bbox"
+    }
+    response = await httpEngine.post(BASIN_URL, agency = 'ACIS', data = params)
+    if response.status_code != 200:
+        return {}
+
+    return {str(basin['id']): [float(coord) for coord in basin['bbox']] for basin in response.json().get('meta', []) if 'bbox' in basin}
+
+
+def additionalDatasetHUCs():
+    """
+    Returns the HUCs of the watershed datasets in AdditionalDatasets.xlsx
+    """
+    try:
+        additionalDatasets = pd.read_excel(ADDITIONAL_DATASETS_FILE, dtype={'DatasetExternalID':str}, usecols = ['DatasetType', 'DatasetExternalID'])
+    except Exception:
+        return set()
+
+    return set(additionalDatasets.loc[additionalDatasets['DatasetType'] == 'WATERSHED', 'DatasetExternalID'])
+
+
+def loadBBoxTable():
+    """
+    Returns the bounding box table, reading it from disk the first time
+    """
+    global bboxTable
+    with bboxFileLock:
+        if bboxTable is None:
+            try:
+                with open(BBOX_TABLE_FILE, 'r') as readFile:
+                    bboxTable = json.load(readFile)
+            except (OSError, ValueError):
+                bboxTable = {}
+        return bboxTable
+
+
+def saveBBoxTable(table):
+    """
+    Writes (a copy of) the bounding box table to disk
+    """
+    with bboxFileLock:
+        os.makedirs(os.path.dirname(BBOX_TABLE_FILE), exist_ok = True)
+        temporaryPath = BBOX_TABLE_FILE + '.tmp'
+        with open(temporaryPath, 'w') as writeFile:
+            json.dump(table, writeFile)
+        os.replace(temporaryPath, BBOX_TABLE_FILE)
+
+    return
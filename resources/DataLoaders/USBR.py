@@ -9,10 +9,11 @@
 # Import Libraries
 import pandas as pd
 import numpy as np
-import requests
+from io import StringIO
 from datetime import datetime
+from resources.modules.DataTab import httpEngine
 
-def dataLoader(dataset, startDate, endDate):
+async def dataLoader(dataset, startDate, endDate):
     """
     This dataloader loads data from USBR Rest endpoints. The required parameters
     are "Dataset ID" which specifies the hydromet ID and the "DatasetParameterCode" which
@@ -45,7 +46,7 @@ def dataLoader(dataset, startDate, endDate):
         url = url.format(stationID, syear, smonth, sday, eyear, emonth, eday, pcode)
 
         # Download the data and check for valid response
-        response = requests.get(url)
+        response = await httpEngine.get(url, agency = 'USBR')
         if response.status_code == 200:
             data = response.json()
             if data == []:
@@ -82,14 +83,14 @@ def dataLoader(dataset, startDate, endDate):
         url = url.format(stationID, syear, smonth, sday, eyear, emonth, eday, pcode)
 
         # Download the data and check for a valid response
-        response = requests.get(url)
+        response = await httpEngine.get(url, agency = 'USBR')
         if response.status_code == 200:
             pass
         else:
             return pd.DataFrame()
         
         # Parse the data into a dataframe
-        df = pd.read_csv(url, parse_dates=['DateTime']) # Read the data into a dataframe
+        df = pd.read_csv(StringIO(response.text), parse_dates=['DateTime']) # Read the data into a dataframe
         df.set_index(pd.DatetimeIndex(pd.to_datetime(df['DateTime'])), inplace=True) # Set the index to the datetime column
         del df['DateTime'] # Delete the redundant datetime column
         df = df[~df.index.duplicated(keep='first')] # Remove duplicates from the dataset
@@ -1,28 +1,106 @@
 # Script Name:      USGS_NWIS.py
 # Script Author:    Kevin Foley, Civil Engineer
 # Description:      A Dataloader for USGS_NWIS data in JSON format.
-#                   Uses the REST Protocol
+#                   Uses the REST Protocol. All of the USGS datasets in a download are
+#                   requested together, up to MAX_SITES_PER_REQUEST sites per request.
 
 # Function takes the stationDict entry for the station in question
 # along with datetime formatted dates and returns a datatable with columns (date, data, flag)
 
 # Import libraries
+import asyncio
+import json
+import re
 import pandas as pd
 import numpy as np
-import requests
 from datetime import datetime
+from resources.modules.DataTab import httpEngine
 
-def dataLoader(stationDict, startDate, endDate):
+# The most sites the NWIS daily values service accepts in one request
+MAX_SITES_PER_REQUEST = 100
+
+# NWIS's missing value code
+NO_DATA_VALUE = -999999
+
+# Patterns used to pull the data out of the JSON response without decoding the whole thing.
+# Each time series starts with its site code, and its daily values look like
+# {"value":"12.3","qualifiers":["A"],"dateTime":"2020-10-01T00:00:00.000"}
+SITE_PATTERN = re.compile(rb'"siteCode"\s*:\s*\[\s*\{\s*"value"\s*:\s*"([^"]*)"')
+VALUES_PATTERN = re.compile(rb'"values"\s*:\s*\[\s*\{\s*"value"\s*:\s*\[')
+RECORD_PATTERN = re.compile(rb'\{\s*"value"\s*:\s*"([^"]*)"[^{}]*?"dateTime"\s*:\s*"(\d{4}-\d\d-\d\d)')
+
+
+async def dataLoader(stationDict, startDate, endDate):
     """
     This dataloader loads streamflow data from the USGS's NWIS database.The only necessary
     parameter is the USGS streamgage number that should be entered into the "Dataset ID" field.
     DEFAULT OPTIONS
     """
 
+    # Download the single dataset as a batch of one
+    datasets = pd.DataFrame([stationDict])
+    frames = await batchDataLoader(datasets, pd.Series(startDate, index = datasets.index), endDate)
+
+    return frames.get(datasets.index[0])
+
+
+async def batchDataLoader(datasets, startDates, endDate):
+    """
+    Downloads every USGS dataset in the download at once. Sites are requested together with comma
+    separated 'sites=' (MAX_SITES_PER_REQUEST sites per request), and the requests run concurrently.
+    Incremental downloads give each dataset its own start date, so the sites are sorted by start
+    date, each request starts on its earliest site's start date, and each dataset's data is trimmed
+    back to its own start date.
+
+    Input:
+        datasets -> the datasets' rows in the datasetTable
+        startDates -> pd.Series of start dates indexed by DatasetInternalID
+        endDate -> the last date to download
+
+    Output:
+        frames -> dict of DatasetInternalID -> single column dataframe
+    """
+
+    # Each site's earliest start date, with the sites in start date order so that requests cover similar periods
+    siteStartDates = pd.Series(pd.to_datetime(startDates[datasets.index].values), index = datasets['DatasetExternalID'].astype(str).values)
+    siteStartDates = siteStartDates.groupby(level = 0).min().sort_values(kind = 'stable')
+    sites = list(siteStartDates.index)
+    siteRequests = [(siteStartDates.iloc[i], sites[i:i + MAX_SITES_PER_REQUEST]) for i in range(0, len(sites), MAX_SITES_PER_REQUEST)]
+
+    # Make the requests
+    results = await asyncio.gather(*[downloadSites(requestSites, startDate, endDate) for startDate, requestSites in siteRequests])
+
+    # Split the data back out into datasets
+    siteData = {}
+    for result in results:
+        siteData.update(result)
+
+    frames = {}
+    for datasetID, dataset in datasets.iterrows():
+        site = str(dataset['DatasetExternalID'])
+        if site not in siteData:
+            continue
+        dates, values = siteData[site]
+        keep = dates >= np.datetime64(pd.Timestamp(startDates[datasetID]), 'D')
+        df = pd.DataFrame({'USGS | ' + site + ' | Streamflow | CFS': values[keep]}, index = pd.DatetimeIndex(dates[keep]))
+        df = df[~df.index.duplicated(keep='last')] # Remove duplicates from the dataset
+        frames[datasetID] = df
+
+    return frames
+
+
+async def downloadSites(sites, startDate, endDate):
+    """
+    Downloads daily mean streamflow for a list of sites with one request
+
+    Output:
+        siteData -> dict of site number -> (dates, values) numpy arrays
+    """
+
     # Generate a URL
     url = ('https://waterservices.usgs.gov/nwis/dv/?format=json' +
             # Specify the sites to download
-            '&sites=' + stationDict['DatasetExternalID'] +
+            '&sites=' + ','.join(sites) +
             # Specify the start date
             '&startDT=' + datetime.strftime( startDate, '%Y-%m-%d' ) +
             #Specify the end data
@@ -33,36 +111,84 @@ def dataLoader(stationDict, startDate, endDate):
             '&statCd=00003' +
             # Allow all sites
             '&siteStatus=all' )
-    
+
     # Get the data
-    response = requests.get(url)
+    response = await httpEngine.get(url, agency = 'USGS')
 
     # Check the status code
     if response.status_code != 200:
-        return 
-    else:
-        response = response.json()
-    
-    # Create a dataframe from the data
-    df = pd.DataFrame(response['value']['timeSeries'][0]['values'][0]['value'])
-
-    # Set the index to the dateTime index
-    df.set_index(pd.DatetimeIndex(pd.to_datetime(df['dateTime'])), inplace = True)
-    del df['dateTime'] # Delete the redundant column
-
-    # Replace missing data with NaN's
-    df['value'].replace(to_replace = '-999999', value = np.nan, inplace = True)
-
-    # Convert to numeric
-    df['value'] = pd.to_numeric(df['value'])
-    
-    # Remove any duplicate data in the dataset
-    df = df[~df.index.duplicated(keep='last')] # Remove duplicates from the dataset
-    df = df[~df.index.isnull()]
-
-    # Rename the columns
-    df.columns = ['USGS | ' + stationDict['DatasetExternalID'] + ' | Flag', 'USGS | ' + stationDict['DatasetExternalID'] + ' | Streamflow | CFS']
-    del df['USGS | ' + stationDict['DatasetExternalID'] + ' | Flag']
-
-    # Return the data frame
-    return df
\ No newline at end of file
+        return {}
+
+    # Parse it off the event loop, since long records take a moment
+    return await asyncio.get_running_loop().run_in_executor(None, parseTimeSeries, response.content)
+
+
+def parseTimeSeries(content):
+    """
+    Parses a NWIS JSON response into numpy arrays for each site. The response is scanned one time
+    series at a time, and the dates and values go straight into typed arrays (no JSON tree or list
+    of dicts is built). Responses that don't look like we expect are decoded with the json module.
+
+    Input:
+        content -> the response body (bytes)
+
+    Output:
+        siteData -> dict of site number -> (dates, values) numpy arrays (datetime64[D], float). Only the
+                    first time series for each site is kept.
+    """
+    siteData = {}
+
+    # Each site's time series runs from its site code to the next site code
+    sites = list(SITE_PATTERN.finditer(content))
+    for i, siteMatch in enumerate(sites):
+        site = siteMatch.group(1).decode()
+        if site in siteData:
+            continue
+        segmentEnd = sites[i + 1].start() if i + 1 < len(sites) else len(content)
+
+        # The site's first set of values ends where that set's "qualifier" list starts
+        valuesMatch = VALUES_PATTERN.search(content, siteMatch.end(), segmentEnd)
+        if valuesMatch is None:
+            siteData[site] = (np.array([], dtype='datetime64[D]'), np.array([], dtype=float))
+            continue
+        valuesEnd = content.find(b'"qualifier":', valuesMatch.end(), segmentEnd)
+        valuesEnd = segmentEnd if valuesEnd < 0 else valuesEnd
+        records = RECORD_PATTERN.findall(content, valuesMatch.end(), valuesEnd)
+
+        # If the records are laid out differently than we expect, decode the response properly instead
+        if len(records) != content.count(b'"dateTime"', valuesMatch.end(), valuesEnd):
+            return parseTimeSeriesJSON(content)
+
+        siteData[site] = toArrays([record[1] for record in records], [record[0] for record in records])
+
+    return siteData
+
+
+def parseTimeSeriesJSON(content):
+    """
+    Parses a NWIS JSON response with the json module (the slow way)
+    """
+    siteData = {}
+    for timeSeries in json.loads(content)['value']['timeSeries']:
+        site = timeSeries['sourceInfo']['siteCode'][0]['value']
+        if site in siteData:
+            continue
+        records = timeSeries['values'][0]['value'] if timeSeries['values'] != [] else []
+        siteData[site] = toArrays([record['dateTime'][:10] for record in records], [record['value'] for record in records])
+
+    return siteData
+
+
+def toArrays(dates, values):
+    """
+    Converts lists of date strings and value strings into datetime64[D] and float arrays.
+    NWIS's missing value code becomes NaN.
+    """
+    dates = np.array(dates, dtype='S10' if dates and isinstance(dates[0], bytes) else 'U10').astype('datetime64[D]')
+    try:
+        values = np.array(values).astype(float) if len(values) > 0 else np.array([], dtype=float)
+    except ValueError:
+        values = pd.to_numeric(pd.Series(values).str.decode('utf-8') if values and isinstance(values[0], bytes) else pd.Series(values), errors = 'coerce').values
+    values[values == NO_DATA_VALUE] = np.nan
+
+    return dates, values
@@ -272,6 +272,7 @@ class TimeSeriesSliderPlot(pg.GraphicsLayoutWidget):
         
         cc = colorCycler()
         dataset_ids = list(set(dataFrame.index.get_level_values(1)))
+        self.plotted_ids = dataset_ids
         self.dates = dataFrame.index.levels[0].astype('int64')/1000000000
         self.names = [datasets.loc[id_]['DatasetName'] for id_ in dataset_ids]
         self.unitList = [datasets.loc[id_]['DatasetUnits'] for id_ in dataset_ids]
@@ -383,6 +384,43 @@ class TimeSeriesSliderPlot(pg.GraphicsLayoutWidget):
         return
 
 
+    def update_plotted_values(self, changed_values):
+        """
+        Writes changed values straight into the plotted curves instead of replotting them. Only the
+        curves that changed are redrawn, and the main plot only redraws them if a changed point
+        is in view. Returns False if a value can't be placed on its curve (e.g. it extends the curve),
+        in which case the caller should replot.
+
+        changed_values -> list of (DatasetInternalID, date, newValue)
+        """
+        if not hasattr(self, 'plotted_ids'):
+            return False
+
+        changedItems = {}
+        for id_, date, value in changed_values:
+            if id_ not in self.plotted_ids:
+                continue
+            i = self.plotted_ids.index(id_)
+            x = pd.Timestamp(date).value/1000000000
+            for item in [self.p1CurveItems[i], self.p2CurveItems[i]]:
+                idx = np.searchsorted(item.xData[:len(item.yData)], x)
+                if idx >= len(item.yData) or item.xData[idx] != x:
+                    return False
+                item.yData[idx] = value
+            changedItems.setdefault(i, []).append(x)
+
+        # Redraw the changed curves. The overview plot always shows the whole curve, the main plot only redraws if the change is visible
+        xMin, xMax = self.p1.vb.viewRange()[0]
+        for i, xs in changedItems.items():
+            self.p2CurveItems[i].viewRangeChanged()
+            if any(xMin <= x <= xMax for x in xs):
+                self.p1CurveItems[i].viewRangeChanged()
+            else:
+                self.p1CurveItems[i].xDisp = self.p1CurveItems[i].yDisp = None
+
+        return True
+
+
 class colorCycler():
     """
     Simple color cycler for the plots
@@ -37,13 +37,10 @@ class SpreadSheetModel(QtCore.QAbstractItemModel):
         self.parent=parent
         self.initialized = False
 
-    def initialize_model_with_dataset(self, dataTable, datasetTable):
+    def initialize_model_with_dataset(self, dataStore, datasetTable):
         """
-        The dataTable looks like:
-        datetime    datasetInternalID   value   editflag
-        2018-10-01  102020              34.22   F
-        2018-10-01  102321              122.33  T
-        ...
+        The dataStore is the application's DataStore (daily dates x datasets). Cells are read 
+        straight out of the store's value and edit flag arrays.
 
         The datasetTable looks like:
         datasetID   datasetName ... ...
@@ -52,7 +49,8 @@ class SpreadSheetModel(QtCore.QAbstractItemModel):
         ...
         """
         self.beginResetModel()
-        self.dataTable = dataTable
+        self.dataStore = dataStore
+        self.dates = dataStore.dates
         self.datasetTable = datasetTable
         self.datasetNames = OrderedDict((id_,name) for id_, name in ((row[0], row[1]['DatasetName']) for row in self.datasetTable.iterrows()))
         for id_ in list(self.datasetNames):
@@ -78,8 +76,6 @@ class SpreadSheetModel(QtCore.QAbstractItemModel):
                     
                     
         self.datasetNamesList = list(self.datasetNames)
-        #self.indexArray = np.array([[self.createIndex(i,j,self.dataTable.loc[(date, id_),'Value']) if (date, id_) in self.dataTable.index else self.createIndex(i,j,np.nan) for j, id_ in enumerate(self.datasetNamesList)] for i, date in enumerate(self.dataTable.index.levels[0])])
-        self.indexArray = np.array([[self.createIndex(i,j) for j, id_ in enumerate(self.datasetNamesList)] for i, date in enumerate(self.dataTable.index.levels[0])])
         self.initialized = True
         self.endResetModel()
 
@@ -89,41 +85,31 @@ class SpreadSheetModel(QtCore.QAbstractItemModel):
         return
 
     def index(self, row, column, parent = QtCore.QModelIndex()):
-        return self.indexArray[row][column]
+        return self.createIndex(row, column)
 
     
     def columnCount(self, parent=QtCore.QModelIndex()):
         if self.initialized:
-            return self.indexArray.shape[1]
+            return len(self.datasetNamesList)
         return 0
 
     def rowCount(self, parent=QtCore.QModelIndex()):
         if self.initialized:
-            return self.indexArray.shape[0]
+            return len(self.dates)
         return 0
     
     def data(self, index, role = QtCore.Qt.DisplayRole):
-        date = self.dataTable.index.levels[0][index.row()]
         id_ = self.datasetNamesList[index.column()]
+        col = self.dataStore.columnIndex.get(id_)
         if role == QtCore.Qt.DisplayRole:
-            if (date, id_) in self.dataTable.index:
-                val = str(round(self.dataTable.loc[(date, id_), 'Value'], 3))
+            if col is not None and not np.isnan(self.dataStore.values[index.row(), col]):
+                val = str(round(self.dataStore.values[index.row(), col], 3))
             else:
                 val = QtCore.QVariant()
-            # try:
-            #     val = str(round(self.dataTable.loc[(date, id_), 'Value'], 3))
-            # except Exception as e:
-            #     print(self.dataTable.index.levels[1])
-            #     print(e)
-            #     print(id_)
-            #     print(date)
 
         elif role == QtCore.Qt.BackgroundRole:
-            if (date, id_) in self.dataTable.index:
-                if self.dataTable.loc[(date, id_), 'EditFlag']:
-                    val = QtCore.QVariant(QtGui.QColor(255, 178, 178))
-                else:
-                    val = QtCore.QVariant(QtGui.QColor(255,255,255))
+            if col is not None and self.dataStore.editFlags[index.row(), col]:
+                val = QtCore.QVariant(QtGui.QColor(255, 178, 178))
             else:
                 val = QtCore.QVariant(QtGui.QColor(255,255,255))
         else:
@@ -131,9 +117,9 @@ class SpreadSheetModel(QtCore.QAbstractItemModel):
         return val
 
     def setData(self, index, value, role = QtCore.Qt.DisplayRole):
-        date = self.dataTable.index.levels[0][index.row()]
+        date = self.dates[index.row()]
         id_ = self.datasetNamesList[index.column()]
-        oldValue = float(self.dataTable.loc[(date, id_),'Value'])
+        oldValue = float(self.dataStore.getValues([date], [id_])[0][0])
         
         try:
             try:
@@ -156,7 +142,7 @@ class SpreadSheetModel(QtCore.QAbstractItemModel):
         if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
             val = QtCore.QVariant(str(self.datasetNames[self.datasetNamesList[section]]))
         elif orientation == QtCore.Qt.Vertical and role == QtCore.Qt.DisplayRole:
-            val = QtCore.QVariant(self.dataTable.index.levels[0][section].strftime('%Y-%m-%d') + ' ')
+            val = QtCore.QVariant(self.dates[section].strftime('%Y-%m-%d') + ' ')
         else:
             val = QtCore.QVariant()
         return val
@@ -9,6 +9,7 @@ sys.path.append(os.getcwd())
 import numpy as np
 import re
 from resources.GUI.CustomWidgets import PyQtGraphs, DatasetBoxView
+from resources.modules.Miscellaneous import loggingAndErrors, DataProcessor
 from    PyQt5   import  QtWidgets, \
                         QtCore, \
                         QtGui
@@ -17,12 +18,15 @@ class ScaledDataViewer(QtWidgets.QDialog):
     """
     """
 
-    def __init__(self, dataTable, datasetTable):
+    def __init__(self, dataTable, datasetTable, resampleCache):
         """
+        resampleCache is the application's DataProcessor.ResampleCache (the one the Data and Datasets tabs
+        keep up to date), so resampled datasets are shared and rebuilt when their data changes.
         """
         super(ScaledDataViewer, self).__init__()
         self.dataTable = dataTable
         self.datasetTable = datasetTable
+        self.resampleCache = resampleCache
         self.setupUI()
 
         self.freqDict = {
@@ -73,6 +77,12 @@ class ScaledDataViewer(QtWidgets.QDialog):
 
         d = {"Title":title, "subtitle1": subtitle1, "subtitle2": subtitle2, "subtitle3":subtitle3, "ID":id_, "resampleString":resampleString, "ResampleMethod":method, "CustomFunction":function}
 
+        # Resample the data (re-using the cached series if this dataset hasn't changed since it was last resampled)
+        resampledData, code, message = self.resampleCache.resample(self.dataTable, int(id_), resampleString, method, function)
+        if code != 0:
+            loggingAndErrors.showErrorMessage(self, message)
+            return
+
         self.datasetList.addAbstractEntry(d)
         
 
@@ -201,7 +211,9 @@ class ScaledDataViewer(QtWidgets.QDialog):
 
         self.setLayout(layout1)
 
-class resamplePlotViewer(PyQtGraphs)
+class resamplePlotViewer(PyQtGraphs.TimeSeriesSliderPlot):
+    """
+    """
 
 if __name__ == "__main__":
     
@@ -211,7 +223,7 @@ if __name__ == "__main__":
     window = QtWidgets.QMainWindow()
     dataTable = pd.DataFrame()
     datasetTable = pd.DataFrame([["Test 1", "Param1"], ["Test 2", "Param2"]], columns=['DatasetName', 'DatasetParameter'], index=[100101, 100202])
-    widg = ScaledDataViewer(dataTable, datasetTable)
+    widg = ScaledDataViewer(dataTable, datasetTable, DataProcessor.ResampleCache())
     window.setCentralWidget(widg)
     window.show()
     sys.exit(app.exec_())
@@ -1,6 +1,7 @@
 from PyQt5 import QtWidgets, QtCore
 from datetime import datetime
 from resources.modules.Miscellaneous import  loggingAndErrors
+from resources.modules.DataTab import dataloaderRegistry, httpEngine, importFiles
 
 import pandas as pd
 import os
@@ -92,12 +93,9 @@ class UserDefinedDatasetDialog(QtWidgets.QDialog):
 
         loaderSelectTitle = QtWidgets.QLabel("Select Loader")
         self.loaderDropDown = QtWidgets.QComboBox()
-        self.defaultLoaders = os.listdir("resources/DataLoaders/")
-        self.customLoaders = os.listdir("resources/DataLoaders/CustomDataLoaders/")
         if not importDatasetFlag:
-            for i, file in enumerate(self.defaultLoaders + self.customLoaders):
-                if file[-3:] == '.py':
-                    self.loaderDropDown.addItem(file[:-3])
+            for loader in dataloaderRegistry.names():
+                self.loaderDropDown.addItem(loader)
 
             self.loaderDropDown.currentTextChanged.connect(self.populateOptions)
         else:
@@ -129,6 +127,13 @@ class UserDefinedDatasetDialog(QtWidgets.QDialog):
             hlayout.addWidget(self.fileNameText)
             mainLayout.addLayout(hlayout)
 
+            importColumnTitle = QtWidgets.QLabel("Data Column")
+            self.importColumnDropDown = QtWidgets.QComboBox()
+            hlayout = QtWidgets.QHBoxLayout()
+            hlayout.addWidget(importColumnTitle)
+            hlayout.addWidget(self.importColumnDropDown)
+            mainLayout.addLayout(hlayout)
+
         addButton = QtWidgets.QPushButton("Confirm")
         addButton.clicked.connect(self.packageAndReturn)
         cancelButton = QtWidgets.QPushButton("Cancel")
@@ -155,14 +160,35 @@ class UserDefinedDatasetDialog(QtWidgets.QDialog):
     def setImportLayout(self):
         self.description.setPlainText("""
 Load data from a CSV or XLSX file. 
-Data should be formatted in two columns
-with headers similar to:
-
-Date        |   Data Value
-------------|--------------
-2018-10-01  |   2342.2
-2018-10-02  |   2345.3
-...         |   ....""")
+Data should be formatted in two (or more)
+columns with headers similar to:
+
+Date        |   Data Value  |   Other Value
+------------|---------------|--------------
+2018-10-01  |   2342.2      |   12.1
+2018-10-02  |   2345.3      |   12.4
+...         |   ....        |   ....
+
+Choose the column (and sheet) with this
+dataset's data under 'Data Column'.""")
+        return
+
+    def populateImportColumns(self, fileName, sheet = '', column = ''):
+        """
+        Lists the data columns (of every sheet) in the import file, and selects the dataset's column
+        """
+        self.importColumnDropDown.clear()
+        try:
+            tables = importFiles.readImportFile(fileName)
+        except Exception as E:
+            loggingAndErrors.showErrorMessage(self, "Error: Could not read {0}.\n{1}".format(fileName, E))
+            return
+
+        for sheetName, columnName in importFiles.fileColumns(tables):
+            self.importColumnDropDown.addItem(columnName if sheetName == '' or len(tables) == 1 else '{0}: {1}'.format(sheetName, columnName), (sheetName, columnName))
+            if (sheetName == sheet or sheet == '') and columnName == column:
+                self.importColumnDropDown.setCurrentIndex(self.importColumnDropDown.count() - 1)
+
         return
 
     def setFileName(self):
@@ -170,6 +196,7 @@ Date        |   Data Value
         if fname != '':
             self.fileName = fname
             self.fileNameText.setText(fname)
+            self.populateImportColumns(fname)
         else:
             return
 
@@ -207,13 +234,22 @@ Date        |   Data Value
                 else:
                     additionalOptionsDict[key] = value
         else:
-            if self.fileName == '':
+            if self.fileName == '' or self.importColumnDropDown.currentData() is None:
                 return
             additionalOptionsDict['Import Filename'] = self.fileName
+            additionalOptionsDict['Import Sheet'], additionalOptionsDict['Import Column'] = self.importColumnDropDown.currentData()
 
         if additionalOptionsDict != {}:
             df['DatasetAdditionalOptions'] = [additionalOptionsDict]
 
+        # Check that the fields the dataloader reads (from the registry) are filled in
+        if not self.importDatasetFlag:
+            fields = dataloaderRegistry.dataloaderInfo(self.loaderDropDown.currentText())['fields']
+            missing = [field for field in fields if str(df[field].iloc[0] if field in df.columns else additionalOptionsDict.get(field, '')).strip() == '']
+            if missing != []:
+                loggingAndErrors.showErrorMessage(self, "The {0} dataloader needs these fields: {1}".format(self.loaderDropDown.currentText(), ', '.join(missing)))
+                return
+
         # Check to make sure the dataloader works with the provided data
         if not self.testLoader(df):
             return
@@ -242,33 +278,21 @@ Date        |   Data Value
         # Clear the existing description
         self.description.clear()
         
-        # Import the selected dataloader
+        # Load the dataloaders description and options (from the registry, without importing the dataloader)
         loader = self.loaderDropDown.currentText()
-        if loader+'.py' in self.defaultLoaders:
-            dataloader = importlib.import_module('resources.DataLoaders.'+ loader)
-        else:
-            dataloader = importlib.import_module('resources.DataLoaders.CustomDataLoaders.'+ loader)
-        
-        # Load the dataloaders description and options
-        docstring = dataloader.dataLoader.__doc__
-        description = docstring.split('DEFAULT OPTIONS')[0]
-        description = description.replace('\n', '')
-        options = docstring.split("DEFAULT OPTIONS")[1]
+        if loader == '':
+            return
+        loaderInfo = dataloaderRegistry.dataloaderInfo(loader)
 
-        self.description.setPlainText(description)
+        self.description.setPlainText(loaderInfo['description'])
 
-        for option in options.splitlines():
-            if option.strip() == '':
-                continue
-            else:
-                key = option.split(':')[0].strip()
-                value = option.split(':')[1].strip()
-                currentRow = self.optionsTable.rowCount()
-                self.optionsTable.insertRow(currentRow)
-                item = QtWidgets.QTableWidgetItem(key)
-                item.setFlags(QtCore.Qt.ItemIsEnabled)
-                self.optionsTable.setItem(currentRow, 0, item)
-                self.optionsTable.setItem(currentRow, 1, QtWidgets.QTableWidgetItem(value))
+        for key, value in loaderInfo['defaultOptions']:
+            currentRow = self.optionsTable.rowCount()
+            self.optionsTable.insertRow(currentRow)
+            item = QtWidgets.QTableWidgetItem(key)
+            item.setFlags(QtCore.Qt.ItemIsEnabled)
+            self.optionsTable.setItem(currentRow, 0, item)
+            self.optionsTable.setItem(currentRow, 1, QtWidgets.QTableWidgetItem(value))
 
         return
 
@@ -289,43 +313,32 @@ Date        |   Data Value
         self.longEdit.setText(str(dataset['DatasetLongitude']))
         
         if self.importDatasetFlag:
-            self.fileNameText.setText(dataset['DatasetAdditionalOptions']['Import Filename'])
+            importOptions = dataset['DatasetAdditionalOptions']
+            self.fileName = importOptions['Import Filename']
+            self.fileNameText.setText(self.fileName)
+            self.populateImportColumns(self.fileName, importOptions.get('Import Sheet', ''), importOptions.get('Import Column', ''))
             return
 
-        loader = self.loaderDropDown.currentText()
-        if loader+'.py' in self.defaultLoaders:
-            dataloader = importlib.import_module('resources.DataLoaders.'+ loader)
-        else:
-            dataloader = importlib.import_module('resources.DataLoaders.CustomDataLoaders.'+ loader)
-
-        docstring = dataloader.dataLoader.__doc__
-        description = docstring.split('DEFAULT OPTIONS')[0]
-        description = description.replace('\n', '')
-        options = docstring.split("DEFAULT OPTIONS")[1]
+        loaderInfo = dataloaderRegistry.dataloaderInfo(self.loaderDropDown.currentText())
 
-        self.description.setPlainText(description)
+        self.description.setPlainText(loaderInfo['description'])
 
         self.optionsTable.setRowCount(0)
 
-        for option in options.splitlines():
-            if option.strip() == '':
-                continue
+        for key, value in loaderInfo['defaultOptions']:
+            if key in self.parent.datasetTable.columns:
+                filledVal = dataset[key]
             else:
-                key = option.split(':')[0].strip()
-                value = option.split(':')[1].strip()
-                if key in self.parent.datasetTable.columns:
-                    filledVal = dataset[key]
-                else:
-                    try:
-                        filledVal = dataset['DatasetAdditionalOptions'][key]
-                    except:
-                        filledVal = value
-                currentRow = self.optionsTable.rowCount()
-                self.optionsTable.insertRow(currentRow)
-                item = QtWidgets.QTableWidgetItem(key)
-                item.setFlags(QtCore.Qt.ItemIsEnabled)
-                self.optionsTable.setItem(currentRow, 0, item)
-                self.optionsTable.setItem(currentRow, 1, QtWidgets.QTableWidgetItem(filledVal))
+                try:
+                    filledVal = dataset['DatasetAdditionalOptions'][key]
+                except:
+                    filledVal = value
+            currentRow = self.optionsTable.rowCount()
+            self.optionsTable.insertRow(currentRow)
+            item = QtWidgets.QTableWidgetItem(key)
+            item.setFlags(QtCore.Qt.ItemIsEnabled)
+            self.optionsTable.setItem(currentRow, 0, item)
+            self.optionsTable.setItem(currentRow, 1, QtWidgets.QTableWidgetItem(filledVal))
         return
 
     def testLoader(self, dataset):
@@ -334,27 +347,24 @@ Date        |   Data Value
         the dataset can be properly downloaded or imported. 
         """
         if self.importDatasetFlag:
-            fileName = dataset['DatasetAdditionalOptions'].iloc[0]['Import Filename']
+            importOptions = dataset['DatasetAdditionalOptions'].iloc[0]
             try:
-                if fileName[-4:] == '.csv':
-                    df = pd.read_csv(fileName, index_col=0, parse_dates=True)
-                elif '.xls' in fileName[-5:]:
-                    df = pd.read_excel(fileName, index_col=0, parse_dates=True)
-                else:
-                    return False
-                self.datasetToReturnEventually = df
-                return True
-            except:
+                fingerprint = importFiles.fileFingerprint(importOptions['Import Filename'])
+                tables = importFiles.readImportFile(importOptions['Import Filename'], fingerprint)
+                self.datasetToReturnEventually = importFiles.selectSeries(tables, importOptions['Import Sheet'], importOptions['Import Column']).to_frame('Value')
+            except Exception as E:
+                loggingAndErrors.showErrorMessage(self, "Error: Could not import the data.\n"+str(E))
                 return False
 
+            # New datasets get this data now, so the next refresh doesn't need to read the file again
+            if not self.editFlag:
+                importOptions['Import Fingerprint'] = fingerprint
+            return True
+
 
         # Attempt to import the loader
         try:
-            loaderName = list(dataset['DatasetDataloader'])[0]
-            if loaderName + '.py' in  self.defaultLoaders:
-                loader = importlib.import_module('resources.DataLoaders.'+ loaderName)
-            else:
-                loader = importlib.import_module('resources.DataLoaders.CustomDataLoaders'+ loaderName)
+            loader = dataloaderRegistry.load(list(dataset['DatasetDataloader'])[0])
         
         except Exception as E:
             loggingAndErrors.showErrorMessage(self, "Error: Could not initialize the selected dataloader. Please check the dataloader for errors.\n"+str(E))
@@ -364,7 +374,7 @@ Date        |   Data Value
         try:
             currentDate = pd.to_datetime(self.parent.userOptionsConfig['GENERAL']['application_datetime'])
             startDate = currentDate - pd.DateOffset(10)
-            data = loader.dataLoader(dataset.loc[1], startDate, currentDate)
+            data = httpEngine.syncDataLoader(loader)(dataset.loc[1], startDate, currentDate)
         except Exception as E:
             loggingAndErrors.showErrorMessage(self, "Error: Dataloader could not return data for the past 10 days. Check dataloader for errors.\n"+str(E))
             return False
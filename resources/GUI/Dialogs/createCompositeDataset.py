@@ -16,9 +16,10 @@ class compositeDatasetDialog(QtWidgets.QDialog):
 
     returnDatasetSignal = QtCore.pyqtSignal(object)
 
-    def __init__(self, datasetTable, dataTable, predefinedOptions = None):
+    def __init__(self, datasetTable, dataTable, predefinedOptions = None, nanHandling = 'propagate'):
         super(compositeDatasetDialog, self).__init__()
         self.datasetTable = datasetTable
+        self.nanHandling = nanHandling
 
         if datasetTable.empty:
             print('No datasets')
@@ -82,16 +83,7 @@ class compositeDatasetDialog(QtWidgets.QDialog):
         self.predifinedIndex = options.name
 
         comboString = options['DatasetAdditionalOptions']['CompositeString']
-        
-        def parser(idx, parseString):
-            if idx == 0:
-                return None
-            elif idx == 1 or idx == 3:
-                return [int(i) for i in parseString.split(',')]
-            elif idx == 2:
-                return [float(i) for i in parseString.split(',')]
-
-        null, IDs, CFs, LGs = [parser(i, x) for i,x in enumerate(comboString.split('/'))]
+        IDs, CFs, LGs = DataProcessor.parseCompositeString(comboString)
 
         for i, idx in enumerate(IDs):
             dataset = self.datasetTable.loc[idx]
@@ -161,7 +153,7 @@ class compositeDatasetDialog(QtWidgets.QDialog):
         d = self.tableToDict()
         d['DatasetName'] = datasetName
 
-        datasetEntry, dataEntry = DataProcessor.combinedDataSet(self.dataTable, self.datasetTable, s, d, self.predifinedIndex)
+        datasetEntry, dataEntry = DataProcessor.combinedDataSet(self.dataTable, self.datasetTable, s, d, self.predifinedIndex, self.nanHandling)
         self.returnDatasetSignal.emit([datasetEntry, dataEntry])
         self.close()
         return
@@ -30,18 +30,25 @@ class DataTab(QtWidgets.QWidget):
         self.porT1.setFixedWidth(50)
         self.porT2.setFixedWidth(50)
         self.downloadButton = QtWidgets.QPushButton("Download / Update")
+        self.fullResyncCheck = QtWidgets.QCheckBox("Full re-sync")
+        self.fullResyncCheck.setToolTip("Re-download the entire period of record instead of only the most recent data")
         self.importButton = QtWidgets.QPushButton("Import")
         self.downloadProgressBar = QtWidgets.QProgressBar()
         self.downloadProgressBar.setRange(0, 100)
         self.downloadProgressBar.setFixedWidth(100)
         self.downloadProgressBar.hide()
+        self.cancelDownloadButton = QtWidgets.QPushButton("Cancel")
+        self.cancelDownloadButton.setToolTip("Stop the download. Data that has already downloaded is kept.")
+        self.cancelDownloadButton.hide()
         self.compositeButton = QtWidgets.QPushButton("Create Composite Dataset")
         hlayout.addWidget(porLabel)
         hlayout.addWidget(self.porT1)
         hlayout.addWidget(self.porT2)
         hlayout.addWidget(self.downloadButton)
+        hlayout.addWidget(self.fullResyncCheck)
         hlayout.addWidget(self.importButton)
         hlayout.addWidget(self.downloadProgressBar)
+        hlayout.addWidget(self.cancelDownloadButton)
         hlayout.addSpacerItem(QtWidgets.QSpacerItem(500, 10, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum))
         hlayout.addWidget(self.compositeButton)
         layout.addLayout(hlayout)
@@ -23,7 +23,7 @@ from resources.GUI import NextFlowGUI
 from resources.modules.DatasetTab import datasetTabMaster 
 from resources.modules.DataTab import dataTabMaster
 from resources.modules.MenuBar import menuBarMaster
-from resources.modules.Miscellaneous import initUserOptions
+from resources.modules.Miscellaneous import initUserOptions, DataProcessor, DataStore
 from datetime import datetime
 import configparser
 import pandas as pd
@@ -67,17 +67,14 @@ class mainWindow(QtWidgets.QMainWindow, NextFlowGUI.UI_MainWindow, datasetTabMas
             'DatasetPOREnd',# e.g. 1/22/2019
             'DatasetAdditionalOptions']) 
 
-        # The data table stores all of the raw data associated with the selected datasets.
-        # Edited data is versioned as 1 and unedited data is versioned as 0
-        self.dataTable = pd.DataFrame(
-            index = pd.MultiIndex(
-                levels=[[],[],],
-                codes = [[],[],],
-                names = ['Datetime','DatasetInternalID']
-            ),
-            columns = ["Value","EditFlag"],
-            dtype=float)
-        self.dataTable['EditFlag'] = self.dataTable['EditFlag'].astype(bool)
+        # The data store holds all of the raw data associated with the selected datasets as a 
+        # (daily dates x datasets) array. Edited data is flagged in a parallel array of edit flags.
+        # The long (Datetime, DatasetInternalID) version of the data is available as 'self.dataTable'.
+        self.dataStore = DataStore.DataStore()
+
+        # The composite graph tracks which composite datasets are computed from which datasets, so that
+        # new or changed data only triggers recomputation of the composites downstream of it.
+        self.compositeGraph = DataProcessor.CompositeGraph()
         
         # This table will keep track of all the model runs initial conditions
         self.modelRunsTable = pd.DataFrame(
@@ -132,6 +129,9 @@ class mainWindow(QtWidgets.QMainWindow, NextFlowGUI.UI_MainWindow, datasetTabMas
         self.userOptionsConfig = configparser.ConfigParser()
         self.userOptionsConfig.read('resources/temp/user_options.txt')
 
+        # The resample cache stores recently resampled predictor datasets so that they aren't rebuilt until their data changes
+        self.resampleCache = DataProcessor.ResampleCache(float(self.userOptionsConfig['DATA TAB'].get('resample_cache_mb', '64')))
+
         self.setUI()
         pd.set_option('display.max_rows', 25)
 
@@ -146,4 +146,24 @@ class mainWindow(QtWidgets.QMainWindow, NextFlowGUI.UI_MainWindow, datasetTabMas
         # Show the application
         self.showMaximized()
 
-        return
\ No newline at end of file
+        return
+
+    @property
+    def dataTable(self):
+        """
+        The data in the data store as a long dataframe, for code that hasn't moved over to the data store:
+
+        Datetime    DatasetInternalID   Value   EditFlag
+        2018-10-01  102020              34.22   False
+        2018-10-01  102321              122.33  True
+
+        This is a read-only copy. Use the dataStore methods to change data in place.
+        """
+        return self.dataStore.longView()
+
+    @dataTable.setter
+    def dataTable(self, dataTable):
+        """
+        Replaces all the data in the data store with the data in a long dataframe
+        """
+        self.dataStore = DataStore.DataStore.fromLongTable(dataTable)
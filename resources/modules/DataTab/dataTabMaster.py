@@ -2,8 +2,8 @@
 Script Name:    dataTabMaster.py
 Description:    This script contains all the functionality behind the User interface of the Data Tab.
 """
-from resources.modules.Miscellaneous import loggingAndErrors, DataProcessor
-from resources.modules.DataTab import downloadData
+from resources.modules.Miscellaneous import loggingAndErrors, DataProcessor, DataStore
+from resources.modules.DataTab import downloadData, downloadExecutor, httpEngine, refreshPipeline
 from resources.GUI.Dialogs.createCompositeDataset import compositeDatasetDialog
 from resources.GUI.Dialogs import UserDefinedDatasetDialog
 from PyQt5 import QtCore
@@ -12,6 +12,9 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 
+# Datasets listed in the message about failed downloads (the rest are counted)
+MAX_LISTED_FAILURES = 15
+
 class dataTab(object):
 
     def setupDataTab(self):
@@ -22,15 +25,26 @@ class dataTab(object):
         self.dataTab.downloadButton.clicked.connect(self.downloadData)
         self.dataTab.importButton.clicked.connect(lambda x: self.createUserDefinedDataset(importDatasetFlag=True))
         self.dataTab.compositeButton.clicked.connect(self.openCompositeDialog)
+        self.dataTab.cancelDownloadButton.clicked.connect(self.cancelDownload)
+        self.dataTab.fullResyncCheck.setChecked(self.userOptionsConfig['DATA TAB'].get('incremental_download', 'True') != 'True')
         self.currentlyPlottedColumns = []
 
+        # Downloaded files are cached on disk. In offline mode, data only comes from the cache.
+        httpEngine.configureCache(maxMegabytes = float(self.userOptionsConfig['DATA TAB'].get('http_cache_mb', '200')), offline = self.userOptionsConfig['DATA TAB'].get('offline_mode', 'False') == 'True')
+
+        # Download workers are kept alive between downloads
+        self.downloadExecutor = downloadExecutor.DownloadExecutor(self.userOptionsConfig['DATA TAB'].get('download_threads', '8'), self.userOptionsConfig['DATA TAB'].get('download_processes', '2'), self.userOptionsConfig['DATA TAB'].get('download_timeout', '600'))
+        self.downloadWorker = None
+        self.downloadStatus = {}
+        self.fullDownloadStart = None
+
         return
 
     def resetDataTab(self):
         """
         Resets the data tab to a previous configuration based on the data in the 'userOptionsConfig'
         """
-        if self.dataTable.empty:
+        if self.dataStore.empty:
             return
         self.displayDataInTable()
         self.dataTab.porT2.setText(datetime.strftime(pd.to_datetime(self.userOptionsConfig['GENERAL']['application_datetime']), '%Y'))
@@ -47,6 +61,7 @@ class dataTab(object):
         Stores the current settings for the plot and datetimes that the user has set. 
         """
         self.userOptionsConfig['DATA TAB']['por_start'] = self.dataTab.porT1.text()
+        self.userOptionsConfig['DATA TAB']['incremental_download'] = str(not self.dataTab.fullResyncCheck.isChecked())
         self.userOptionsConfig['DATA TAB']['current_plotted_columns'] = ','.join([str(i) for i in self.currentlyPlottedColumns])
         self.userOptionsConfig['DATA TAB']['current_plot_bounds'] = ','.join(str(x) for x in self.dataTab.dataPlot.p1.vb.viewRange()[0]) + ',' + ','.join(str(x) for x in self.dataTab.dataPlot.p1.vb.viewRange()[1])
         
@@ -55,7 +70,7 @@ class dataTab(object):
     def openCompositeDialog(self):
         """
         """
-        self.compDialog = compositeDatasetDialog(self.datasetTable, self.dataTable)
+        self.compDialog = compositeDatasetDialog(self.datasetTable, self.dataTable, nanHandling = self.userOptionsConfig['DATA TAB'].get('composite_nan_handling', 'propagate'))
         self.compDialog.returnDatasetSignal.connect(self.addNewlyCombinedDatasetToDatastores)
         self.compDialog.exec_()
 
@@ -71,7 +86,7 @@ class dataTab(object):
         self.addUserDefinedDatasetToSelectedDatasets(dataset)
 
         # Append the data to the dataTable
-        self.setDataForImportedDataset(data, composite=True)
+        self.setDataForImportedDataset(data)
 
         return
 
@@ -79,15 +94,16 @@ class dataTab(object):
         """
         1. Validates the POR input.
         2. Validates the Datasets Table
-        3. Instantiates a Progress Bar
-        4. Downloads data for each dataset in datasets table and appends to dataTable
+        3. Figures out where each dataset's download should start
+        4. Instantiates a Progress Bar
+        5. Downloads data for each dataset in datasets table and appends to dataTable
         """
 
         # 1. Validate POR input
         porT1 = self.dataTab.porT1.text()
         porT2 = self.dataTab.porT2.text()
         try:
-            porT1 = pd.to_datetime(porT1+'-10-01')
+            porT1 = refreshPipeline.periodOfRecordStart(porT1)
             porT2 = pd.to_datetime(self.userOptionsConfig['GENERAL']['application_datetime'])
         except Exception as E:
             loggingAndErrors.showErrorMessage(self, 'Could not parse POR input: {0}'.format(E))
@@ -98,22 +114,71 @@ class dataTab(object):
             loggingAndErrors.showErrorMessage(self, 'No datasets Selected')
             return
         
-        # 3. Instantiate Progress Bar
+        # 3. Get the start date for each dataset. A full download is recorded once it has finished with every dataset.
+        startDates = self.downloadStartDates(porT1)
+        self.fullDownloadStart = porT1 if refreshPipeline.isFullDownload(self.userOptionsConfig['DATA TAB'], porT1, self.dataTab.fullResyncCheck.isChecked()) else None
+
+        # 4. Instantiate Progress Bar
         self.dataTab.downloadProgressBar.show()
+        self.dataTab.downloadProgressBar.setToolTip('')
+        self.dataTab.cancelDownloadButton.show()
+        self.dataTab.cancelDownloadButton.setEnabled(True)
         self.dataTab.downloadButton.setEnabled(False)
+        self.downloadStatus = {}
 
-        # 4. Download Data For each dataset and append to dataTable
+        # 5. Download Data For each dataset and append to dataTable
         try:
-            downloadWorker = downloadData.alternateThreadWorker(self.datasetTable, porT1, porT2, self.dataTable)
-            downloadWorker.signals.updateProgBar.connect(self.dataTab.downloadProgressBar.setValue)
-            downloadWorker.signals.returnNewData.connect(lambda x: self.postProcessNewData(x))
-            downloadWorker.signals.finished.connect(self.downloadFinished)
-            self.threadPool.start(downloadWorker)
+            self.downloadWorker = downloadData.alternateThreadWorker(self.datasetTable, startDates, porT2, self.downloadExecutor, self.dataTab.fullResyncCheck.isChecked())
+            self.downloadWorker.signals.updateProgBar.connect(self.dataTab.downloadProgressBar.setValue)
+            self.downloadWorker.signals.returnNewData.connect(lambda x: self.postProcessNewData(x, noDisplay=True))
+            self.downloadWorker.signals.returnImportedData.connect(self.postProcessImportedData)
+            self.downloadWorker.signals.datasetStatus.connect(self.updateDownloadStatus)
+            self.downloadWorker.signals.finished.connect(self.downloadFinished)
+            self.threadPool.start(self.downloadWorker)
         except Exception as E:
             loggingAndErrors.showErrorMessage(self, 'Could not download data: {0}'.format(E))
             self.dataTab.downloadButton.setEnabled(True)
             self.dataTab.downloadProgressBar.hide()
+            self.dataTab.cancelDownloadButton.hide()
+
 
+        return
+
+
+    def downloadStartDates(self, porT1):
+        """
+        Returns the date that each dataset's download should start on (see refreshPipeline.downloadStartDates). 
+        The 'Full re-sync' box downloads the whole period of record.
+
+        Input:
+            porT1 -> the start of the period of record
+        
+        Output:
+            startDates -> pd.Series of start dates indexed by DatasetInternalID
+        """
+        return refreshPipeline.downloadStartDates(self.datasetTable, self.dataStore, self.userOptionsConfig['DATA TAB'], porT1, self.dataTab.fullResyncCheck.isChecked())
+
+
+    def cancelDownload(self):
+        """
+        Cancels the running download. The datasets that have already downloaded are kept.
+        """
+        if self.downloadWorker is not None:
+            self.dataTab.cancelDownloadButton.setEnabled(False)
+            self.downloadWorker.cancel()
+
+        return
+
+
+    @QtCore.pyqtSlot(object)
+    def updateDownloadStatus(self, event):
+        """
+        Keeps track of each dataset's download status, and summarizes it in the progress bar's tooltip
+        """
+        self.downloadStatus[event['DatasetInternalID']] = event
+        statuses = pd.Series([e['status'] for e in self.downloadStatus.values()])
+        megabytes = sum(e['bytes']/e['jobSize'] for e in self.downloadStatus.values())/1e6
+        self.dataTab.downloadProgressBar.setToolTip(', '.join('{0} {1}'.format(count, status) for status, count in statuses.value_counts().items()) + ' ({0:.1f} MB)'.format(megabytes))
 
         return
 
@@ -123,13 +188,31 @@ class dataTab(object):
         Hide the progress bar after the data finishes downloading
         """
         self.dataTab.downloadProgressBar.hide()
+        self.dataTab.cancelDownloadButton.hide()
         self.dataTab.downloadButton.setEnabled(True)
+        self.downloadWorker = None
+
+        # The data streamed in one dataset at a time without being displayed. Display it now that it's all here.
+        self.displayDataInTable()
+
+        # Record a full download of the period of record, unless it was cancelled or some datasets didn't download
+        if self.fullDownloadStart is not None and all(event['status'] == 'done' for event in self.downloadStatus.values()):
+            refreshPipeline.recordFullDownload(self.userOptionsConfig['DATA TAB'], self.fullDownloadStart)
+        self.fullDownloadStart = None
+
+        # Tell the user which datasets couldn't be downloaded (or imported)
+        failed = [event for event in self.downloadStatus.values() if event['status'] in ['failed', 'timed out']]
+        if failed != []:
+            messages = ['{0} ({1}): {2}'.format(self.datasetTable.loc[event['DatasetInternalID'], 'DatasetName'], event['DatasetInternalID'], event['error'] if event['error'] is not None else event['status']) for event in failed]
+            if len(messages) > MAX_LISTED_FAILURES:
+                messages = messages[:MAX_LISTED_FAILURES] + ['... and {0} more'.format(len(messages) - MAX_LISTED_FAILURES)]
+            loggingAndErrors.showErrorMessage(self, "We could not update {0} dataset(s):\n\n{1}".format(len(failed), '\n'.join(messages)))
 
         return
 
 
     @QtCore.pyqtSlot(object)
-    def setDataForImportedDataset(self, data, id_ = -1, composite=False):
+    def setDataForImportedDataset(self, data, id_ = -1):
         """
         Stores the data from the imported dataset into the dataTable.
         """
@@ -138,81 +221,52 @@ class dataTab(object):
         data.columns =['Value']
         data.set_index([data.index, pd.Index(len(data)*[id_])], inplace=True)
         data.index.names = ['Datetime','DatasetInternalID']
-        self.postProcessNewData(data, composite)
+        self.postProcessNewData(data)
         return
 
-    def postProcessNewData(self, newDataTable, recursionFlag = False, noPlot = False):
+    def postProcessNewData(self, newDataTable, noPlot = False, noDisplay = False):
         """
         This function gets the raw downloaded data from the downloadData function and merges it with the existing dataset, updating any outdated 
-        values, and detecting any merge conflicts.
+        values, and detecting any merge conflicts. Returns the ChangeSet of the cells that changed.
         """
 
-        # Don't bother with empty datatables
-        if newDataTable.empty:
-            return
-
-        # First create a merged dataTable
-        merged = pd.merge(left=self.dataTable, right=newDataTable, on=['Datetime','DatasetInternalID'], suffixes=('_old','_new'), indicator=True, how='outer')
-        
-        # Filter to only get the changed data
-        merged = merged[merged.Value_old != merged.Value_new]
-
-        # Add brand new data to the datatable
-        newValues = pd.DataFrame(merged[(np.isnan(merged['Value_old'])) & (merged['_merge'] == 'right_only')][['Value_new', 'EditFlag']])
-        newValues.columns = ['Value', 'EditFlag']
-        newValues['EditFlag'] = [False] * len(newValues)
-        self.dataTable = self.dataTable.append(newValues)
-        self.dataTable = self.dataTable[~self.dataTable.index.duplicated(keep='last')]
-
-        # Figure out which values are updated and don't need to be validated by the user
-        updatedValuesNew = pd.DataFrame(merged[(merged['_merge'] == 'both') & (merged['Value_new'] != merged['Value_old']) & (merged['EditFlag'] == False)][['Value_new', 'EditFlag']])
-        updatedValuesNew.columns = ['Value', 'EditFlag']
-        self.dataTable = self.dataTable.append(updatedValuesNew)
-        self.dataTable = self.dataTable[~self.dataTable.index.duplicated(keep='last')]
+        # Merge the new data into the data store, and recompute the composite datasets built on the changed data
+        nanHandling = self.userOptionsConfig['DATA TAB'].get('composite_nan_handling', 'propagate')
+        changes, skipped = refreshPipeline.mergeNewData(self.dataStore, self.compositeGraph, self.datasetTable, newDataTable, nanHandling, self.resampleCache)
 
         # find the updated values that are replacing unedited original data
-        #updatedValuesNew_need_validation = pd.DataFrame(merged[(merged['_merge'] == 'both') & (merged['Value_new'] != merged['Value_old']) & (merged['EditFlag'] == True)][['Value_old', 'Value_new', 'EditFlag']])
         #if loggingAndErrors.displayDialog("We've downloaded data that conflicts with your edited data. Would you like to review the conflicts? If not, we'll overwrite your edits with the new data."):
-            # self.conflictReviewDialog = conflictReviewDialog(df=updatedValuesNew_need_validation, datasets = self.datasetTable)
+            # self.conflictReviewDialog = conflictReviewDialog(df=changes.conflicts(), datasets = self.datasetTable)
             # This part still needs work. Theres a lot of moving parts with checkboxes/etc. 
 
-        #TEMPORARY
-        updatedValuesNew_need_validation = pd.DataFrame(merged[(merged['_merge'] == 'both') & (merged['Value_new'] != merged['Value_old']) & (merged['EditFlag'] == True)][['Value_new', 'EditFlag']])
-        updatedValuesNew_need_validation.columns = ['Value', 'EditFlag']
-        self.dataTable = self.dataTable.append(updatedValuesNew_need_validation)
-        self.dataTable = self.dataTable[~self.dataTable.index.duplicated(keep='last')]
-
-        # Update any composite datasets
-        # Regenerate any composite datasets (assuming the original datasets still exist)
-        if not recursionFlag:
-            for i, dataset in self.datasetTable.iterrows():
-                if dataset['DatasetDataloader'] == 'COMPOSITE':
-                    combinationString = dataset['DatasetAdditionalOptions']['CompositeString']
-                    reliesOn = [int(j) for j in combinationString.split('/')[1].split(',')]
-                    if np.all([j in list(self.datasetTable.index) for j in reliesOn]):
-
-                        null, df = DataProcessor.combinedDataSet(self.dataTable, self.datasetTable, combinationString, newDatasetMetaData = {})
-                        df.columns =['Value']
-                        df.set_index([df.index, pd.Index(len(df)*[i])], inplace=True)
-                        df.index.names = ['Datetime', 'DatasetInternalID']
-                        self.postProcessNewData(df, True)
-                        return
-
-                    else:
-                        loggingAndErrors.showErrorMessage(self, "Composite dataset {0} ({1}) relies on a dataset that no longer exists. We did not update this dataset.".format(dataset['DatasetName'], dataset.name))
-
-        self.displayDataInTable(noPlot)
+        for compositeID, reason in skipped.items():
+            loggingAndErrors.showErrorMessage(self, "We did not update composite dataset {0} ({1}) because {2}.".format(self.datasetTable.loc[compositeID, 'DatasetName'], compositeID, reason))
 
-        return
+        if not noDisplay:
+            self.displayDataInTable(noPlot)
+
+        return changes
 
     
+    @QtCore.pyqtSlot(object, object)
+    def postProcessImportedData(self, newDataTable, fingerprints):
+        """
+        Merges the data re-read from imported files, then records which version of each file it came from
+        (so unchanged files are skipped next time). If the merge fails, the files are read again next time.
+        """
+        self.postProcessNewData(newDataTable, noDisplay = True)
+        refreshPipeline.recordImportFingerprints(self.datasetTable, fingerprints)
+
+        return
+
+
     def displayDataInTable(self, noPlot=False):
         """
         This function takes the dataTable and converts it into a spreadsheet-like datatable. 
         """
-        if self.dataTable.empty:
+        if self.dataStore.empty:
             return
-        self.dataTab.table.model().initialize_model_with_dataset(self.dataTable, self.datasetTable)
+        self.dataTab.table.model().initialize_model_with_dataset(self.dataStore, self.datasetTable)
         self.dataTab.table.horizontalHeader().sectionClicked.connect(lambda x: self.plotClickedColumns())
         self.dataTab.table.model().changedDataSignal.connect(self.userChangedData)
         if not noPlot:
@@ -228,29 +282,27 @@ class dataTab(object):
 
         dataChanges: list of changed data, i.e [date, columnName, oldValue, newValue]
         """
-        self.dataTable.loc[(dataChanges[0], dataChanges[1])] = (dataChanges[3], True)
+        date, datasetID, oldValue, newValue = dataChanges
+        self.dataStore.setValue(date, datasetID, newValue, True)
         
-        if dataChanges[2] == dataChanges[3]:
+        if oldValue == newValue:
             return
 
-        changed_cols = [dataChanges[1]]
-
-        # Update any composite datasets that are based on this data
-        for i, dataset in self.datasetTable.iterrows():
-            if dataset['DatasetDataloader'] == 'COMPOSITE':
-                combinationString = dataset['DatasetAdditionalOptions']['CompositeString']
-                reliesOn = [int(j) for j in combinationString.split('/')[1].split(',')]
-                if dataChanges[1] in reliesOn:
-                    if np.all([j in list(self.datasetTable.index) for j in reliesOn]):
-                        newDataValue = DataProcessor.updateSingleComputedValue(self.dataTable, combinationString, dataChanges[0])
-                        self.dataTable.loc[(dataChanges[0], dataset.name), 'Value'] = newDataValue
-                        changed_cols.append(dataset.name)
-                        
-
-        self.plotClickedColumns(displayColumns=self.currentlyPlottedColumns, changed_col=changed_cols)
-
-        
-                        
+        # Push the edit through to every composite cell built on this one, using the composite graph's reverse index
+        self.compositeGraph.update(self.datasetTable)
+        nanHandling = self.userOptionsConfig['DATA TAB'].get('composite_nan_handling', 'propagate')
+        changedCells = [(datasetID, date, newValue)] + DataProcessor.updateCompositeCells(self.dataStore, self.compositeGraph, datasetID, date, oldValue, newValue, nanHandling)
+
+        # Invalidate the resampled data once, with each dataset's changed date range
+        changedRanges = {}
+        for ID, cellDate, value in changedCells:
+            firstDate, lastDate = changedRanges.get(ID, (cellDate, cellDate))
+            changedRanges[ID] = (min(firstDate, cellDate), max(lastDate, cellDate))
+        self.resampleCache.bumpDataVersion(list(changedRanges), changedRanges)
+
+        # Redraw only the changed points of the plotted curves (replot if they can't be updated in place)
+        if not self.dataTab.dataPlot.update_plotted_values(changedCells):
+            self.plotClickedColumns(displayColumns=self.currentlyPlottedColumns, changed_col=list(set(cell[0] for cell in changedCells)))
 
         # NOTE, NEED TO UPDATE ANY FORECASTS BASED ON THIS DATA
 
@@ -0,0 +1,208 @@
+"""
+Script name:    dataloaderRegistry.py
+Description:    The dataloaderRegistry.py script keeps track of the dataloaders in resources/DataLoaders
+                (and resources/DataLoaders/CustomDataLoaders). The dataloader files are scanned without
+                importing them: each file's source is parsed (ast) for its dataLoader docstring (the
+                description and DEFAULT OPTIONS), the dataset fields it reads, and what it can do:
+
+                    batchable   -> it defines batchDataLoader (see downloadExecutor.py)
+                    async       -> its dataLoader is a coroutine (it runs on the HTTP engine's event loop)
+                    executor    -> its module level EXECUTOR ('thread' or 'process')
+                    incremental -> its module level INCREMENTAL (default True). False means the
+                                   dataloader's source files always hold the whole record (e.g.
+                                   CPC, PDSI), so incremental downloads start it at the period
+                                   of record start (see refreshPipeline.downloadStartDates).
+
+                The dataset fields each dataloader reads are listed too ('fields'), so the dataset
+                dialog can ask for them before trying the dataloader.
+
+                The scan results are kept in an index file (resources/temp/dataloaderIndex.json), and
+                a file is only parsed again when its modification time or size changes. Modules are
+                imported the first time a dataloader is actually run (load()), so listing the
+                dataloaders or showing their options doesn't import them (or what they import, like zeep).
+"""
+
+import ast
+import importlib
+import json
+import os
+import threading
+
+# Where the dataloaders are, and the package they're imported from
+DATALOADER_DIRECTORIES = [
+    ('resources/DataLoaders',                   'resources.DataLoaders'),
+    ('resources/DataLoaders/CustomDataLoaders', 'resources.DataLoaders.CustomDataLoaders')]
+
+# The scanned dataloaders (see scanDataloader)
+INDEX_FILE = 'resources/temp/dataloaderIndex.json'
+
+# Bump when the scanned fields change, so old index files are re-scanned
+INDEX_VERSION = 3
+
+DEFAULT_EXECUTOR = 'thread'
+
+# Scanned dataloaders (name -> info), once per process
+registryLock = threading.Lock()
+registry = None
+
+
+def scanDataloader(fileName, moduleName):
+    """
+    Reads a dataloader's information from its source code (without importing it)
+
+    Input:
+        fileName -> the dataloader's .py file
+        moduleName -> the module to import it as
+
+    Output:
+        info -> dict with the dataloader's 'module', 'description', 'defaultOptions' (list of
+                [option, value]), 'fields' (the dataset fields it reads), 'batchable', 'async',
+                'executor' and 'incremental'
+    """
+    with open(fileName, 'r', encoding = 'utf-8') as readFile:
+        tree = ast.parse(readFile.read(), fileName)
+
+    functions = {node.name: node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))}
+    if 'dataLoader' not in functions:
+        raise ValueError("{0} doesn't define a dataLoader function".format(fileName))
+
+    # Module level constants (EXECUTOR = 'process', INCREMENTAL = False)
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    constants[target.id] = node.value.value
+
+    # The docstring has the description, then the options after 'DEFAULT OPTIONS'
+    docstring = ast.get_docstring(functions['dataLoader'], clean = False) or ''
+    description, _, options = docstring.partition('DEFAULT OPTIONS')
+    defaultOptions = []
+    for option in options.splitlines():
+        if ':' in option:
+            key, value = option.split(':', 1)
+            defaultOptions.append([key.strip(), value.strip()])
+
+    # Dataset fields the dataloader reads (e.g. stationDict['DatasetExternalID'])
+    fields = [option for option, value in defaultOptions]
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+            if node.slice.value.startswith('Dataset') and node.slice.value not in fields:
+                fields.append(node.slice.value)
+
+    return {
+        'module':           moduleName,
+        'description':      description.replace('\n', ''),
+        'defaultOptions':   defaultOptions,
+        'fields':           fields,
+        'batchable':        'batchDataLoader' in functions,
+        'async':            isinstance(functions['dataLoader'], ast.AsyncFunctionDef),
+        'executor':         constants.get('EXECUTOR', DEFAULT_EXECUTOR),
+        'incremental':      bool(constants.get('INCREMENTAL', True))}
+
+
+def readIndex():
+    """
+    Returns the saved index ({} if there isn't one, or it's out of date)
+    """
+    try:
+        with open(INDEX_FILE, 'r') as readFile:
+            index = json.load(readFile)
+        return index['dataloaders'] if index.get('version') == INDEX_VERSION else {}
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def writeIndex(dataloaders):
+    """
+    Saves the index. It's only a cache, so failing to write it isn't an error.
+    """
+    try:
+        temporaryFile = '{0}.{1}.tmp'.format(INDEX_FILE, os.getpid())
+        with open(temporaryFile, 'w') as writeFile:
+            json.dump({'version': INDEX_VERSION, 'dataloaders': dataloaders}, writeFile, indent = 1)
+        os.replace(temporaryFile, INDEX_FILE)
+    except OSError:
+        pass
+
+    return
+
+
+def scan():
+    """
+    Finds the dataloaders, re-scanning the files that changed since the index was saved
+
+    Output:
+        dataloaders -> dict of dataloader name -> info (see scanDataloader, plus the file's 'mtime' and
+                       'size', and 'error' for files that couldn't be scanned). Default dataloaders take
+                       precedence over custom dataloaders with the same name.
+    """
+    index = readIndex()
+    dataloaders = {}
+    for directory, package in DATALOADER_DIRECTORIES:
+        if not os.path.isdir(directory):
+            continue
+        for fileName in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(fileName)
+            if extension != '.py' or name.startswith('_') or name in dataloaders:
+                continue
+            fileName = os.path.join(directory, fileName)
+            fileStat = os.stat(fileName)
+            moduleName = package + '.' + name
+
+            # Unchanged files keep their scanned information
+            info = index.get(name)
+            if info is None or info.get('module') != moduleName or info.get('mtime') != fileStat.st_mtime or info.get('size') != fileStat.st_size:
+                try:
+                    info = scanDataloader(fileName, moduleName)
+                except (SyntaxError, ValueError, UnicodeDecodeError) as E:
+                    info = {'module': moduleName, 'error': str(E)}
+                info.update(mtime = fileStat.st_mtime, size = fileStat.st_size)
+            dataloaders[name] = info
+
+    if dataloaders != index:
+        writeIndex(dataloaders)
+
+    return dataloaders
+
+
+def getRegistry(refresh = False):
+    """
+    Returns the scanned dataloaders. The dataloader files are scanned once per process (or again
+    if refresh is True, e.g. after a custom dataloader is added).
+    """
+    global registry
+    with registryLock:
+        if registry is None or refresh:
+            registry = scan()
+        return registry
+
+
+def names():
+    """
+    Returns the names of the dataloaders that can be used (in file order)
+    """
+    return [name for name, info in getRegistry().items() if 'error' not in info]
+
+
+def dataloaderInfo(dataloader):
+    """
+    Returns a dataloader's scanned information (see scanDataloader). Raises a KeyError for unknown
+    dataloaders and a ValueError for dataloaders that couldn't be scanned.
+    """
+    dataloaders = getRegistry()
+    if dataloader not in dataloaders:
+        dataloaders = getRegistry(refresh = True)
+    if dataloader not in dataloaders:
+        raise KeyError("There is no dataloader called '{0}'".format(dataloader))
+    if 'error' in dataloaders[dataloader]:
+        raise ValueError("The '{0}' dataloader could not be read: {1}".format(dataloader, dataloaders[dataloader]['error']))
+
+    return dataloaders[dataloader]
+
+
+def load(dataloader):
+    """
+    Returns the dataloader module (e.g. 'USGS_NWIS'), importing it the first time it's used
+    """
+    return importlib.import_module(dataloaderInfo(dataloader)['module'])
@@ -1,12 +1,5 @@
 from PyQt5 import QtCore, QtWidgets
-from resources.modules.Miscellaneous.DataProcessor import combinedDataSet
-import json
-import pandas as pd
-import numpy as np
-import importlib
-from datetime import datetime, timedelta
-import multiprocessing as mp
-import sys
+from resources.modules.DataTab import downloadExecutor, refreshPipeline
 
 # Data Table Reference
 # self.dataTable = pd.DataFrame(
@@ -26,18 +19,21 @@ class alternateThreadWorkerSignals(QtCore.QObject):
     updateProgBar = QtCore.pyqtSignal(int) # Signal to update the progress bar on the data tab
     finished = QtCore.pyqtSignal(bool) # Signal to tell the parent thread that the worker is done
     returnNewData = QtCore.pyqtSignal(object) # returns the new data dataframe back to the main thread
+    returnImportedData = QtCore.pyqtSignal(object, object) # returns the imported data and the fingerprints of the files it was read from
+    datasetStatus = QtCore.pyqtSignal(object) # a dataset's status event (queued, done, failed, ...) with its bytes and latency
 
 # Define the main alternate thread worker that will actually run the download algorithm
 class alternateThreadWorker(QtCore.QRunnable):
 
-    def __init__(self, datasets, startDate, endDate, existingDataTable = None):
+    def __init__(self, datasets, startDate, endDate, executor = None, fullResync = False):
         super(alternateThreadWorker, self).__init__()
 
-        # Load argument
+        # Load argument. The startDate is either one date or a Series of start dates by DatasetInternalID.
         self.datasets = datasets
         self.startDate = startDate
         self.endDate = endDate
-        self.existingDataTable = existingDataTable
+        self.downloadExecutor = executor if executor is not None else downloadExecutor.DownloadExecutor()
+        self.fullResync = fullResync
 
         # Get the total number of stations
         self.totalStations = len(self.datasets)
@@ -45,115 +41,39 @@ class alternateThreadWorker(QtCore.QRunnable):
         # Load the signals into the worker object
         self.signals = alternateThreadWorkerSignals()
 
-        # set up a dataframe to store all the new data
-        mi = pd.MultiIndex(levels=[[],[]], codes=[[],[]], names=['Datetime','DatasetInternalID'])
-        self.df = pd.DataFrame(index = mi, columns = ['Value'])
-
     @QtCore.pyqtSlot()
     def run(self):
 
         self.signals.updateProgBar.emit(0)
 
-        queue = mp.Queue()
-        processes = []
-        returned = []
-        compositeDatasets = []
-        importDatasets = []
-
-        for dataset in self.datasets.iterrows():
-            if dataset[1]['DatasetDataloader'] == 'COMPOSITE':
-                compositeDatasets.append(dataset)
-                continue
-            elif dataset[1]['DatasetDataloader'] == 'IMPORT':
-                importDatasets.append(dataset)
-                continue                
-
-            proc = mp.Process(target = worker, args = (queue, dataset[1], self.startDate, self.endDate))
-            processes.append(proc)
-            proc.start()
-
-        for i, proc in enumerate(processes):
-            returnValue = queue.get()
-            returned.append(returnValue)
-            progress = int(100*(i+1)/self.totalStations)
-            self.signals.updateProgBar.emit(progress)
-
-        for proc in processes:
-            proc.join()
-        
-        for returnValue in returned:
-            if returnValue.empty:
-                continue
-            self.df = pd.concat([self.df, returnValue])
-        
-        # Update any imported spreadsheets (assuming the file still exists)
-        for i, dataset in importDatasets:
-            fileName = dataset['DatasetAdditionalOptions']['Import Filename']
-            try:
-                if fileName[-4:] == '.csv':
-                    df = pd.read_csv(fileName, index_col=0, parse_dates=True)
-                elif '.xls' in fileName[-5:]:
-                    df = pd.read_excel(fileName, index_col=0, parse_dates=True)
-                
-                df.columns =['Value']
-                df.set_index([df.index, pd.Index(len(df)*[i])], inplace=True)
-                df.index.names = ['Datetime', 'DatasetInternalID']
-                self.df = pd.concat([self.df, df])
-                
-            except:
-                df = self.existingDataTable.loc[(slice(None), dataset.name), 'Value']
-                self.df = pd.concat([self.df, df])
-                continue
-
-        
-            
+        # Download the datasets on the download workers. Composite datasets are recomputed from their components 
+        # as the components' data is merged, and imported datasets are re-read from their files. Datasets that
+        # fail are reported through their status events.
+        newData, errors = refreshPipeline.downloadNewData(self.datasets, self.startDate, self.endDate, self.downloadExecutor,
+                                                          onProgress = lambda numFinished: self.signals.updateProgBar.emit(int(100*numFinished/self.totalStations)),
+                                                          onEvent = self.signals.datasetStatus.emit)
 
+        # Send the new data back to be merged in one go
+        if newData is not None:
+            self.signals.returnNewData.emit(newData)
         
-        self.df = self.df[~self.df.index.duplicated(keep='first')]
-        self.signals.returnNewData.emit(self.df)
+        # Update any imported spreadsheets that have changed (all of them on a full re-sync), unless the download was cancelled.
+        # The main thread stores the files' fingerprints in the datasets once it has merged their data.
+        importedData, fingerprints, errors = refreshPipeline.readImportedDatasets(self.datasets, self.downloadExecutor.cancelEvent.is_set, self.fullResync)
+        for datasetID, error in errors.items():
+            self.signals.datasetStatus.emit(downloadExecutor.DownloadJob([datasetID], False).event(datasetID, 'failed', error))
+        if importedData is not None:
+            self.signals.returnImportedData.emit(importedData, fingerprints)
+
+        self.signals.updateProgBar.emit(100)
         self.signals.finished.emit(True)
 
         return
 
+    def cancel(self):
+        """
+        Cancels the download (called from the main thread). The data that has already arrived is kept.
+        """
+        self.downloadExecutor.cancel()
 
-def worker(queue, dataset, startDate, endDate):
-    """
-    This multiprocessing worker retrieves data for a dataset
-    and stores it in a dataframe which it then appends to the 
-    multiprocessing queue. 
-    """
-
-    # Get the dataloader
-    dataloader = dataset['DatasetDataloader']
-    modName = "resources.DataLoaders." + dataloader
-
-    # Don't attempt to load imported data
-    if dataloader == 'IMPORT':
-        retval = pd.DataFrame()
-        queue.put(retval)
-        return
-    
-    # Load in the dataloader if it's not yet loaded
-    if modName not in sys.modules:
-        mod = importlib.import_module(modName)
-        dataGetFunction = getattr(mod, 'dataLoader')
-    else:
-        mod = sys.modules[modName]
-        dataGetFunction = getattr(mod, 'dataLoader')
-    
-    # use the dataloader to get the data
-    try:
-        data = dataGetFunction(dataset, startDate, endDate)
-        data.columns =['Value']
-        data.set_index([data.index, pd.Index(len(data)*[int(dataset.name)])], inplace=True)
-        data.index.names = ['Datetime','DatasetInternalID']
-
-    except:
-        retval = pd.DataFrame()
-        queue.put(retval)
         return
-    
-    # rput the dataframe into the queue
-    retval = data
-    queue.put(retval)
-    return
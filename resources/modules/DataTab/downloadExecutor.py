@@ -0,0 +1,497 @@
+"""
+Script name:    downloadExecutor.py
+Description:    The downloadExecutor.py script runs the dataloaders for a set of datasets on a
+                bounded pool of workers that stays alive between downloads. Most dataloaders spend
+                their time waiting on web services, so they run on the HTTP engine's event loop
+                (async dataloaders) or on a thread pool (synchronous ones). Dataloaders that
+                spend their time parsing can set EXECUTOR = 'process' at module level to run on a
+                (smaller) process pool instead. Which pool a dataloader runs on comes from the
+                dataloaderRegistry, so process-pool dataloaders are only imported by the workers.
+                Workers keep the dataloader modules they've imported loaded, so repeated refreshes
+                don't pay for the imports again.
+
+                Dataloaders for web services that take many stations per request can also define
+
+                    batchDataLoader(datasets, startDates, endDate)
+
+                which gets all of that dataloader's datasets at once and returns a dict of 
+                DatasetInternalID -> single column dataframe (the same dataframe dataLoader returns),
+                or the exception raised for that dataset.
+
+                Results come back as compact (dates, values) arrays. Process-pool workers hand them
+                over in shared memory, and combineResults builds one dataTable from all of them.
+
+                Each call to download() is a download session. Dataloaders can share downloaded source
+                files between the datasets in a session with sessionArtifacts.getArtifact.
+
+                A download can be cancelled (cancel()) from another thread, and a job that runs longer
+                than the executor's job timeout is given up on, so one slow agency can't hold up the
+                rest of a refresh. download() reports each dataset's status, bytes downloaded and
+                latency through its onEvent callback.
+"""
+
+import concurrent.futures
+import threading
+import time
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import pandas as pd
+from resources.modules.DataTab import dataloaderRegistry, httpEngine, sessionArtifacts
+
+# How long (seconds) a download job can run before it's given up on, and how often download() 
+# checks for cancelled and overdue jobs
+JOB_TIMEOUT = 600
+POLL_INTERVAL = 0.25
+
+
+def loadDataloader(dataloader):
+    """
+    Returns the dataloader module (e.g. 'USGS_NWIS'). Modules are only imported once per process.
+    """
+    return dataloaderRegistry.load(dataloader)
+
+
+def downloadDataset(dataset, startDate, endDate, sessionID = None):
+    """
+    Downloads the data for one dataset with its dataloader. This runs on a worker process, so the
+    data goes back to the main process through shared memory.
+
+    Input:
+        dataset -> the dataset's row in the datasetTable
+        startDate, endDate -> the period to download
+        sessionID -> the download session (source files are shared within a session)
+
+    Output:
+        sharedResults -> see toSharedMemory
+        stats -> the job's httpEngine.RequestStats
+    """
+    sessionArtifacts.useSession(sessionID)
+    stats = httpEngine.RequestStats()
+    httpEngine.requestStats.set(stats)
+    dataGetFunction = httpEngine.syncDataLoader(loadDataloader(dataset['DatasetDataloader']))
+
+    return toSharedMemory({dataset.name: compactData(dataGetFunction(dataset, startDate, endDate))}), stats
+
+
+async def downloadDatasetAsync(dataset, startDate, endDate, executor = None, sessionID = None, stats = None):
+    """
+    Downloads the data for one dataset on the HTTP engine's event loop. Async dataloaders run on the loop,
+    synchronous ones run on the executor. The dataset's requests are counted in stats.
+
+    Output:
+        results -> {DatasetInternalID: (dates, values)}
+    """
+    sessionArtifacts.useSession(sessionID)
+    httpEngine.requestStats.set(stats)
+    dataGetFunction = httpEngine.asyncDataLoader(loadDataloader(dataset['DatasetDataloader']), executor)
+
+    return {dataset.name: compactData(await dataGetFunction(dataset, startDate, endDate))}
+
+
+def downloadBatch(datasets, startDates, endDate, sessionID = None):
+    """
+    Downloads the data for a group of datasets that share a dataloader with its batchDataLoader. 
+    This runs on a worker process.
+
+    Input:
+        datasets -> the datasets' rows in the datasetTable
+        startDates -> pd.Series of start dates indexed by DatasetInternalID
+        endDate -> the last date to download
+        sessionID -> the download session
+
+    Output:
+        sharedResults -> see toSharedMemory
+        stats -> the job's httpEngine.RequestStats
+    """
+    sessionArtifacts.useSession(sessionID)
+    stats = httpEngine.RequestStats()
+    httpEngine.requestStats.set(stats)
+    batchGetFunction = httpEngine.syncDataLoader(loadDataloader(datasets['DatasetDataloader'].iloc[0]), 'batchDataLoader')
+
+    return toSharedMemory(compactBatch(batchGetFunction(datasets, startDates, endDate), datasets)), stats
+
+
+async def downloadBatchAsync(datasets, startDates, endDate, executor = None, sessionID = None, stats = None):
+    """
+    Downloads the data for a group of datasets on the HTTP engine's event loop
+
+    Output:
+        results -> dict of DatasetInternalID -> (dates, values) (or the exception if that dataset failed)
+    """
+    sessionArtifacts.useSession(sessionID)
+    httpEngine.requestStats.set(stats)
+    batchGetFunction = httpEngine.asyncDataLoader(loadDataloader(datasets['DatasetDataloader'].iloc[0]), executor, 'batchDataLoader')
+
+    return compactBatch(await batchGetFunction(datasets, startDates, endDate), datasets)
+
+
+def compactBatch(frames, datasets):
+    """
+    Converts a batchDataLoader's dataframes into (dates, values) arrays. Datasets that the dataloader didn't 
+    return data for get a LookupError. The dataloader can also return an exception for a dataset that failed.
+    """
+    results = {}
+    for datasetID in datasets.index:
+        try:
+            if isinstance(frames[datasetID], Exception):
+                results[datasetID] = frames[datasetID]
+                continue
+            results[datasetID] = compactData(frames[datasetID])
+        except KeyError:
+            results[datasetID] = LookupError("The dataloader didn't return any data for this dataset")
+        except Exception as E:
+            results[datasetID] = E
+
+    return results
+
+
+def compactData(data):
+    """
+    Converts a dataloader's single column dataframe into a compact pair of arrays. Rows without a date are 
+    dropped and the first of any duplicated dates is kept.
+
+    Output:
+        dates -> datetime64[D] array
+        values -> float64 array
+    """
+    if not isinstance(data, pd.DataFrame) or len(data.columns) == 0:
+        raise ValueError("The dataloader didn't return any data")
+
+    dates = pd.DatetimeIndex(data.index)
+    values = pd.to_numeric(data.iloc[:, 0], errors='coerce').to_numpy(dtype=np.float64)
+    keep = ~dates.isna() & ~dates.duplicated(keep='first')
+
+    return dates[keep].values.astype('datetime64[D]'), values[keep]
+
+
+def toSharedMemory(results):
+    """
+    Packs the (dates, values) arrays for a set of datasets into one shared memory block, so that 
+    a worker process can hand them to the main process without pickling them. The main process
+    unpacks them with fromSharedMemory, which also frees the block.
+
+    Input:
+        results -> dict of DatasetInternalID -> (dates, values) (or an exception)
+
+    Output:
+        sharedResults -> (block name, {DatasetInternalID: (offset, length)}, {DatasetInternalID: exception})
+    """
+    layout = {}
+    errors = {}
+    offset = 0
+    for datasetID, result in results.items():
+        if isinstance(result, Exception):
+            errors[datasetID] = result
+        else:
+            layout[datasetID] = (offset, len(result[0]))
+            offset += len(result[0])
+
+    # The block holds every dataset's dates (as int64 days) followed by every dataset's values
+    block = shared_memory.SharedMemory(create = True, size = max(1, 16*offset))
+    try:
+        dates = np.ndarray((offset,), dtype=np.int64, buffer=block.buf)
+        values = np.ndarray((offset,), dtype=np.float64, buffer=block.buf, offset=8*offset)
+        for datasetID, (start, length) in layout.items():
+            dates[start:start + length] = results[datasetID][0].view(np.int64)
+            values[start:start + length] = results[datasetID][1]
+        del dates, values
+    finally:
+        block.close()
+
+    # The main process frees the block, so this process's resource tracker shouldn't try to
+    resource_tracker.unregister(block._name, 'shared_memory')
+
+    return block.name, layout, errors
+
+
+def fromSharedMemory(sharedResults):
+    """
+    Copies the arrays out of a worker's shared memory block, and frees the block
+
+    Output:
+        results -> dict of DatasetInternalID -> (dates, values) (or the exception if that dataset failed)
+    """
+    name, layout, errors = sharedResults
+    block = shared_memory.SharedMemory(name = name)
+    try:
+        total = sum(length for offset, length in layout.values())
+        dates = np.ndarray((total,), dtype=np.int64, buffer=block.buf)
+        values = np.ndarray((total,), dtype=np.float64, buffer=block.buf, offset=8*total)
+        results = {datasetID: (dates[start:start + length].astype('datetime64[D]'), values[start:start + length].copy()) for datasetID, (start, length) in layout.items()}
+        del dates, values
+    finally:
+        block.close()
+        block.unlink()
+    results.update(errors)
+
+    return results
+
+
+def discardSharedResults(future):
+    """
+    Frees the shared memory block of a process-pool job that was given up on, once the job finishes
+    """
+    if not future.cancelled() and future.exception() is None:
+        fromSharedMemory(future.result()[0])
+
+    return
+
+
+def combineResults(results):
+    """
+    Builds one long (Datetime, DatasetInternalID) dataframe with a 'Value' column from every dataset's
+    arrays. The combined arrays are allocated once, at their final size.
+
+    Input:
+        results -> list of (DatasetInternalID, dates, values)
+    """
+    total = sum(len(dates) for datasetID, dates, values in results)
+    allDates = np.empty(total, dtype='datetime64[D]')
+    allIDs = np.empty(total, dtype=np.int64)
+    allValues = np.empty(total, dtype=np.float64)
+
+    start = 0
+    for datasetID, dates, values in results:
+        allDates[start:start + len(dates)] = dates
+        allIDs[start:start + len(dates)] = int(datasetID)
+        allValues[start:start + len(dates)] = values
+        start += len(dates)
+
+    index = pd.MultiIndex.from_arrays([pd.DatetimeIndex(allDates.astype('datetime64[ns]')), allIDs], names=['Datetime','DatasetInternalID'])
+
+    return pd.DataFrame({'Value': allValues}, index=index)
+
+
+class DownloadJob(object):
+    """
+    A download job (one dataset, or a batch of datasets) that download() is waiting on
+    """
+
+    def __init__(self, datasetIDs, shared, stats = None):
+        self.datasetIDs = datasetIDs
+        self.shared = shared # The results come back through shared memory
+        self.stats = stats if stats is not None else httpEngine.RequestStats()
+        self.started = None # When the job started running (not when it was queued)
+
+    def checkStarted(self, future):
+        """
+        Notes when the job starts running. Jobs on the HTTP engine mark their RequestStats when their
+        dataloader starts (httpEngine.startJob). Process pool jobs count from when their future is
+        first seen running.
+        """
+        if self.started is None:
+            if self.shared:
+                self.started = time.monotonic() if future.running() or future.done() else None
+            else:
+                self.started = self.stats.started
+
+        return
+
+    def event(self, datasetID, status, error = None):
+        """
+        Returns a status event for one of the job's datasets. 'bytes', 'requests' and 'retries' are for
+        the whole job (a batch job downloads all of its datasets together), and 'seconds' is the time
+        since the job started running (0 if it hasn't started).
+        """
+        return {
+            'DatasetInternalID':    datasetID,
+            'status':               status,
+            'bytes':                self.stats.bytes,
+            'requests':             self.stats.requests,
+            'retries':              self.stats.retries,
+            'seconds':              time.monotonic() - self.started if self.started is not None else 0.0,
+            'jobSize':              len(self.datasetIDs),
+            'error':                error}
+
+
+class DownloadExecutor(object):
+    """
+    A reusable, bounded set of download workers. The pools are created the first time they're
+    needed and are kept until shutdown() (or until the worker counts change).
+    """
+
+    def __init__(self, numThreads = 8, numProcesses = 2, jobTimeout = JOB_TIMEOUT):
+        self.numThreads = max(1, int(numThreads))
+        self.numProcesses = max(1, int(numProcesses))
+        self.jobTimeout = float(jobTimeout)
+        self.threadPool = None
+        self.processPool = None
+        self.poolLock = threading.Lock()
+        self.cancelEvent = threading.Event()
+
+    def executorFor(self, dataloader):
+        """
+        Returns the pool that a dataloader should run on
+        """
+        onProcessPool = dataloaderRegistry.dataloaderInfo(dataloader)['executor'] == 'process'
+        with self.poolLock:
+            if onProcessPool:
+                if self.processPool is None:
+                    self.processPool = concurrent.futures.ProcessPoolExecutor(max_workers = self.numProcesses, initializer = httpEngine.configureWorker, initargs = (dict(httpEngine.CACHE_SETTINGS), dict(httpEngine.HOST_OVERRIDES)))
+                return self.processPool
+
+            if self.threadPool is None:
+                self.threadPool = concurrent.futures.ThreadPoolExecutor(max_workers = self.numThreads, thread_name_prefix = 'download')
+            return self.threadPool
+
+    def download(self, datasets, startDate, endDate, onEvent = None, sessionID = None):
+        """
+        Downloads the data for every dataset and yields the results as each dataset finishes.
+
+        Input:
+            datasets -> datasetTable rows to download
+            startDate -> the first date to download. Either one date for every dataset, or a
+                         pd.Series of dates indexed by DatasetInternalID (incremental downloads)
+            endDate -> the last date to download
+            onEvent -> optional function called with a status event (see DownloadJob.event) when each 
+                       dataset is queued ('queued') and when it finishes ('done', 'failed', 'timed out'
+                       or 'cancelled'). It's called on the thread iterating over download().
+            sessionID -> optional download session. Downloads that run together (e.g. several forecast 
+                         files being refreshed at once) can pass the same session to share source files.
+                         By default each download is its own session.
+
+        Output (yielded, one per dataset):
+            datasetID -> the DatasetInternalID
+            data -> (dates, values) arrays with the new data (None if the download failed). 
+                    combineResults makes them into a dataTable.
+            error -> the exception raised by the download (None if it succeeded)
+        """
+        if not isinstance(startDate, pd.Series):
+            startDate = pd.Series(startDate, index = datasets.index)
+        onEvent = onEvent if onEvent is not None else (lambda event: None)
+        self.cancelEvent.clear()
+
+        # Source files that several datasets use are downloaded once per session
+        sessionID = sessionID if sessionID is not None else uuid.uuid4().hex
+
+        jobs = {} # future -> DownloadJob
+        for dataloader, group in datasets.groupby('DatasetDataloader', sort = False, dropna = False):
+            try:
+                info = dataloaderRegistry.dataloaderInfo(dataloader)
+                executor = self.executorFor(dataloader)
+                if executor is not self.processPool:
+                    loadDataloader(dataloader) # Import it here (once) rather than on the event loop
+            except Exception as E:
+                for datasetID in group.index:
+                    onEvent(DownloadJob([datasetID], False).event(datasetID, 'failed', E))
+                    yield datasetID, None, E
+                continue
+            onProcessPool = executor is self.processPool
+
+            # Dataloaders that can download many datasets at once get the whole group in one job
+            if info['batchable']:
+                startDates = startDate[group.index]
+                job = DownloadJob(list(group.index), onProcessPool)
+                if onProcessPool:
+                    future = executor.submit(downloadBatch, group, startDates, endDate, sessionID)
+                else:
+                    future = httpEngine.getEngine().submit(downloadBatchAsync(group, startDates, endDate, executor, sessionID, job.stats))
+                jobs[future] = job
+                continue
+
+            # Everything except process-pool loaders runs through the HTTP engine (sync loaders on the thread pool)
+            for datasetID, dataset in group.iterrows():
+                job = DownloadJob([datasetID], onProcessPool)
+                if onProcessPool:
+                    future = executor.submit(downloadDataset, dataset, startDate[datasetID], endDate, sessionID)
+                else:
+                    future = httpEngine.getEngine().submit(downloadDatasetAsync(dataset, startDate[datasetID], endDate, executor, sessionID, job.stats))
+                jobs[future] = job
+
+        for job in jobs.values():
+            for datasetID in job.datasetIDs:
+                onEvent(job.event(datasetID, 'queued'))
+
+        pending = set(jobs)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout = POLL_INTERVAL, return_when = concurrent.futures.FIRST_COMPLETED)
+
+            # Collect the finished jobs
+            for future in done:
+                job = jobs[future]
+                job.checkStarted(future)
+                try:
+                    results = future.result()
+                    if job.shared:
+                        results, job.stats = results
+                        results = fromSharedMemory(results)
+                except Exception as E:
+                    results = {datasetID: E for datasetID in job.datasetIDs}
+
+                for datasetID in job.datasetIDs:
+                    if isinstance(results[datasetID], Exception):
+                        onEvent(job.event(datasetID, 'failed', results[datasetID]))
+                        yield datasetID, None, results[datasetID]
+                    else:
+                        onEvent(job.event(datasetID, 'done'))
+                        yield datasetID, results[datasetID], None
+
+            # Give up on the jobs that have been cancelled or have run too long (jobs still waiting for a worker can't time out)
+            cancelled = self.cancelEvent.is_set()
+            for future in pending:
+                jobs[future].checkStarted(future)
+            overdue = [future for future in pending if cancelled or (jobs[future].started is not None and time.monotonic() - jobs[future].started > self.jobTimeout)]
+            for future in overdue:
+                pending.discard(future)
+                job = jobs[future]
+                self.abandon(future, job)
+                if cancelled:
+                    status, error = 'cancelled', concurrent.futures.CancelledError("The download was cancelled")
+                else:
+                    status, error = 'timed out', TimeoutError("The download took longer than {0:.0f} seconds".format(self.jobTimeout))
+                for datasetID in job.datasetIDs:
+                    onEvent(job.event(datasetID, status, error))
+                    yield datasetID, None, error
+
+        return
+
+    def abandon(self, future, job):
+        """
+        Stops waiting for a job. Jobs on the event loop are cancelled where they are, and synchronous 
+        dataloaders stop at their next request (see httpEngine.RequestStats). A process-pool job that 
+        has already started runs to the end, and its shared memory is freed when it does.
+        """
+        job.stats.cancelled = True
+        future.cancel()
+        if job.shared:
+            future.add_done_callback(discardSharedResults)
+
+        return
+
+    def cancel(self):
+        """
+        Cancels the current download (from any thread). download() stops waiting for the datasets
+        that haven't finished and yields them with a CancelledError.
+        """
+        self.cancelEvent.set()
+
+        return
+
+    def setWorkerCounts(self, numThreads, numProcesses):
+        """
+        Changes the number of workers. Pools with a different size are shut down (after their
+        current work finishes) and recreated when next needed.
+        """
+        numThreads, numProcesses = max(1, int(numThreads)), max(1, int(numProcesses))
+        if numThreads != self.numThreads and self.threadPool is not None:
+            self.threadPool.shutdown(wait = False)
+            self.threadPool = None
+        if numProcesses != self.numProcesses and self.processPool is not None:
+            self.processPool.shutdown(wait = False)
+            self.processPool = None
+        self.numThreads, self.numProcesses = numThreads, numProcesses
+
+        return
+
+    def shutdown(self, wait = True):
+        """
+        Stops the workers
+        """
+        for pool in [self.threadPool, self.processPool]:
+            if pool is not None:
+                pool.shutdown(wait = wait)
+        self.threadPool = None
+        self.processPool = None
+
+        return
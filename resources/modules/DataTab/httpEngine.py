@@ -0,0 +1,449 @@
+"""
+Script name:    httpEngine.py
+Description:    The httpEngine.py script is the shared HTTP layer used by the dataloaders. It runs one
+                asyncio event loop on a dedicated background thread. Requests go through one pooled,
+                keep-alive session per host, so repeated requests to an agency reuse their TCP/TLS
+                connections. Each agency has a limit on how many requests it gets at once and a
+                token bucket limiting how fast they start, so a busy refresh doesn't hammer any one
+                service. Transient failures (dropped connections, timeouts, 429 and 5xx responses)
+                are retried with exponential backoff and jitter.
+
+                Dataloaders can be written as coroutines:
+
+                    async def dataLoader(stationDict, startDate, endDate):
+                        response = await httpEngine.get(url, agency = 'USGS')
+
+                Synchronous dataloaders keep working. They can use the pooled connections through
+                httpEngine.run(httpEngine.get(...)), and asyncDataLoader / syncDataLoader adapt
+                either kind of loader to the calling code.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+import requests
+from requests.adapters import HTTPAdapter
+from resources.modules.DataTab.responseCache import ResponseCache, CACHE_DIRECTORY
+
+# Number of requests each agency can have in flight at once
+AGENCY_LIMITS = {
+    'USGS':     8,
+    'USBR':     4,
+    'ACIS':     4,
+    'NRCS':     4,
+    'CPC':      2,
+    'NCEI':     2}
+DEFAULT_AGENCY_LIMIT = 4
+
+# Token bucket for each agency: (requests per second, burst size)
+AGENCY_RATES = {
+    'USGS':     (10, 20),
+    'USBR':     (4, 8),
+    'ACIS':     (4, 8),
+    'NRCS':     (4, 8),
+    'CPC':      (2, 4),
+    'NCEI':     (2, 4)}
+DEFAULT_AGENCY_RATE = (4, 8)
+
+# Connections kept open to each host, and the timeout for each request (seconds)
+CONNECTIONS_PER_HOST = 8
+REQUEST_TIMEOUT = 120
+
+# Retries for transient failures. The n'th retry waits a random time between 0 and
+# min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2**n) seconds (or as long as a Retry-After header asks).
+MAX_RETRIES = 3
+RETRY_BACKOFF_BASE = 1.0
+RETRY_BACKOFF_MAX = 30.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Response cache settings. Change these with configureCache.
+CACHE_SETTINGS = {
+    'enabled':      True,
+    'directory':    CACHE_DIRECTORY,
+    'maxMegabytes': 200,
+    'offline':      False}
+
+# Hosts whose requests are sent somewhere else instead, e.g. {'waterservices.usgs.gov': 'http://127.0.0.1:8765'}.
+# The benchmarks use this to point the dataloaders at a local mock server. Change it with configureHosts.
+HOST_OVERRIDES = {}
+
+# The RequestStats that the current download job's requests are counted in (see RequestStats)
+requestStats = contextvars.ContextVar('requestStats', default = None)
+
+
+class RequestStats(object):
+    """
+    Counts the requests, bytes, retries and time spent on HTTP for a download job. The download 
+    executor sets one for each job with requestStats.set(...), and every request made from that job
+    (including from sync dataloaders running on a thread, and from tasks the job starts) adds to it.
+    Once the job is cancelled, its requests raise a CancelledError instead of going out.
+    'started' is when the job's dataloader started running (time.monotonic(), see startJob).
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.cancelled = False
+        self.started = None
+
+
+class TokenBucket(object):
+    """
+    Limits how often requests start: the bucket holds up to 'burst' tokens and refills at 'rate' tokens
+    a second, and each request takes one. Requests that find the bucket empty reserve a token
+    anyway and wait until it would have been refilled, so they go in the order they asked.
+    The bucket is only used from the engine's event loop.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens/self.rate)
+
+        return
+
+
+class HostOverrideAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that sends requests for the hosts in HOST_OVERRIDES to their replacement
+    (scheme and host), keeping the original host in the Host header. It's mounted on every session, 
+    so SOAP clients using the sessions are redirected too.
+    """
+
+    def send(self, request, **kwargs):
+        if HOST_OVERRIDES:
+            parts = urlsplit(request.url)
+            if parts.netloc in HOST_OVERRIDES:
+                target = urlsplit(HOST_OVERRIDES[parts.netloc])
+                request.headers['Host'] = parts.netloc
+                request.url = urlunsplit((target.scheme, target.netloc, parts.path, parts.query, parts.fragment))
+        return super(HostOverrideAdapter, self).send(request, **kwargs)
+
+
+class HTTPEngine(object):
+    """
+    An event loop on a background thread, with pooled sessions and per-agency concurrency limits
+    """
+
+    def __init__(self, agencyLimits = None, agencyRates = None, connectionsPerHost = CONNECTIONS_PER_HOST, numThreads = 32):
+        self.agencyLimits = dict(AGENCY_LIMITS if agencyLimits is None else agencyLimits)
+        self.agencyRates = dict(AGENCY_RATES if agencyRates is None else agencyRates)
+        self.connectionsPerHost = connectionsPerHost
+        self.sessions = {} # host -> requests.Session
+        self.semaphores = {} # agency -> asyncio.Semaphore
+        self.buckets = {} # agency -> TokenBucket
+        self.sessionLock = threading.Lock()
+        self.cache = makeCache()
+
+        # Blocking socket I/O runs on these threads, so the event loop itself never blocks
+        self.ioPool = concurrent.futures.ThreadPoolExecutor(max_workers = numThreads, thread_name_prefix = 'http')
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever, name = 'http-engine', daemon = True)
+        self.thread.start()
+
+    def session(self, url):
+        """
+        Returns the keep-alive session for the url's host
+        """
+        host = urlsplit(url).netloc
+        with self.sessionLock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HostOverrideAdapter(pool_connections = 1, pool_maxsize = self.connectionsPerHost, pool_block = True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    def semaphore(self, agency):
+        """
+        Returns the semaphore limiting the agency's requests (must be called on the event loop)
+        """
+        if agency not in self.semaphores:
+            self.semaphores[agency] = asyncio.Semaphore(self.agencyLimits.get(agency, DEFAULT_AGENCY_LIMIT))
+        return self.semaphores[agency]
+
+    def bucket(self, agency):
+        """
+        Returns the token bucket limiting the agency's request rate (must be called on the event loop)
+        """
+        if agency not in self.buckets:
+            self.buckets[agency] = TokenBucket(*self.agencyRates.get(agency, DEFAULT_AGENCY_RATE))
+        return self.buckets[agency]
+
+    async def request(self, method, url, agency = None, **kwargs):
+        """
+        Makes an HTTP request and returns the requests.Response. Connection errors, timeouts and
+        RETRY_STATUS_CODES responses are retried up to MAX_RETRIES times. The last failure is 
+        raised (or, for an error status, returned).
+        """
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        agency = agency if agency is not None else urlsplit(url).netloc
+        stats = requestStats.get()
+
+        for attempt in range(MAX_RETRIES + 1):
+            if stats is not None and stats.cancelled:
+                raise concurrent.futures.CancelledError("The download was cancelled")
+
+            # Wait for the agency's rate limit and a free slot. The slot is given up while backing off.
+            await self.bucket(agency).acquire()
+            async with self.semaphore(agency):
+                started = time.monotonic()
+                try:
+                    response, error = await asyncio.get_running_loop().run_in_executor(self.ioPool, functools.partial(self.fetch, method, url, agency, dict(kwargs))), None
+                except (requests.ConnectionError, requests.Timeout) as E:
+                    response, error = None, E
+                if stats is not None:
+                    stats.requests += 1
+                    stats.seconds += time.monotonic() - started
+                    stats.bytes += len(response.content) if response is not None else 0
+
+            # Return anything that isn't a transient failure, and give up after the last retry
+            transient = error is not None or response.status_code in RETRY_STATUS_CODES
+            offline = self.cache is not None and self.cache.offline
+            if not transient or offline or attempt == MAX_RETRIES:
+                if error is not None:
+                    raise error
+                return response
+
+            if stats is not None:
+                stats.retries += 1
+            await asyncio.sleep(retryDelay(attempt, response))
+
+    def fetch(self, method, url, agency, kwargs):
+        """
+        The blocking part of a request: checks the response cache, makes the HTTP call (conditionally, 
+        if there's a stale cached copy) and stores the response
+        """
+        cache = self.cache
+        if cache is None:
+            return self.session(url).request(method, url, **kwargs)
+
+        # Use the cached copy if it's fresh (or if we're offline)
+        key = cache.key(method, url, kwargs)
+        entry = cache.load(key)
+        if entry is not None and (cache.offline or cache.isFresh(entry)):
+            return cache.toResponse(entry)
+        if cache.offline:
+            raise requests.ConnectionError("Offline mode: {0} is not in the response cache".format(url))
+
+        # Otherwise ask the server, letting it answer 'Not Modified' if we have a stale copy
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            headers.update(cache.conditionalHeaders(entry))
+        try:
+            response = self.session(url).request(method, url, headers = headers, **kwargs)
+        except requests.RequestException:
+            if entry is not None:
+                return cache.toResponse(entry) # The server can't be reached, so the stale copy will have to do
+            raise
+
+        if response.status_code == 304 and entry is not None:
+            cache.revalidated(key, entry)
+            return cache.toResponse(entry)
+        if response.status_code == 200:
+            cache.save(key, response, agency)
+
+        return response
+
+    def submit(self, coroutine):
+        """
+        Schedules a coroutine on the engine's loop from any thread. Returns a concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the engine's loop and waits for the result. Don't call this from the loop itself.
+        """
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("httpEngine.run can't be called from the engine's own event loop. Use 'await' instead.")
+        return self.submit(coroutine).result()
+
+    def close(self):
+        """
+        Stops the loop and closes the sessions
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.ioPool.shutdown(wait = False)
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+
+        return
+
+
+def retryDelay(attempt, response = None):
+    """
+    Returns how long to wait (seconds) before retrying a request: exponential backoff with full jitter,
+    or the server's Retry-After time if it sent one (up to RETRY_BACKOFF_MAX)
+    """
+    retryAfter = response.headers.get('Retry-After') if response is not None else None
+    if retryAfter is not None and retryAfter.strip().isdigit():
+        return min(RETRY_BACKOFF_MAX, float(retryAfter))
+
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE*2**attempt))
+
+
+def makeCache():
+    """
+    Returns a ResponseCache built from CACHE_SETTINGS (or None if the cache is disabled)
+    """
+    if not CACHE_SETTINGS['enabled']:
+        return None
+    return ResponseCache(CACHE_SETTINGS['directory'], CACHE_SETTINGS['maxMegabytes'], CACHE_SETTINGS['offline'])
+
+
+def configureCache(enabled = None, directory = None, maxMegabytes = None, offline = None):
+    """
+    Changes the response cache settings. Settings that aren't given are left alone.
+
+    Input:
+        enabled -> False downloads everything from the servers (the '--no-cache' option)
+        directory -> where the cache is stored
+        maxMegabytes -> the cache's size limit
+        offline -> True serves every request from the cache, however old, and never contacts the servers
+    """
+    for name, value in [('enabled', enabled), ('directory', directory), ('maxMegabytes', maxMegabytes), ('offline', offline)]:
+        if value is not None:
+            CACHE_SETTINGS[name] = value
+    with engineLock:
+        if engine is not None:
+            engine.cache = makeCache()
+
+    return
+
+
+def configureHosts(overrides):
+    """
+    Sends the requests for some hosts to another server (e.g. the benchmarks' mock agency server)
+
+    Input:
+        overrides -> dict of host (e.g. 'waterservices.usgs.gov') -> replacement URL (e.g. 'http://127.0.0.1:8765').
+                     An empty dict stops redirecting.
+    """
+    HOST_OVERRIDES.clear()
+    HOST_OVERRIDES.update(overrides)
+
+    return
+
+
+def configureWorker(cacheSettings, hostOverrides):
+    """
+    Gives a download worker process the main process's cache settings and host overrides
+    """
+    configureCache(**cacheSettings)
+    configureHosts(hostOverrides)
+
+    return
+
+
+# Each process gets one engine, created the first time it's needed. A forked worker process
+# doesn't inherit the parent's loop thread, so it creates its own.
+engineLock = threading.Lock()
+engine = None
+enginePID = None
+
+def getEngine():
+    """
+    Returns this process's HTTPEngine
+    """
+    global engine, enginePID
+    with engineLock:
+        if engine is None or enginePID != os.getpid():
+            engine = HTTPEngine()
+            enginePID = os.getpid()
+        return engine
+
+
+async def get(url, agency = None, **kwargs):
+    """
+    Pooled HTTP GET. Use 'await httpEngine.get(...)' in async dataloaders, or httpEngine.run(httpEngine.get(...)) in synchronous code.
+    """
+    return await getEngine().request('GET', url, agency, **kwargs)
+
+
+async def post(url, agency = None, **kwargs):
+    """
+    Pooled HTTP POST
+    """
+    return await getEngine().request('POST', url, agency, **kwargs)
+
+
+def run(coroutine):
+    """
+    Runs a coroutine (e.g. httpEngine.get(...)) on the engine and returns its result
+    """
+    return getEngine().run(coroutine)
+
+
+def startJob():
+    """
+    Marks the current download job (its RequestStats) as started running. The download executor's
+    job timeout counts from here, so the time a job waits for a free worker doesn't count against it.
+    """
+    stats = requestStats.get()
+    if stats is not None and stats.started is None:
+        stats.started = time.monotonic()
+
+    return
+
+
+def asyncDataLoader(module, executor = None, functionName = 'dataLoader'):
+    """
+    Returns a dataloader module's dataLoader (or another loader function, e.g. 'batchDataLoader') as a 
+    coroutine function. Synchronous dataloaders are run on the executor (or the loop's default executor) 
+    so they don't block the event loop.
+    """
+    dataGetFunction = getattr(module, functionName)
+    if asyncio.iscoroutinefunction(dataGetFunction):
+        async def asyncAdapter(*args):
+            startJob()
+            return await dataGetFunction(*args)
+
+        return asyncAdapter
+
+    # The loader runs in a copy of the caller's context, so its requests count towards the caller's RequestStats.
+    # The job only starts once the executor has a free thread for it.
+    def startedLoader(*args):
+        startJob()
+        return dataGetFunction(*args)
+
+    async def adapter(*args):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(contextvars.copy_context().run, startedLoader, *args))
+
+    return adapter
+
+
+def syncDataLoader(module, functionName = 'dataLoader'):
+    """
+    Returns a dataloader module's dataLoader (or another loader function) as a plain (blocking) function, 
+    whether it's async or not
+    """
+    dataGetFunction = getattr(module, functionName)
+    if not asyncio.iscoroutinefunction(dataGetFunction):
+        return dataGetFunction
+
+    def adapter(*args):
+        return run(dataGetFunction(*args))
+
+    return adapter
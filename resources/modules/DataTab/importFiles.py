@@ -0,0 +1,292 @@
+"""
+Script name:    importFiles.py
+Description:    The importFiles.py script reads the CSV and Excel files behind imported ('IMPORT') datasets.
+                Each file is fingerprinted (size, modification time and a hash of its contents), and
+                a dataset remembers the fingerprint of the file it was last read from (its 'Import
+                Fingerprint' option), so refreshes skip files that haven't changed. A file is only
+                hashed again when its size or modification time changes.
+
+                CSV files are read with pyarrow's reader when it's installed (pandas' C reader
+                otherwise), with float64 value columns. Excel workbooks are slow to parse, so every
+                sheet is converted once into a columnar sidecar (.npz with the dates and a values
+                array per sheet) in resources/temp/importCache, keyed by the workbook's hash.
+
+                One file can hold several datasets. A dataset's 'Import Sheet' and 'Import Column'
+                options say which sheet and column are its data (by default, the first sheet's first
+                column), and every dataset in the same file is filled from one read.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+try:
+    import python_calamine
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None # pandas' default (openpyxl / xlrd)
+
+IMPORT_CACHE_DIRECTORY = 'resources/temp/importCache'
+
+# The fingerprints of the files that have been read ({file: {'size', 'mtime', 'hash'}})
+FINGERPRINT_FILE = os.path.join(IMPORT_CACHE_DIRECTORY, 'fingerprints.json')
+
+HASH_CHUNK_BYTES = 1024*1024
+
+fingerprintLock = threading.Lock()
+
+
+def hashFile(fileName):
+    """
+    Returns a hash of the file's contents
+    """
+    fileHash = hashlib.blake2b(digest_size = 20)
+    with open(fileName, 'rb') as readFile:
+        for chunk in iter(lambda: readFile.read(HASH_CHUNK_BYTES), b''):
+            fileHash.update(chunk)
+
+    return fileHash.hexdigest()
+
+
+def readFingerprints():
+    try:
+        with open(FINGERPRINT_FILE, 'r') as readFile:
+            return json.load(readFile)
+    except (OSError, ValueError):
+        return {}
+
+
+def writeFingerprints(fingerprints):
+    """
+    Saves the fingerprints. They're only a cache, so failing to write them isn't an error.
+    """
+    try:
+        os.makedirs(IMPORT_CACHE_DIRECTORY, exist_ok = True)
+        temporaryFile = '{0}.{1}.tmp'.format(FINGERPRINT_FILE, os.getpid())
+        with open(temporaryFile, 'w') as writeFile:
+            json.dump(fingerprints, writeFile, indent = 1)
+        os.replace(temporaryFile, FINGERPRINT_FILE)
+    except OSError:
+        pass
+
+    return
+
+
+def fileFingerprint(fileName):
+    """
+    Returns the file's fingerprint (a hash of its contents). The file is only read if its size or
+    modification time has changed since it was last fingerprinted.
+    """
+    fileName = os.path.abspath(fileName)
+    fileStat = os.stat(fileName)
+
+    with fingerprintLock:
+        fingerprints = readFingerprints()
+        entry = fingerprints.get(fileName, {})
+        if entry.get('size') == fileStat.st_size and entry.get('mtime') == fileStat.st_mtime_ns:
+            return entry['hash']
+
+        fileHash = hashFile(fileName)
+
+        # The old version's sidecar isn't needed any more
+        if entry.get('hash', fileHash) != fileHash and entry['hash'] not in [other['hash'] for name, other in fingerprints.items() if name != fileName]:
+            try:
+                os.remove(sidecarFile(entry['hash']))
+            except OSError:
+                pass
+
+        fingerprints[fileName] = {'size': fileStat.st_size, 'mtime': fileStat.st_mtime_ns, 'hash': fileHash}
+        writeFingerprints(fingerprints)
+
+    return fileHash
+
+
+def cleanTable(table):
+    """
+    Converts a table read from a file into a table of float64 columns with a DatetimeIndex. Rows whose
+    date can't be read are dropped, and values that aren't numbers (e.g. 'M' for missing) become NaN.
+    """
+    table.index = pd.to_datetime(table.index, errors = 'coerce')
+    table = table[table.index.notna()]
+    table.columns = [str(column) for column in table.columns]
+    for column in table.columns:
+        if table[column].dtype != np.float64:
+            table[column] = pd.to_numeric(table[column], errors = 'coerce').astype(np.float64)
+    table.index.name = None
+
+    return table
+
+
+def readCSV(fileName):
+    """
+    Reads a CSV file (dates in the first column, then one or more value columns)
+    """
+    header = pd.read_csv(fileName, nrows = 0)
+    try:
+        table = pd.read_csv(fileName, index_col = 0, dtype = {column: np.float64 for column in header.columns[1:]}, engine = CSV_ENGINE)
+    except ValueError:
+        # Columns with values that aren't numbers are converted by cleanTable
+        table = pd.read_csv(fileName, index_col = 0, engine = CSV_ENGINE)
+
+    return cleanTable(table)
+
+
+def sidecarFile(fileHash):
+    return os.path.join(IMPORT_CACHE_DIRECTORY, fileHash + '.npz')
+
+
+def writeSidecar(fileName, tables):
+    """
+    Saves a workbook's sheets as a columnar .npz file (sheet names, then each sheet's dates, column
+    names and values array)
+    """
+    arrays = {'sheets': np.array(list(tables.keys()), dtype = str)}
+    for i, table in enumerate(tables.values()):
+        arrays['dates{0}'.format(i)] = table.index.values.astype('datetime64[ns]').view(np.int64)
+        arrays['columns{0}'.format(i)] = np.array(table.columns, dtype = str)
+        arrays['values{0}'.format(i)] = table.to_numpy(dtype = np.float64)
+
+    os.makedirs(IMPORT_CACHE_DIRECTORY, exist_ok = True)
+    temporaryFile = '{0}.{1}.tmp'.format(fileName, os.getpid())
+    with open(temporaryFile, 'wb') as writeFile:
+        np.savez(writeFile, **arrays)
+    os.replace(temporaryFile, fileName)
+
+    return
+
+
+def readSidecar(fileName):
+    """
+    Reads the sheets saved by writeSidecar
+    """
+    tables = {}
+    with np.load(fileName, allow_pickle = False) as arrays:
+        for i, sheet in enumerate(arrays['sheets']):
+            dates = pd.DatetimeIndex(arrays['dates{0}'.format(i)].view('datetime64[ns]'))
+            tables[str(sheet)] = pd.DataFrame(arrays['values{0}'.format(i)], index = dates, columns = [str(column) for column in arrays['columns{0}'.format(i)]])
+
+    return tables
+
+
+def readWorkbook(fileName, fileHash):
+    """
+    Reads every sheet of an Excel workbook, from its sidecar if it has already been converted
+    """
+    sidecar = sidecarFile(fileHash)
+    if os.path.exists(sidecar):
+        try:
+            return readSidecar(sidecar)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    sheets = pd.read_excel(fileName, sheet_name = None, index_col = 0, engine = EXCEL_ENGINE)
+    tables = {str(sheet): cleanTable(table) for sheet, table in sheets.items()}
+    try:
+        writeSidecar(sidecar, tables)
+    except OSError:
+        pass
+
+    return tables
+
+
+def readImportFile(fileName, fileHash = None):
+    """
+    Reads a CSV or Excel file
+
+    Input:
+        fileName -> the .csv, .xls or .xlsx file
+        fileHash -> the file's fingerprint, if it's already known
+
+    Output:
+        tables -> dict of sheet name ('' for CSV files) -> dataframe of float64 columns with a DatetimeIndex
+    """
+    extension = os.path.splitext(fileName)[1].lower()
+    if extension == '.csv':
+        return {'': readCSV(fileName)}
+    if extension in ['.xls', '.xlsx', '.xlsm']:
+        return readWorkbook(fileName, fileHash if fileHash is not None else fileFingerprint(fileName))
+
+    raise ValueError("{0} is not a CSV or Excel file".format(fileName))
+
+
+def fileColumns(tables):
+    """
+    Returns the (sheet, column) pairs in a file, in order
+    """
+    return [(sheet, column) for sheet, table in tables.items() for column in table.columns]
+
+
+def selectSeries(tables, sheet = '', column = ''):
+    """
+    Returns a column of a file as a series. An empty sheet or column means the first one.
+    """
+    if sheet == '':
+        sheet = next(iter(tables))
+    if sheet not in tables:
+        raise KeyError("There is no sheet called '{0}'".format(sheet))
+    table = tables[sheet]
+    if column == '':
+        if len(table.columns) == 0:
+            raise KeyError("Sheet '{0}' has no data columns".format(sheet))
+        column = table.columns[0]
+    if column not in table.columns:
+        raise KeyError("There is no column called '{0}'".format(column))
+
+    series = table[column]
+
+    return series[~series.index.duplicated(keep = 'first')]
+
+
+def importDatasets(datasets, force = False, cancelled = None):
+    """
+    Reads the data of the imported datasets. Files are read once for all of the datasets in them, and
+    files that haven't changed since a dataset was last read are skipped.
+
+    Input:
+        datasets -> datasetTable rows of 'IMPORT' datasets
+        force -> True reads every file, changed or not
+        cancelled -> optional function that returns True to stop early
+
+    Output:
+        newData -> long (Datetime, DatasetInternalID) dataframe of the data that was read (None if nothing was)
+        fingerprints -> dict of DatasetInternalID -> the fingerprint of the file it was read from
+        errors -> dict of DatasetInternalID -> the exception for datasets that couldn't be read
+    """
+    frames = []
+    fingerprints = {}
+    errors = {}
+    fileNames = datasets['DatasetAdditionalOptions'].map(lambda options: options.get('Import Filename', ''))
+    for fileName, group in datasets.groupby(fileNames, sort = False):
+        if cancelled is not None and cancelled():
+            break
+        try:
+            fileHash = fileFingerprint(fileName)
+            changed = [datasetID for datasetID, options in group['DatasetAdditionalOptions'].items() if force or options.get('Import Fingerprint') != fileHash]
+            if changed == []:
+                continue
+            tables = readImportFile(fileName, fileHash)
+        except Exception as E:
+            errors.update({datasetID: E for datasetID in group.index})
+            continue
+
+        # Fill each dataset from its sheet and column
+        for datasetID in changed:
+            options = group.loc[datasetID, 'DatasetAdditionalOptions']
+            try:
+                series = selectSeries(tables, options.get('Import Sheet', ''), options.get('Import Column', ''))
+            except KeyError as E:
+                errors[datasetID] = E
+                continue
+            frames.append(pd.DataFrame({'Value': series.values}, index = pd.MultiIndex.from_arrays([series.index, np.full(len(series), datasetID)], names = ['Datetime', 'DatasetInternalID'])))
+            fingerprints[datasetID] = fileHash
+
+    return (pd.concat(frames) if frames != [] else None), fingerprints, errors
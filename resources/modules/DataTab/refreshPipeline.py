@@ -0,0 +1,279 @@
+"""
+Script name:    refreshPipeline.py
+Description:    The refreshPipeline.py script has the steps of a data refresh (working out where each
+                dataset's download starts, downloading, re-reading imported files, and merging the new
+                data into the data store along with the composites built on it) as plain functions with
+                no GUI code. The Data tab runs them through its Qt worker, and the headless command line
+                refresh (python -m nextflow refresh) runs them directly with refreshForecastFile.
+"""
+
+import configparser
+import time
+from datetime import datetime
+from io import StringIO
+import pandas as pd
+from resources.modules.DataTab import dataloaderRegistry, downloadExecutor, importFiles
+from resources.modules.Miscellaneous import DataProcessor, DataStore, forecastFile
+
+
+def periodOfRecordStart(porStart):
+    """
+    Returns the start of the period of record: October 1st of the 'por_start' year (the start of that
+    water year). Raises a ValueError if porStart isn't a year.
+    """
+    porStart = str(porStart).strip()
+    if not (porStart.isdigit() and len(porStart) == 4):
+        raise ValueError("The period of record start ('por_start') must be a year, not '{0}'".format(porStart))
+
+    return pd.to_datetime(porStart + '-10-01')
+
+
+def isFullDownload(dataOptions, porT1, fullResync = False):
+    """
+    Returns True if every dataset needs its whole period of record downloaded: on a full re-sync, when
+    no full download has finished yet, or when the period of record now starts earlier than the last
+    full download (the 'downloaded_por_start' option, see recordFullDownload)
+    """
+    downloadedPORStart = dataOptions.get('downloaded_por_start', '')
+
+    return fullResync or downloadedPORStart == '' or porT1 < pd.to_datetime(downloadedPORStart)
+
+
+def recordFullDownload(dataOptions, porT1):
+    """
+    Records that the whole period of record (from porT1) has been downloaded. Only call this once a
+    full download has finished with every dataset, so that a cancelled or failed download is redone.
+    """
+    dataOptions['downloaded_por_start'] = datetime.strftime(porT1, '%Y-%m-%d')
+
+    return
+
+
+def downloadStartDates(datasetTable, dataStore, dataOptions, porT1, fullResync = False):
+    """
+    Returns the date that each dataset's download should start on. A full download (see isFullDownload)
+    downloads the whole period of record. Otherwise (incremental downloads), datasets only download 
+    from a look-back window before their last downloaded (non-edited) value, so that provisional data
+    that the agency has since revised gets updated. Datasets with no data, and datasets whose dataloader
+    isn't incremental (see isIncremental), download the whole period of record.
+
+    Input:
+        datasetTable -> the datasets being downloaded
+        dataStore -> the DataStore with the data we already have
+        dataOptions -> the 'DATA TAB' section of the user options
+        porT1 -> the start of the period of record
+        fullResync -> True downloads the whole period of record for every dataset
+
+    Output:
+        startDates -> pd.Series of start dates indexed by DatasetInternalID
+    """
+    startDates = pd.Series(porT1, index = datasetTable.index)
+
+    # Full re-syncs (or a period of record that starts earlier than the data we have) download everything
+    if isFullDownload(dataOptions, porT1, fullResync):
+        return startDates
+
+    # Start each dataset's download a look-back window before its last downloaded value
+    lookback = pd.Timedelta(days = int(dataOptions.get('download_lookback_days', '30')))
+    lastDates = dataStore.lastStoredDates(datasetTable.index)
+    incremental = datasetTable['DatasetDataloader'].map({dataloader: isIncremental(dataloader) for dataloader in datasetTable['DatasetDataloader'].unique()})
+    hasData = lastDates.notna() & incremental.astype(bool)
+    startDates[hasData] = (lastDates[hasData] - lookback).clip(lower = porT1)
+
+    return startDates
+
+
+def isIncremental(dataloader):
+    """
+    Returns False for dataloaders whose source files always hold the whole record (INCREMENTAL = False,
+    see dataloaderRegistry.py), which gain nothing from a later start date. Composite and imported
+    datasets, and dataloaders that can't be found, count as incremental.
+    """
+    if dataloader in ['COMPOSITE', 'IMPORT']:
+        return True
+    try:
+        return dataloaderRegistry.dataloaderInfo(dataloader)['incremental']
+    except (KeyError, ValueError):
+        return True
+
+
+def downloadNewData(datasets, startDate, endDate, executor, onProgress = None, onEvent = None, sessionID = None):
+    """
+    Downloads the datasets that come from a dataloader (not composite or imported datasets)
+
+    Input:
+        datasets -> datasetTable rows to download
+        startDate, endDate -> the period to download (startDate can be a pd.Series by DatasetInternalID)
+        executor -> the DownloadExecutor
+        onProgress -> optional function called with the number of datasets finished so far
+        onEvent -> optional function called with each dataset's status events (see DownloadExecutor.download)
+        sessionID -> optional download session to share source files with (see DownloadExecutor.download)
+
+    Output:
+        newData -> long (Datetime, DatasetInternalID) dataframe of everything that downloaded (None if nothing did)
+        errors -> dict of DatasetInternalID -> the exception for datasets that failed
+    """
+    downloadDatasets = datasets[~datasets['DatasetDataloader'].isin(['COMPOSITE', 'IMPORT'])]
+
+    results = []
+    errors = {}
+    for i, (datasetID, data, error) in enumerate(executor.download(downloadDatasets, startDate, endDate, onEvent, sessionID)):
+        if error is not None:
+            errors[datasetID] = error
+        elif len(data[0]) > 0:
+            results.append((datasetID, data[0], data[1]))
+        if onProgress is not None:
+            onProgress(i + 1)
+
+    return (downloadExecutor.combineResults(results) if results != [] else None), errors
+
+
+def readImportedDatasets(datasets, cancelled = None, force = False):
+    """
+    Re-reads the files of the imported datasets (see importFiles.py). Files that haven't changed since
+    they were last read are skipped, and datasets that can't be read keep their existing data. The 
+    datasets aren't changed here: once the new data has been merged, recordImportFingerprints stores
+    the fingerprints of the files that were read.
+
+    Input:
+        datasets -> datasetTable rows (only the 'IMPORT' datasets are read)
+        cancelled -> optional function that returns True to stop early
+        force -> True re-reads every file, changed or not
+
+    Output:
+        newData -> long (Datetime, DatasetInternalID) dataframe of the data that was read (None if nothing was)
+        fingerprints -> dict of DatasetInternalID -> the fingerprint of the file it was read from
+        errors -> dict of DatasetInternalID -> the exception for datasets that couldn't be read
+    """
+    importedDatasets = datasets[datasets['DatasetDataloader'] == 'IMPORT']
+    if importedDatasets.empty:
+        return None, {}, {}
+
+    return importFiles.importDatasets(importedDatasets, force, cancelled)
+
+
+def recordImportFingerprints(datasetTable, fingerprints):
+    """
+    Stores the fingerprints of the files that imported datasets were read from (their 'Import Fingerprint'
+    option), so the next refresh skips them if they haven't changed. Only call this once their data has
+    been merged, so that data that never made it into the data store is read again.
+    """
+    for datasetID, fingerprint in fingerprints.items():
+        if datasetID in datasetTable.index:
+            datasetTable.loc[datasetID, 'DatasetAdditionalOptions']['Import Fingerprint'] = fingerprint
+
+    return
+
+
+def mergeNewData(dataStore, compositeGraph, datasetTable, newDataTable, nanHandling = 'propagate', resampleCache = None):
+    """
+    Merges new data into the data store, and recomputes the composite datasets built on the changed data
+    (including composites of composites) over the changed dates only
+
+    Input:
+        dataStore -> the DataStore
+        compositeGraph -> the CompositeGraph (brought up to date with the datasetTable here)
+        datasetTable -> the datasets
+        newDataTable -> long (Datetime, DatasetInternalID) dataframe with a 'Value' column
+        nanHandling -> how composites treat missing components ('propagate' or 'skip')
+        resampleCache -> optional ResampleCache to invalidate for the changed data
+
+    Output:
+        changes -> ChangeSet of every changed cell (the new data's and the composites')
+        skipped -> dict of {compositeID: reason} for composites that couldn't be updated
+    """
+
+    # Don't bother with empty datatables
+    if newDataTable is None or newDataTable.empty:
+        return DataStore.ChangeSet.emptyChangeSet(), {}
+
+    # Merge the new data into the data store. New values and updates to unedited values are written in place,
+    # and values that the user edited are flagged as conflicts in the change-set.
+    changes = dataStore.merge(newDataTable)
+
+    # Any resampled data built from the changed datasets is now out of date. Only the periods overlapping the changed dates need recomputing.
+    if resampleCache is not None:
+        resampleCache.bumpDataVersion(changes.changedDatasets(), changes.dateRanges())
+
+    #TEMPORARY: conflicting values overwrite the user's edits (the edit flags are kept)
+
+    # Recompute the composite datasets built on the changed data
+    compositeGraph.update(datasetTable)
+    compositeChanges, skipped = DataProcessor.updateComposites(dataStore, compositeGraph, changes.dateRanges(), nanHandling)
+    if resampleCache is not None:
+        resampleCache.bumpDataVersion(compositeChanges.changedDatasets(), compositeChanges.dateRanges())
+
+    return DataStore.ChangeSet.concatenate([changes, compositeChanges]), skipped
+
+
+def refreshForecastFile(fileName, executor, fullResync = False, sessionID = None):
+    """
+    Refreshes the data in a forecast file without the GUI: downloads new data for its datasets (incrementally,
+    unless fullResync is True or the file's options say otherwise), re-reads its imported files, updates its
+    composites and writes the file back.
+
+    Input:
+        fileName -> the .fcst file
+        executor -> the DownloadExecutor to download on (it can be shared by several files at once)
+        fullResync -> True downloads the whole period of record for every dataset
+        sessionID -> optional download session, so that files refreshed together share source files
+
+    Output:
+        summary -> dict with the file's number of 'datasets', datasets 'downloaded' (or imported) that returned
+                   new data, datasets that 'failed', cells 'changed', the 'errors' ({DatasetInternalID: exception}),
+                   the 'skipped' composites ({compositeID: reason}) and the 'seconds' it took
+    """
+    start = time.perf_counter()
+    tables = forecastFile.readForecastFile(fileName)
+    datasetTable = tables['datasetTable']
+    options = configparser.ConfigParser()
+    options.read_string(tables['userOptions'])
+    dataOptions = options['DATA TAB']
+
+    # The period of record, as the Data tab works it out
+    porT1 = periodOfRecordStart(dataOptions.get('por_start', ''))
+    porT2 = pd.to_datetime(options['GENERAL'].get('application_datetime', 'today'))
+
+    # Download, re-read imports, and merge everything (with the composites) into the file's data
+    dataStore = DataStore.DataStore.fromLongTable(tables['dataTable'])
+    fullResync = fullResync or dataOptions.get('incremental_download', 'True') != 'True'
+    fullDownload = isFullDownload(dataOptions, porT1, fullResync)
+    startDates = downloadStartDates(datasetTable, dataStore, dataOptions, porT1, fullResync)
+    newData, errors = downloadNewData(datasetTable, startDates, porT2, executor, sessionID = sessionID)
+    importedData, fingerprints, importErrors = readImportedDatasets(datasetTable, force = fullResync)
+    errors.update(importErrors)
+    newTables = [table for table in [newData, importedData] if table is not None]
+
+    compositeGraph = DataProcessor.CompositeGraph()
+    nanHandling = dataOptions.get('composite_nan_handling', 'propagate')
+    numChanged = 0
+    skippedComposites = {}
+    loadedIDs = set()
+    for newTable in newTables:
+        changes, skipped = mergeNewData(dataStore, compositeGraph, datasetTable, newTable, nanHandling)
+        numChanged += len(changes)
+        skippedComposites.update(skipped)
+        loadedIDs.update(newTable.index.get_level_values('DatasetInternalID').unique())
+
+    # The imported data is in, so the imported files don't need reading again until they change
+    recordImportFingerprints(datasetTable, fingerprints)
+
+    # A full download only counts once every dataset has been downloaded
+    if fullDownload and errors == {}:
+        recordFullDownload(dataOptions, porT1)
+
+    # Write the file back
+    optionsText = StringIO()
+    options.write(optionsText)
+    tables['dataTable'] = dataStore.longView()
+    tables['userOptions'] = optionsText.getvalue()
+    forecastFile.writeForecastFile(fileName, tables)
+
+    return {
+        'datasets':     len(datasetTable),
+        'downloaded':   len(loadedIDs),
+        'failed':       len(errors),
+        'changed':      numChanged,
+        'errors':       errors,
+        'skipped':      skippedComposites,
+        'seconds':      time.perf_counter() - start}
@@ -0,0 +1,200 @@
+"""
+Script name:    responseCache.py
+Description:    The responseCache.py script stores HTTP responses from the dataloaders on disk, so that
+                repeated downloads of the same (often static) files don't go back to the agency servers.
+                Entries are keyed by the request method, URL, parameters and body, and are stored gzip
+                compressed. Each agency has a time-to-live; once an entry is older than that, it is
+                revalidated with the server using its ETag / Last-Modified headers. In offline mode, or
+                when the server can't be reached, stale entries are served. The cache is kept under a
+                size limit by evicting the least recently used entries. The cache's size is worked out
+                once and then kept as a running total, so the directory is only listed again when the
+                cache goes over its limit (it's then evicted down to EVICT_TO_FRACTION of the limit).
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# How long (seconds) a cached response is used without checking with the server
+CACHE_TTLS = {
+    'USGS':     3600,
+    'USBR':     3600,
+    'NRCS':     3600,
+    'ACIS':     6*3600,
+    'CPC':      24*3600,
+    'NCEI':     24*3600,
+    'NOAA PSL': 7*24*3600}
+DEFAULT_TTL = 6*3600
+
+CACHE_DIRECTORY = 'resources/temp/httpCache'
+
+# When the cache goes over its size limit, entries are evicted until it's this fraction of the limit
+EVICT_TO_FRACTION = 0.9
+
+
+class ResponseCache(object):
+    """
+    A size-bounded, compressed, on-disk cache of HTTP responses
+    """
+
+    def __init__(self, directory = CACHE_DIRECTORY, maxMegabytes = 200, offline = False, ttls = None):
+        self.directory = directory
+        self.maxBytes = int(float(maxMegabytes)*1024*1024)
+        self.offline = offline
+        self.ttls = dict(CACHE_TTLS if ttls is None else ttls)
+        self.lock = threading.Lock()
+        self.totalBytes = None # Worked out by the first evict()
+        os.makedirs(self.directory, exist_ok = True)
+
+    @staticmethod
+    def key(method, url, kwargs):
+        """
+        Returns the cache key of a request (a hash of the method, URL, query parameters and body)
+        """
+        parts = [method.upper(), url] + [json.dumps(kwargs.get(name), sort_keys = True, default = str) for name in ['params', 'data', 'json']]
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.gz')
+
+    def load(self, key):
+        """
+        Returns the stored entry for a key (or None). Reading an entry marks it as recently used.
+        """
+        path = self.path(key)
+        try:
+            with gzip.open(path, 'rb') as readFile:
+                entry = pickle.load(readFile)
+            os.utime(path)
+            return entry
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save(self, key, response, agency):
+        """
+        Stores a successful response
+        """
+        entry = {
+            'url':          response.url,
+            'status':       response.status_code,
+            'headers':      dict(response.headers),
+            'encoding':     response.encoding,
+            'content':      response.content,
+            'agency':       agency,
+            'storedOn':     time.time()}
+        self.write(key, entry)
+
+        return
+
+    def write(self, key, entry):
+        """
+        Writes an entry atomically, then evicts old entries if the cache is over its size limit
+        """
+        # Download worker processes share the cache, so the temporary file is named for the process and thread
+        temporaryPath = self.path(key) + '.{0}.{1}.tmp'.format(os.getpid(), threading.get_ident())
+        with gzip.open(temporaryPath, 'wb', compresslevel = 6) as writeFile:
+            pickle.dump(entry, writeFile, protocol = pickle.HIGHEST_PROTOCOL)
+        try:
+            replacedBytes = os.path.getsize(self.path(key))
+        except OSError:
+            replacedBytes = 0
+        newBytes = os.path.getsize(temporaryPath)
+        os.replace(temporaryPath, self.path(key))
+
+        # Keep the running total, and only evict when it goes over the limit
+        with self.lock:
+            if self.totalBytes is not None:
+                self.totalBytes += newBytes - replacedBytes
+            overLimit = self.totalBytes is None or self.totalBytes > self.maxBytes
+        if overLimit:
+            self.evict()
+
+        return
+
+    def isFresh(self, entry):
+        return time.time() - entry['storedOn'] < self.ttls.get(entry['agency'], DEFAULT_TTL)
+
+    def conditionalHeaders(self, entry):
+        """
+        Returns the headers that ask the server whether a cached entry is still current
+        """
+        headers = {}
+        entryHeaders = CaseInsensitiveDict(entry['headers'])
+        if 'ETag' in entryHeaders:
+            headers['If-None-Match'] = entryHeaders['ETag']
+        if 'Last-Modified' in entryHeaders:
+            headers['If-Modified-Since'] = entryHeaders['Last-Modified']
+        return headers
+
+    def revalidated(self, key, entry):
+        """
+        Marks an entry as current again after the server answered '304 Not Modified'
+        """
+        entry['storedOn'] = time.time()
+        self.write(key, entry)
+
+        return
+
+    @staticmethod
+    def toResponse(entry):
+        """
+        Rebuilds a requests.Response from a cached entry
+        """
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = entry['encoding']
+        response.url = entry['url']
+        response._content = entry['content']
+        response.fromCache = True
+        return response
+
+    def evict(self):
+        """
+        Works out the cache's size, and deletes the least recently used entries if it's over its size
+        limit (down to EVICT_TO_FRACTION of the limit)
+        """
+        with self.lock:
+            entries = []
+            for fileName in os.listdir(self.directory):
+                if fileName.endswith('.gz'):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, fileName))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, fileName))
+
+            totalBytes = sum(entry[1] for entry in entries)
+            if totalBytes > self.maxBytes:
+                for mtime, size, fileName in sorted(entries):
+                    if totalBytes <= EVICT_TO_FRACTION*self.maxBytes:
+                        break
+                    try:
+                        os.remove(os.path.join(self.directory, fileName))
+                        totalBytes -= size
+                    except OSError:
+                        continue
+            self.totalBytes = totalBytes
+
+        return
+
+    def clear(self):
+        """
+        Deletes every entry
+        """
+        with self.lock:
+            for fileName in os.listdir(self.directory):
+                if fileName.endswith('.gz'):
+                    try:
+                        os.remove(os.path.join(self.directory, fileName))
+                    except OSError:
+                        continue
+            self.totalBytes = 0
+
+        return
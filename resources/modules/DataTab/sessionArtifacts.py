@@ -0,0 +1,99 @@
+"""
+Script name:    sessionArtifacts.py
+Description:    The sessionArtifacts.py script lets the dataloaders share downloaded (and parsed) source
+                files within a download session. Several datasets often come from the same file (e.g.
+                every PDSI climate division is in the national climdiv file). The first dataloader that
+                needs the file downloads and parses it, and the other datasets in the session use the
+                parsed object:
+
+                    divisions = sessionArtifacts.getArtifact('climdiv-pdsidv', downloadAndParse)
+
+                The DownloadExecutor starts a new session for each download, so every refresh gets
+                the current files. Each process keeps the artifacts for one session at a time.
+
+                Dataloaders whose datasets are all cut out of shared files (CPC, PDSI) only need a
+                function that returns a dataset's whole record; loadFromArtifacts and trimRecord do
+                the rest of dataLoader and batchDataLoader.
+"""
+
+import threading
+
+sessionLock = threading.Lock()
+currentSession = None
+artifacts = {} # key -> parsed object
+artifactLocks = {} # key -> lock held while the artifact is being built
+
+
+def useSession(sessionID):
+    """
+    Makes sessionID the current session. Artifacts from an earlier session are dropped.
+    A sessionID of None keeps the current session.
+    """
+    global currentSession, artifacts, artifactLocks
+    if sessionID is None:
+        return
+    with sessionLock:
+        if sessionID != currentSession:
+            currentSession = sessionID
+            artifacts = {}
+            artifactLocks = {}
+
+    return
+
+
+def getArtifact(key, build):
+    """
+    Returns the session's artifact for a key, calling build() to make it if this is the first request
+    for it. Other threads that ask for the same artifact while it's being built wait for it.
+
+    Input:
+        key -> a name for the artifact (e.g. the source file's URL)
+        build -> function with no arguments that downloads and parses the artifact
+
+    Output:
+        artifact -> whatever build() returned
+    """
+    with sessionLock:
+        if key in artifacts:
+            return artifacts[key]
+        keyLock = artifactLocks.setdefault(key, threading.Lock())
+        sessionArtifacts = artifacts
+
+    with keyLock:
+        if key not in sessionArtifacts:
+            sessionArtifacts[key] = build()
+        return sessionArtifacts[key]
+
+
+def trimRecord(record, startDate, endDate):
+    """
+    Returns the part of a dataset's record (dataframe with a DatetimeIndex) between startDate and endDate
+    """
+    if record.empty:
+        return record
+
+    return record[(record.index >= startDate) & (record.index <= endDate)]
+
+
+def loadFromArtifacts(datasets, startDates, endDate, datasetRecord):
+    """
+    Loads datasets that are cut out of shared source files (a batchDataLoader, see downloadExecutor.py)
+
+    Input:
+        datasets -> the datasets' rows in the datasetTable
+        startDates -> pd.Series of start dates indexed by DatasetInternalID
+        endDate -> the last date to load
+        datasetRecord -> function of a dataset that returns its whole record (usually cut out of an 
+                         artifact from getArtifact), or an empty dataframe if the source has no such dataset
+
+    Output:
+        frames -> dict of DatasetInternalID -> dataframe, or the exception raised for that dataset
+    """
+    frames = {}
+    for datasetID, dataset in datasets.iterrows():
+        try:
+            frames[datasetID] = trimRecord(datasetRecord(dataset), startDates[datasetID], endDate)
+        except Exception as E:
+            frames[datasetID] = E
+
+    return frames
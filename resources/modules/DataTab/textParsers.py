@@ -0,0 +1,140 @@
+"""
+Script name:    textParsers.py
+Description:    The textParsers.py script has the parsers for the text files that the CPC and PDSI
+                dataloaders download (Nino 3.4, PNA, AMO and the climate division PDSI file). Each
+                file is read in one pass with pandas' C reader (or a fixed width reader), and the
+                dates are built with integer year / month arithmetic straight into datetime64
+                arrays, instead of parsing a date string for every row.
+"""
+
+from io import StringIO
+import numpy as np
+import pandas as pd
+
+# Missing value code used in the PSL / NCEI monthly files
+MISSING_VALUE = -99.99
+
+# Columns of the weekly Nino SST file (' 03JAN1990     23.4-0.4     25.1-0.3     26.6 0.0     28.6 0.3'):
+# the week's date, and the Nino 3.4 anomaly
+WEEKLY_NINO_COLUMNS = [(1, 10), (45, 49)]
+
+
+def monthlyDates(years, months, day = 1):
+    """
+    Returns a datetime64[D] array of the given day in each (year, month)
+
+    Input:
+        years, months -> integer arrays (months are 1 - 12)
+        day -> day of the month
+    """
+    monthNumbers = (np.asarray(years, dtype=np.int64) - 1970)*12 + (np.asarray(months, dtype=np.int64) - 1)
+
+    return monthNumbers.astype('datetime64[M]').astype('datetime64[D]') + np.timedelta64(day - 1, 'D')
+
+
+def readWhitespaceTable(text, skiprows = 0, nrows = None, dtype = None):
+    """
+    Reads a whitespace delimited table with no header row
+    """
+    return pd.read_csv(StringIO(text), sep=r'\s+', header=None, skiprows=skiprows, nrows=nrows, dtype=dtype, engine='c')
+
+
+def yearMonthGrid(years, values, day = 1):
+    """
+    Converts a (year x 12 months) table into a monthly series, in date order
+
+    Input:
+        years -> integer array, one per row
+        values -> float array with one row per year and a column per month
+    """
+    values = np.asarray(values, dtype=float)
+    months = np.tile(np.arange(1, 13), len(years))
+    dates = monthlyDates(np.repeat(years, 12), months, day)
+    values = values.ravel()
+    values[values == MISSING_VALUE] = np.nan
+
+    return pd.Series(values, index = pd.DatetimeIndex(dates))
+
+
+def toDaily(series):
+    """
+    Converts a monthly (or weekly) series into a daily series by carrying each value forward
+    """
+    series = series[~series.index.duplicated(keep='first')].sort_index()
+
+    return series.asfreq('D').ffill()
+
+
+def parseNinoMonthly(text):
+    """
+    Parses the monthly 'sstoi.indices' file (YR MON NINO1+2 ANOM NINO3 ANOM NINO4 ANOM NINO3.4 ANOM).
+    Monthly values are dated the 15th.
+
+    Output:
+        series -> the Nino 3.4 anomaly
+    """
+    table = readWhitespaceTable(text, skiprows = 1).to_numpy()
+    dates = monthlyDates(table[:, 0].astype(np.int64), table[:, 1].astype(np.int64), day = 15)
+
+    return pd.Series(table[:, 9].astype(float), index = pd.DatetimeIndex(dates))
+
+
+def parseNinoWeekly(text):
+    """
+    Parses the weekly 'wksst8110.for' file (4 header lines, then fixed width columns)
+
+    Output:
+        series -> the Nino 3.4 anomaly
+    """
+    table = pd.read_fwf(StringIO(text), colspecs = WEEKLY_NINO_COLUMNS, skiprows = 4, header = None, names = ['week', 'anomaly'])
+    table = table.dropna()
+
+    return pd.Series(table['anomaly'].astype(float).values, index = pd.DatetimeIndex(pd.to_datetime(table['week'].str.strip(), format='%d%b%Y')))
+
+
+def parseYearMonthValue(text):
+    """
+    Parses a 'year month value' file (e.g. the monthly PNA index). Values are dated the 1st of the month.
+    """
+    table = readWhitespaceTable(text).to_numpy()
+    dates = monthlyDates(table[:, 0].astype(np.int64), table[:, 1].astype(np.int64))
+
+    return pd.Series(table[:, 2].astype(float), index = pd.DatetimeIndex(dates))
+
+
+def parseYearByMonthTable(text):
+    """
+    Parses a PSL style '.data' file (e.g. the AMO index). The first line has the first and last years,
+    then there is a row of 12 monthly values for each year, followed by a trailer (missing value code
+    and a description) that is skipped.
+    """
+    firstYear, lastYear = [int(year) for year in text.split(None, 2)[:2]]
+    table = readWhitespaceTable(text, skiprows = 1, nrows = lastYear - firstYear + 1).to_numpy(dtype=float)
+
+    return yearMonthGrid(table[:, 0].astype(np.int64), table[:, 1:13])
+
+
+def parseClimateDivisions(text):
+    """
+    Parses the national climate division file (e.g. 'climdiv-pdsidv'). Each row is a code
+    (state, division, element, year as SSDDEEYYYY), then 12 monthly values.
+
+    Output:
+        divisions -> dict of division ID (the code's state and division digits, without the leading
+                     zero, e.g. '101') -> monthly series
+    """
+    table = readWhitespaceTable(text, dtype = {0: np.int64})
+    codes = table[0].to_numpy()
+    values = table.iloc[:, 1:13].to_numpy(dtype=float)
+
+    # Split up the codes with integer arithmetic
+    divisionIDs = codes // 1000000
+    years = codes % 10000
+
+    # Every division's rows, in year order
+    order = np.lexsort((years, divisionIDs))
+    divisionIDs, years, values = divisionIDs[order], years[order], values[order]
+    uniqueIDs, starts = np.unique(divisionIDs, return_index = True)
+    ends = np.append(starts[1:], len(divisionIDs))
+
+    return {str(divisionID): yearMonthGrid(years[start:end], values[start:end]) for divisionID, start, end in zip(uniqueIDs, starts, ends)}
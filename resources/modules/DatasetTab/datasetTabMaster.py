@@ -97,7 +97,7 @@ class datasetTab(object):
                 self.createUserDefinedDataset(options=dataset, importDatasetFlag=True)
                 return
             elif 'CompositeString' in dataset['DatasetAdditionalOptions'].keys():
-                self.editCompositeDialog = createCompositeDataset.compositeDatasetDialog(self.datasetTable, self.dataTable, dataset)
+                self.editCompositeDialog = createCompositeDataset.compositeDatasetDialog(self.datasetTable, self.dataTable, dataset, self.userOptionsConfig['DATA TAB'].get('composite_nan_handling', 'propagate'))
                 self.editCompositeDialog.returnDatasetSignal.connect(self.addNewlyCombinedDatasetToDatastores)
                 self.editCompositeDialog.exec_()
                 return
@@ -317,8 +317,8 @@ class datasetTab(object):
         self.datasetTab.boxHucResultsBox.updateAddedStatus(datasetID)
         
         # Remove any data associated with this dataset from the dataTable, the modelRunTable, and remove any associated forecasts
-        self.dataTable.drop(datasetID, level='DatasetInternalID', inplace=True)
-        self.dataTable.set_index(self.dataTable.index.remove_unused_levels(), inplace=True)
+        self.dataStore.removeColumn(datasetID)
+        self.resampleCache.bumpDataVersion([datasetID])
         self.displayDataInTable(True)
         for row in self.modelRunsTable.iterrows():
             if datasetID in row[1]['PredictorPool']:
@@ -1,7 +1,6 @@
-from resources.modules.Miscellaneous import loggingAndErrors
+from resources.modules.Miscellaneous import loggingAndErrors, forecastFile
 from resources.GUI.Dialogs import PreferencesGUI
 from datetime import datetime
-import pickle
 import time
 from PyQt5.QtWidgets import QFileDialog
 
@@ -47,16 +46,16 @@ class menuBar(object):
         with open('resources/temp/user_options.txt', 'w') as configfile:
             self.userOptionsConfig.write(configfile)
 
-        with open(fname, 'wb') as writefile:
-            
-            pickle.dump(self.datasetTable, writefile, pickle.HIGHEST_PROTOCOL)
-            pickle.dump(self.dataTable, writefile, pickle.HIGHEST_PROTOCOL)
-            pickle.dump(self.modelRunsTable, writefile, pickle.HIGHEST_PROTOCOL)
-            pickle.dump(self.forecastEquationsTable, writefile, pickle.HIGHEST_PROTOCOL)
-            pickle.dump(self.forecastsTable, writefile, pickle.HIGHEST_PROTOCOL)
+        with open('resources/temp/user_options.txt', 'r') as readfile:
+            userOptions = readfile.read()
 
-            with open('resources/temp/user_options.txt', 'r') as readfile:
-                pickle.dump(readfile.read(), writefile, pickle.HIGHEST_PROTOCOL)
+        forecastFile.writeForecastFile(fname, {
+            'datasetTable':             self.datasetTable,
+            'dataTable':                self.dataTable,
+            'modelRunsTable':           self.modelRunsTable,
+            'forecastEquationsTable':   self.forecastEquationsTable,
+            'forecastsTable':           self.forecastsTable,
+            'userOptions':              userOptions})
         
 
     def openForecastFile(self):
@@ -69,16 +68,17 @@ class menuBar(object):
             return 
         
         # Load all the tables, files
-        with open(fname, 'rb') as readfile:
-            self.datasetTable = pickle.load(readfile)
-            self.dataTable = pickle.load(readfile)
-            self.modelRunsTable = pickle.load(readfile)
-            self.forecastEquationsTable = pickle.load(readfile) 
-            self.forecastsTable = pickle.load(readfile)
-            with open('resources/temp/user_options.txt', 'w') as writefile:
-                writefile.write(pickle.load(readfile))
+        tables = forecastFile.readForecastFile(fname)
+        self.datasetTable = tables['datasetTable']
+        self.dataTable = tables['dataTable']
+        self.modelRunsTable = tables['modelRunsTable']
+        self.forecastEquationsTable = tables['forecastEquationsTable']
+        self.forecastsTable = tables['forecastsTable']
+        with open('resources/temp/user_options.txt', 'w') as writefile:
+            writefile.write(tables['userOptions'])
         
         self.userOptionsConfig.read('resources/temp/user_options.txt')
+        self.resampleCache.clear()
 
         # Apply the files and tables to the tabs
         self.resetDatasetTab()
@@ -6,36 +6,48 @@ Description:    The DataProcessor.py script processes daily data into new datase
 
 import pandas as pd
 from datetime import datetime, timedelta
+from functools import lru_cache
+from collections import OrderedDict
+import hashlib
 import isodate
 import numpy as np
+import ast
 import re
+import warnings
+from resources.modules.Miscellaneous.DataStore import DataStore, ChangeSet
 
+RESAMPLE_METHODS = ['accumulation', 'average', 'first', 'last', 'max', 'min', 'custom']
 
-def updateSingleComputedValue(dataTable, combinationString, onDatetime):
-    """
-    Updates a single value in the dataTable
-    """
-     # Parse and validate the combinationString
-    def parser(idx, parseString):
-        if idx == 0:
-            return None
-        elif idx == 1 or idx == 3:
-            return [int(i) for i in parseString.split(',')]
-        elif idx == 2:
-            return [float(i) for i in parseString.split(',')]
+# How missing component data is treated when combining datasets into a composite dataset
+COMPOSITE_NAN_HANDLING = ['propagate', 'skip']
+
+# Numpy functions that can be used in custom resample functions. Reductions are 
+# applied to each period separately.
+CUSTOM_FUNCTION_REDUCTIONS = [
+    'mean', 'nanmean', 'sum', 'nansum', 'max', 'nanmax', 'amax', 'min', 'nanmin', 'amin', 'std', 'nanstd', 'var', 'nanvar', 
+    'median', 'nanmedian', 'percentile', 'nanpercentile', 'quantile', 'nanquantile', 'ptp', 'prod', 'nanprod', 'count_nonzero', 'any', 'all']
+CUSTOM_FUNCTION_ELEMENTWISE = [
+    'abs', 'absolute', 'sqrt', 'square', 'exp', 'log', 'log10', 'log1p', 'sign', 'floor', 'ceil', 'round', 'isnan', 'isfinite', 'minimum', 'maximum']
+CUSTOM_FUNCTION_NUMPY = CUSTOM_FUNCTION_REDUCTIONS + CUSTOM_FUNCTION_ELEMENTWISE + ['nan', 'pi', 'e']
 
-    null, IDs, CFs, LGs = [parser(i, x) for i,x in enumerate(combinationString.split('/'))]
+# Python builtins that can be used in custom resample functions, and the numpy function each one runs as.
+# On a Series, max(x), min(x) and sum(x) skipped missing values, so they run as the NaN-skipping versions.
+CUSTOM_FUNCTION_BUILTINS = {'abs':'abs', 'len':'size', 'max':'nanmax', 'min':'nanmin', 'sum':'nansum'}
 
-    data = pd.Series([0], index=[onDatetime])
+# Position of the 'axis' argument of the reductions that don't take it second (e.g. np.percentile(x, 90, axis))
+CUSTOM_FUNCTION_AXIS_POSITION = {'percentile': 2, 'nanpercentile': 2, 'quantile': 2, 'nanquantile': 2}
 
-    for i, ID in enumerate(IDs):
-        shiftedDatetime = onDatetime + pd.DateOffset(LGs[i])
-        newData = pd.Series(dataTable.loc[(shiftedDatetime, ID), 'Value'], index=[onDatetime])
-        data = np.sum([data, CFs[i]*pd.Series(newData.values, index=newData.index.get_level_values(0))], axis=0)
+# Custom functions used to get 'x' as a pandas Series, and numpy hands these functions to the Series' own
+# methods, which skip missing values. They run as their NaN-skipping versions so that saved functions
+# like "np.mean(x)" give the same results.
+CUSTOM_FUNCTION_NAN_SKIPPING = {
+    'mean':'nanmean', 'sum':'nansum', 'max':'nanmax', 'amax':'nanmax', 'min':'nanmin', 'amin':'nanmin', 
+    'std':'nanstd', 'var':'nanvar', 'prod':'nanprod'}
 
-    return data
+# Largest exponent allowed in custom functions (so that e.g. "9**9**9" can't hang the application)
+CUSTOM_FUNCTION_MAX_EXPONENT = 100
 
-def combinedDataSet(dataTable, datasetTable, combinationString, newDatasetMetaData = {}, existingID = -100):
+def combinedDataSet(dataTable, datasetTable, combinationString, newDatasetMetaData = {}, existingID = -100, nanHandling = 'propagate'):
     """
 
     combinationStrings are formatted as follows:
@@ -45,7 +57,7 @@ def combinedDataSet(dataTable, datasetTable, combinationString, newDatasetMetaDa
     C/ -> Specifies combination of datasets
     id1,id2,id3,...,idN/ -> specifies predictor ID's to be combined
     cf1,cf2,cf3,...,cfN/ -> specifies coeficient to be applied to each series to be combined. 
-    lg1,lg2,lg3,...,lgN/ -> specifies the time lag to apply to each series to be combined. positive integers indicate a lag in the time series. Lag in days
+    lg1,lg2,lg3,...,lgN/ -> specifies the time lag to apply to each series to be combined. positive integers indicate a lag in the time series. Lag in (calendar) days
     
     So if you wanted a un-regulated inflow into reservoir A (inflow id 100000) which is downstream of reservoir B (inflow id 100001, outflow id 100002)
     you could write.
@@ -56,6 +68,7 @@ def combinedDataSet(dataTable, datasetTable, combinationString, newDatasetMetaDa
         dataTable -> The raw datatable as a pandas multi-index dataframe
         combinationString -> The format string used to combine datasets into a new dataset
         newDatasetMetaData -> dictionary of [column name : values] for the new dataset. Only provide things that you want to define personally. The software will do it's best to define the rest. 
+        nanHandling -> 'propagate' (a day is missing if any component is missing) or 'skip' (missing components are left out of the sum)
 
     Output:
         datasetTableEntry -> Information about the new dataset 
@@ -63,25 +76,13 @@ def combinedDataSet(dataTable, datasetTable, combinationString, newDatasetMetaDa
     """
 
     # Parse and validate the combinationString
-    def parser(idx, parseString):
-        if idx == 0:
-            return None
-        elif idx == 1 or idx == 3:
-            return [int(i) for i in parseString.split(',')]
-        elif idx == 2:
-            return [float(i) for i in parseString.split(',')]
-
-    null, IDs, CFs, LGs = [parser(i, x) for i,x in enumerate(combinationString.split('/'))]
-
-    # Retrieve the underlaying data 
-    dates = np.sort(list(set(dataTable.loc[(slice(None),IDs),'Value'].index.get_level_values(0).values)))
-    data = pd.Series([0 for i in dates], index=dates)
-
-    for i, ID in enumerate(IDs):
-        newData = dataTable.loc[(slice(None), ID), 'Value'].shift(LGs[i])
-        data = np.sum([data, CFs[i]*pd.Series(newData.values, index=newData.index.get_level_values(0))], axis=0)
-        
+    IDs, CFs, LGs = parseCompositeString(combinationString)
+    IDs = list(IDs)
 
+    # Line the components up on a daily grid covering all of their data, and combine them
+    dates = pd.DatetimeIndex(dataTable.loc[(slice(None), IDs), 'Value'].index.get_level_values(0))
+    dates = pd.date_range(dates.min().normalize(), dates.max().normalize(), freq='D')
+    data = combineComponents(alignComponents(dataTable, IDs, LGs, dates), CFs, nanHandling)
 
     # Create the datasetTableEntry
     defaults = {
@@ -115,12 +116,299 @@ def combinedDataSet(dataTable, datasetTable, combinationString, newDatasetMetaDa
     
     # Create the dataTableAppend data
     dataTableAppend = pd.DataFrame(data, columns=['Value'], index=dates)
-    print(dataTableAppend)
 
 
     return datasetTableEntry, dataTableAppend
 
 
+@lru_cache(maxsize=1024)
+def parseCompositeString(combinationString):
+    """
+    Parses a composite string (see combinedDataSet) into its dataset IDs, coefficients and lags. 
+    Each distinct string is only parsed once.
+
+    Input:
+        combinationString -> e.g. "C/100121,102331,504423/1.0,0.5,4.3/0,0,5"
+
+    Output:
+        IDs -> tuple of DatasetInternalIDs
+        CFs -> tuple of coefficients
+        LGs -> tuple of lags (in days)
+    """
+    parts = combinationString.split('/')
+    if len(parts) != 4 or parts[0] != 'C':
+        raise ValueError("Composite strings look like 'C/id1,id2/cf1,cf2/lg1,lg2'. Got '{0}'".format(combinationString))
+
+    IDs = tuple(int(i) for i in parts[1].split(','))
+    CFs = tuple(float(i) for i in parts[2].split(','))
+    LGs = tuple(int(i) for i in parts[3].split(','))
+    if not len(IDs) == len(CFs) == len(LGs):
+        raise ValueError("Composite string '{0}' needs one coefficient and one lag per dataset".format(combinationString))
+
+    return IDs, CFs, LGs
+
+
+def compositeValues(dataStore, combinationString, firstDate, lastDate, nanHandling = 'propagate'):
+    """
+    Computes a composite dataset from the data store on the days from firstDate to lastDate (inclusive). 
+    The value on each day is the sum of coefficient * (component value 'lag' days earlier).
+
+    Input:
+        dataStore -> the DataStore holding the component datasets
+        combinationString -> the composite string (see combinedDataSet)
+        firstDate, lastDate -> the days to compute
+        nanHandling -> 'propagate' or 'skip' (see combineComponents)
+
+    Output:
+        values -> daily pandas Series
+    """
+    IDs, CFs, LGs = parseCompositeString(combinationString)
+    dates = pd.date_range(pd.Timestamp(firstDate).normalize(), pd.Timestamp(lastDate).normalize(), freq='D', name='Datetime')
+
+    return pd.Series(combineComponents(alignComponents(dataStore, IDs, LGs, dates), CFs, nanHandling), index=dates)
+
+
+def alignComponents(data, IDs, LGs, dates):
+    """
+    Builds the (components x days) matrix of composite components on a daily grid. Row i holds 
+    dataset IDs[i] shifted forward by LGs[i] calendar days, so gaps in the data don't affect the lag.
+
+    Input:
+        data -> a DataStore, or the long (Datetime, DatasetInternalID) dataTable
+        IDs -> DatasetInternalIDs of the components
+        LGs -> lag of each component in days
+        dates -> the daily DatetimeIndex to align to
+
+    Output:
+        matrix -> float array with one row per component (NaN where there's no data)
+    """
+    numDates = len(dates)
+    matrix = np.full((len(IDs), numDates), np.nan)
+    if numDates == 0:
+        return matrix
+
+    if isinstance(data, DataStore):
+        for i, (ID, LG) in enumerate(zip(IDs, LGs)):
+            if ID in data:
+                rows = data.rowsOf(dates[:1])[0] - LG + np.arange(numDates)
+                valid = (rows >= 0) & (rows < data.numDates)
+                matrix[i, valid] = data.column(ID)[rows[valid]]
+        return matrix
+
+    # Reindex the components to one daily grid that covers every lag, then slice each component out of it
+    gridStart = dates[0] - pd.Timedelta(days=max(LGs))
+    grid = pd.date_range(gridStart, dates[-1] - pd.Timedelta(days=min(LGs)), freq='D')
+    uniqueIDs = list(OrderedDict.fromkeys(IDs))
+    wide = data.loc[(slice(None), uniqueIDs), 'Value'].unstack('DatasetInternalID')
+    wide.index = pd.DatetimeIndex(wide.index).normalize()
+    wide = wide[~wide.index.duplicated(keep='last')].reindex(index=grid, columns=uniqueIDs).values
+    for i, (ID, LG) in enumerate(zip(IDs, LGs)):
+        offset = (dates[0] - pd.Timedelta(days=LG) - gridStart).days
+        matrix[i] = wide[offset:offset+numDates, uniqueIDs.index(ID)]
+
+    return matrix
+
+
+def combineComponents(matrix, CFs, nanHandling = 'propagate'):
+    """
+    Combines aligned components (see alignComponents) into one series as a single coefficients @ matrix product.
+
+    Input:
+        matrix -> (components x days) float array
+        CFs -> coefficient of each component
+        nanHandling -> 'propagate': a day is missing if any component is missing on that day
+                       'skip':      missing components are left out of the sum. A day is only missing if every component is missing
+
+    Output:
+        values -> float array with one value per day
+    """
+    CFs = np.asarray(CFs, dtype=float)
+    if nanHandling == 'propagate':
+        return CFs @ matrix
+    elif nanHandling == 'skip':
+        missing = np.isnan(matrix)
+        values = CFs @ np.where(missing, 0, matrix)
+        values[missing.all(axis=0)] = np.nan
+        return values
+
+    raise ValueError("nanHandling must be one of {0}".format(COMPOSITE_NAN_HANDLING))
+
+
+class CompositeGraph(object):
+    """
+    The dependency graph of the composite datasets in the datasetTable. 
+
+    Composites can be built on other composites, so the graph is used to find every composite downstream 
+    of a changed dataset, in an order where each composite comes after all of the composites it is built on.
+    The graph is only rebuilt when the composite strings (or the datasets in the datasetTable) change.
+    """
+
+    def __init__(self):
+        self.signature = None
+        self.components = {} # compositeID -> composite string
+        self.dependents = {} # DatasetInternalID -> [(compositeID, coefficient, lag) for each composite component that uses it]
+        self.order = [] # compositeIDs in topological order
+        self.brokenComposites = {} # compositeID -> reason the composite can't be computed
+
+    def update(self, datasetTable):
+        """
+        Rebuilds the graph if the composite datasets in the datasetTable have changed
+        """
+        composites = datasetTable[datasetTable['DatasetDataloader'] == 'COMPOSITE']
+        signature = (tuple(datasetTable.index), tuple((ID, options['CompositeString']) for ID, options in composites['DatasetAdditionalOptions'].items()))
+        if signature == self.signature:
+            return
+        self.signature = signature
+
+        self.components = {}
+        self.dependents = {}
+        self.brokenComposites = {}
+        for compositeID, combinationString in signature[1]:
+            try:
+                IDs, CFs, LGs = parseCompositeString(combinationString)
+            except ValueError as E:
+                self.brokenComposites[compositeID] = str(E)
+                continue
+            missing = [ID for ID in IDs if ID not in datasetTable.index]
+            if missing != []:
+                self.brokenComposites[compositeID] = "it relies on a dataset that no longer exists ({0})".format(', '.join(str(ID) for ID in missing))
+            self.components[compositeID] = combinationString
+            for ID, CF, LG in zip(IDs, CFs, LGs):
+                self.dependents.setdefault(ID, []).append((compositeID, CF, LG))
+
+        # Order the composites so that each one comes after the composites it's built on (Kahn's algorithm)
+        numInputs = {compositeID: len([ID for ID in set(parseCompositeString(string)[0]) if ID in self.components]) for compositeID, string in self.components.items()}
+        ready = [compositeID for compositeID, count in numInputs.items() if count == 0]
+        self.order = []
+        while ready:
+            compositeID = ready.pop(0)
+            self.order.append(compositeID)
+            for dependentID in set(entry[0] for entry in self.dependents.get(compositeID, [])):
+                numInputs[dependentID] -= 1
+                if numInputs[dependentID] == 0:
+                    ready.append(dependentID)
+
+        # Anything left over is part of (or downstream of) a circular definition
+        for compositeID in self.components:
+            if numInputs[compositeID] > 0:
+                self.brokenComposites[compositeID] = "it is part of, or built on, a circular composite definition"
+
+        return
+
+    def downstreamOf(self, datasetIDs):
+        """
+        Returns the composites that depend (directly or through other composites) on any of the datasets, 
+        in topological order
+        """
+        affected = set()
+        stack = list(datasetIDs)
+        while stack:
+            for compositeID, CF, LG in self.dependents.get(stack.pop(), []):
+                if compositeID not in affected:
+                    affected.add(compositeID)
+                    stack.append(compositeID)
+
+        return [compositeID for compositeID in self.order if compositeID in affected] + [compositeID for compositeID in self.components if compositeID in affected and compositeID not in self.order]
+
+
+def updateComposites(dataStore, compositeGraph, changedRanges, nanHandling = 'propagate'):
+    """
+    Recomputes the composite datasets downstream of changed data, on the changed dates only, and merges 
+    the results into the data store. Composites are updated in topological order, so a composite built 
+    on other composites sees their updated values.
+
+    Input:
+        dataStore -> the DataStore
+        compositeGraph -> an up-to-date CompositeGraph
+        changedRanges -> dictionary of {DatasetInternalID: (firstChangedDate, lastChangedDate)}
+        nanHandling -> 'propagate' or 'skip' (see combineComponents)
+
+    Output:
+        changes -> ChangeSet of the composite values that changed
+        skipped -> dictionary of {compositeID: reason} for affected composites that couldn't be updated
+    """
+    changedRanges = dict(changedRanges)
+    changeSets = []
+    skipped = {}
+
+    for compositeID in compositeGraph.downstreamOf(changedRanges.keys()):
+        if compositeID in compositeGraph.brokenComposites:
+            skipped[compositeID] = compositeGraph.brokenComposites[compositeID]
+            continue
+
+        # A change on day d of a component lagged by L days changes the composite on day d + L
+        combinationString = compositeGraph.components[compositeID]
+        IDs, CFs, LGs = parseCompositeString(combinationString)
+        shiftedRanges = [(changedRanges[ID][0] + pd.Timedelta(days=LG), changedRanges[ID][1] + pd.Timedelta(days=LG)) for ID, LG in zip(IDs, LGs) if ID in changedRanges]
+        firstDate = max(min(r[0] for r in shiftedRanges), dataStore.dates[0])
+        lastDate = min(max(r[1] for r in shiftedRanges), dataStore.dates[-1])
+        if firstDate > lastDate:
+            continue
+
+        values = compositeValues(dataStore, combinationString, firstDate, lastDate, nanHandling)
+        newData = pd.DataFrame({'Value': values.values}, index=pd.MultiIndex.from_arrays([values.index, np.full(len(values), compositeID)], names=['Datetime', 'DatasetInternalID']))
+        changes = dataStore.merge(newData)
+
+        # Pass the composite's own changes on to the composites built on it
+        if not changes.empty:
+            changedRanges[compositeID] = changes.dateRanges()[compositeID]
+            changeSets.append(changes)
+
+    return ChangeSet.concatenate(changeSets), skipped
+
+
+def updateCompositeCells(dataStore, compositeGraph, datasetID, date, oldValue, newValue, nanHandling = 'propagate'):
+    """
+    Pushes a single edited value through to every composite cell that depends on it (including composites 
+    of composites), using the graph's reverse index of (composite, coefficient, lag) entries. A composite cell 
+    changes by coefficient * (newValue - oldValue), so each dependent cell costs a couple of scalar operations. 
+    Cells where a missing value is involved are recomputed from their components instead.
+
+    Input:
+        dataStore -> the DataStore (already holding the edited value)
+        compositeGraph -> an up-to-date CompositeGraph
+        datasetID, date -> the edited cell
+        oldValue, newValue -> the value before and after the edit
+        nanHandling -> 'propagate' or 'skip' (see combineComponents)
+
+    Output:
+        changedCells -> list of (compositeID, date, newCompositeValue) for the composite cells that changed
+    """
+    changedCells = []
+
+    # Deltas waiting to be applied, by composite and date. NaN means the cell needs recomputing.
+    pending = {}
+    def push(sourceID, sourceDate, delta):
+        for compositeID, CF, LG in compositeGraph.dependents.get(sourceID, []):
+            cells = pending.setdefault(compositeID, {})
+            targetDate = sourceDate + pd.Timedelta(days=LG)
+            cells[targetDate] = cells.get(targetDate, 0.0) + CF * delta
+
+    push(datasetID, pd.Timestamp(date), newValue - oldValue)
+
+    # Apply the deltas in topological order, so that composites of composites receive their inputs' changes first
+    for compositeID in compositeGraph.downstreamOf([datasetID]):
+        if compositeID in compositeGraph.brokenComposites or compositeID not in pending:
+            continue
+        for targetDate, delta in pending.pop(compositeID).items():
+            row, col = dataStore.cellOf(targetDate, compositeID)
+            if row < 0 or delta == 0:
+                continue
+            oldCompositeValue = dataStore.values[row, col]
+            if np.isnan(delta) or np.isnan(oldCompositeValue):
+                IDs, CFs, LGs = parseCompositeString(compositeGraph.components[compositeID])
+                newCompositeValue = combineComponents(alignComponents(dataStore, IDs, LGs, pd.DatetimeIndex([targetDate])), CFs, nanHandling)[0]
+            else:
+                newCompositeValue = oldCompositeValue + delta
+            if newCompositeValue == oldCompositeValue or (np.isnan(newCompositeValue) and np.isnan(oldCompositeValue)):
+                continue
+            dataStore.setValue(targetDate, compositeID, newCompositeValue)
+            changedCells.append((compositeID, targetDate, newCompositeValue))
+            push(compositeID, targetDate, newCompositeValue - oldCompositeValue)
+
+    return changedCells
+
+
 def resampleDataSet(dailyData, resampleString, resampleMethod, customFunction = None):
     """
     This function resamples a dataset (daily timestep) into
@@ -152,6 +440,9 @@ def resampleDataSet(dailyData, resampleString, resampleMethod, customFunction =
                                       the variable "x" to represent the time series. 
 
                                       I.e. "np.mean(x) / np.std(x)" would return z-scores
+
+                                      Custom functions are limited to arithmetic, indexing into x, and
+                                      the numpy functions in CUSTOM_FUNCTION_NUMPY (see compileCustomFunction)
     
     Output:
         resampledData -> data resampled based on format string
@@ -161,47 +452,732 @@ def resampleDataSet(dailyData, resampleString, resampleMethod, customFunction =
     today = datetime.now()
 
     # Create a new empty series
-    resampleData = pd.Series([], index = pd.DatetimeIndex([]))
-
-    # Get information about the daily data
-    firstDate = dailyData.index[0]
+    resampleData = pd.Series([], index = pd.DatetimeIndex([]), dtype=float)
 
     # Parse the resample string
-    resampleList = resampleString.split('/') # Converts 'R/1978-10-01/P1M/F1Y' into ['R', '1978-10-01', 'P1M', 'F1Y']
+    parsed, code, message = parseResampleString(resampleString)
+    if code != 0:
+        return resampleData, code, message
+    startDate, period, frequency = parsed
 
-    # Validate the list
-    if len(resampleList) != 4 or resampleList[0] != 'R' or len(resampleList[1]) != 10 or resampleList[2][0] != 'P' or resampleList[3][0] != 'F':
-        return resampleData, 1, 'Invalid Resample String. Format should be similar to R/1978-10-01/P1M/F1Y'
-    
     # Validate the resample method
-    if resampleMethod not in ['accumulation', 'average', 'first', 'last', 'max', 'min', 'custom']:
+    if resampleMethod not in RESAMPLE_METHODS:
         return resampleData, 1, "Invalid resampling method. Provide one of 'accumulation', 'average', 'first', 'last', 'max', 'min', 'custom'"
 
-    # Parse into values
-    startDate = datetime.strptime(resampleList[1], '%Y-%m-%d') # >>> datetime.date(1978, 10, 1)
-    period = isodate.parse_duration(resampleList[2]) # >>> isodate.duration.Duration(0, 0, 0, years=0, months=1)
-    frequency = isodate.parse_duration(resampleList[3].replace('F', 'P')) # >>> isodate.duration.Duration(0, 0, 0, years=1, months=1)
-
-    # Create all the periods
-    periods = []
-    tracker = startDate
-    while tracker <= today: # >>> periods = [(datetime.datetime(1978-10-01), datetime.datetime(1978-11-01))]
-        periods.append((tracker, tracker+period))#-timedelta(1)))
-        tracker += frequency
-
-    # Parse the function
-    func = lambda x: np.nanmean(x) if resampleMethod == 'average' else (
-        np.nansum(x) if resampleMethod == 'accumulation' else (
-            x.iloc[0][0] if resampleMethod == 'first' else (
-                x.iloc[-1][0] if resampleMethod == 'last' else (
-                    np.max(x) if resampleMethod == 'max' else (
-                        np.min(x) if resampleMethod == 'min' else eval(customFunction))))))
+    # Create all the periods at once
+    lefts, rights = resamplePeriods(startDate, period, frequency, today) # >>> lefts = [1978-10-01, 1979-10-01, ...], rights = [1978-11-01, 1979-11-01, ...]
+
+    # Make sure the daily data is in chronological order
+    if not dailyData.index.is_monotonic_increasing:
+        dailyData = dailyData.sort_index()
+
+    # Map each period onto integer positions in the daily data. Periods include both endpoints.
+    lo, hi = periodPositions(dailyData.index, lefts, rights)
 
     # Resample the data
-    for idx in pd.IntervalIndex.from_tuples(periods):
-        resampleData.loc[idx.left] = ( func(dailyData.loc[idx.left:idx.right]) if (idx.right >= firstDate and today >= idx.right) else np.nan )
+    if resampleMethod == 'custom':
+        try:
+            values = evaluateCustomFunction(compileCustomFunction(customFunction), dailyData.values.astype(float), lo, hi)
+        except Exception as E:
+            return resampleData, 1, 'Invalid custom function: {0}'.format(E)
+    else:
+        values = reducePeriods(dailyData.values.astype(float), lo, hi, resampleMethod)
+
+    # Periods that end before the data starts, or that haven't finished yet, are missing
+    maskIncompletePeriods(values, rights, dailyData.index, today)
+
+    resampleData = pd.Series(values, index = pd.DatetimeIndex(lefts))
 
     # Name the dataframe
-    resampleData.name = dailyData.name + '_' + resampleList[1] + '_' + resampleList[2] + '_' + resampleList[3] + '_' + resampleMethod + '_' + str(customFunction)
+    resampleData.name = str(dailyData.name) + '_' + resampleString.replace('R/', '').replace('/', '_') + '_' + resampleMethod + '_' + str(customFunction)
+
+    return resampleData, 0, 'Procedure Exited Normally'
+
+
+class ResampleCache(object):
+    """
+    A least-recently-used cache in front of resampleDataSet. 
+    
+    Entries are keyed by (DatasetInternalID, resampleString, resampleMethod, custom function hash, data version). 
+    Each dataset has its own data version counter, which is bumped (see bumpDataVersion) whenever that 
+    dataset's data changes, so that an edit to one dataset only invalidates the resampled series built from it.
+    The cache holds at most 'maxMegabytes' of resampled data.
+
+    When the changed date range is known (e.g. a refresh that appends the last few days of data), cached
+    series are carried over to the new data version and only the periods that overlap the changed dates 
+    (along with any periods that have finished since the series was computed) are recomputed. 
+    """
+
+    def __init__(self, maxMegabytes = 64):
+        self.maxBytes = int(maxMegabytes * 1e6)
+        self.entries = OrderedDict() # key -> resampled series
+        self.entrySizes = {} # key -> size of the series in bytes
+        self.computedOn = {} # key -> datetime the series was last brought up to date
+        self.pendingRanges = {} # key -> list of (start, end) date ranges that have changed since the series was computed
+        self.currentBytes = 0
+        self.dataVersions = {} # DatasetInternalID -> data version counter
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.partialUpdates = 0
+
+    def resample(self, dataTable, datasetID, resampleString, resampleMethod, customFunction = None):
+        """
+        Returns the same (resampledData, code, message) tuple as resampleDataSet, using a cached 
+        copy of the resampled data when the dataset hasn't changed since it was last resampled.
+        """
+        datasetID = int(datasetID)
+        functionHash = hashlib.sha1(customFunction.encode('utf-8')).hexdigest() if customFunction is not None else None
+        key = (datasetID, resampleString, resampleMethod, functionHash, self.dataVersions.get(datasetID, 0))
+
+        # Return the cached copy if there is one, recomputing any periods that have changed since it was stored
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if key in self.pendingRanges or self.computedOn[key].date() < datetime.now().date():
+                self.updatePeriods(key, self.datasetSeries(dataTable, datasetID), customFunction)
+            return self.entries[key].copy(), 0, 'Procedure Exited Normally'
+        self.misses += 1
+
+        # Otherwise resample the data
+        resampleData, code, message = resampleDataSet(self.datasetSeries(dataTable, datasetID), resampleString, resampleMethod, customFunction)
+
+        # Store successful results
+        if code == 0:
+            self.store(key, resampleData.copy())
+
+        return resampleData, code, message
+
+    def datasetSeries(self, dataTable, datasetID):
+        """
+        Pulls the daily data for a single dataset out of the dataTable (or DataStore)
+        """
+        if isinstance(dataTable, DataStore):
+            return dataTable.series(datasetID)
+        elif datasetID in dataTable.index.get_level_values('DatasetInternalID'):
+            dailyData = dataTable.xs(datasetID, level='DatasetInternalID')['Value']
+        else:
+            dailyData = pd.Series([], index = pd.DatetimeIndex([]), dtype=float)
+        dailyData.name = str(datasetID)
+
+        return dailyData
+
+    def updatePeriods(self, key, dailyData, customFunction = None):
+        """
+        Brings a cached series up to date by recomputing only the periods that overlap the changed date 
+        ranges, that have finished since the series was last computed, or that are new.
+        """
+        today = datetime.now()
+        datasetID, resampleString, resampleMethod = key[:3]
+        cached = self.entries[key]
+        computedOn = self.computedOn[key]
+        pendingRanges = self.pendingRanges.pop(key, [])
+
+        # Rebuild the period grid. The cached periods are always the first periods of the new grid.
+        startDate, period, frequency = parseResampleString(resampleString)[0]
+        lefts, rights = resamplePeriods(startDate, period, frequency, today)
+        if len(lefts) < len(cached) or not np.array_equal(lefts[:len(cached)], cached.index.values.astype('datetime64[ns]')):
+            resampleData = resampleDataSet(dailyData, resampleString, resampleMethod, customFunction)[0]
+            self.remove(key)
+            self.store(key, resampleData)
+            return
+
+        # Figure out which periods need to be recomputed
+        stale = np.zeros(len(lefts), dtype=bool)
+        stale[len(cached):] = True
+        stale |= rights > np.datetime64(computedOn, 'ns')
+        for changedStart, changedEnd in pendingRanges:
+            stale |= (lefts <= np.datetime64(changedEnd, 'ns')) & (rights >= np.datetime64(changedStart, 'ns'))
+
+        # Recompute those periods only
+        if not dailyData.index.is_monotonic_increasing:
+            dailyData = dailyData.sort_index()
+        lo, hi = periodPositions(dailyData.index, lefts[stale], rights[stale])
+        if resampleMethod == 'custom':
+            newValues = evaluateCustomFunction(compileCustomFunction(customFunction), dailyData.values.astype(float), lo, hi)
+        else:
+            newValues = reducePeriods(dailyData.values.astype(float), lo, hi, resampleMethod).copy()
+        maskIncompletePeriods(newValues, rights[stale], dailyData.index, today)
+
+        values = np.append(cached.values, np.full(len(lefts) - len(cached), np.nan))
+        values[stale] = newValues
+        resampleData = pd.Series(values, index = pd.DatetimeIndex(lefts), name = cached.name)
+
+        self.remove(key)
+        self.store(key, resampleData, today)
+        self.partialUpdates += 1
+
+        return
+
+    def store(self, key, resampleData, computedOn = None):
+        """
+        Adds an entry to the cache and evicts the least recently used entries until the cache fits in memory
+        """
+        size = int(resampleData.memory_usage(index=True, deep=True))
+        if size > self.maxBytes:
+            return
+
+        self.entries[key] = resampleData
+        self.entrySizes[key] = size
+        self.computedOn[key] = computedOn if computedOn is not None else datetime.now()
+        self.currentBytes += size
+
+        while self.currentBytes > self.maxBytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+        return
+
+    def remove(self, key):
+        """
+        Removes a single entry from the cache
+        """
+        del self.entries[key]
+        del self.computedOn[key]
+        self.pendingRanges.pop(key, None)
+        self.currentBytes -= self.entrySizes.pop(key)
+
+        return
+
+    def bumpDataVersion(self, datasetIDs, changedRanges = None):
+        """
+        Marks the data for the given datasets as changed. 
+
+        Input:
+            datasetIDs -> list of DatasetInternalIDs whose data has changed
+            changedRanges (optional) -> dictionary of {DatasetInternalID: (firstChangedDate, lastChangedDate)}. Cached 
+                                        results for datasets with a known changed range are kept and only the affected 
+                                        periods are recomputed the next time they're requested. Results for any other
+                                        dataset are dropped.
+        """
+        changedRanges = {} if changedRanges is None else {int(ID): dates for ID, dates in changedRanges.items()}
+        datasetIDs = set(int(ID) for ID in datasetIDs)
+        for ID in datasetIDs:
+            self.dataVersions[ID] = self.dataVersions.get(ID, 0) + 1
+
+        for key in [key for key in self.entries if key[0] in datasetIDs]:
+            if key[0] in changedRanges:
+                # Carry the entry over to the new data version, and remember which dates changed
+                newKey = key[:4] + (self.dataVersions[key[0]],)
+                self.entries[newKey] = self.entries.pop(key)
+                self.entrySizes[newKey] = self.entrySizes.pop(key)
+                self.computedOn[newKey] = self.computedOn.pop(key)
+                self.pendingRanges[newKey] = self.pendingRanges.pop(key, []) + [changedRanges[key[0]]]
+            else:
+                self.remove(key)
+
+        return
+
+    def setMaxMegabytes(self, maxMegabytes):
+        """
+        Changes the memory cap and evicts entries until the cache fits
+        """
+        self.maxBytes = int(maxMegabytes * 1e6)
+        while self.currentBytes > self.maxBytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+        return
+
+    def clear(self):
+        """
+        Empties the cache (e.g. when a new forecast file is opened). Statistics are kept.
+        """
+        self.entries.clear()
+        self.entrySizes.clear()
+        self.computedOn.clear()
+        self.pendingRanges.clear()
+        self.currentBytes = 0
+        self.dataVersions.clear()
+
+        return
+
+    def statistics(self):
+        """
+        Returns a dictionary of hit/miss statistics and memory usage
+        """
+        lookups = self.hits + self.misses
+        return {
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "HitRate": self.hits / lookups if lookups > 0 else 0.0,
+            "Evictions": self.evictions,
+            "PartialUpdates": self.partialUpdates,
+            "Entries": len(self.entries),
+            "Megabytes": self.currentBytes / 1e6,
+            "MaxMegabytes": self.maxBytes / 1e6
+        }
+
+
+def resampleMany(dataTable, specs):
+    """
+    This function resamples many datasets into many predictors at once. Specs are grouped 
+    by dataset and by resample string so that each dataset is pulled out of the dataTable once, 
+    each period grid is computed once, and reductions that share intermediate arrays (e.g. 
+    'average' and 'accumulation' both need period sums) only compute them once.
+
+    Every resample string must repeat once a year or less often (e.g. F1Y), so that
+    the predictors can be lined up by year.
+
+    Input:
+        dataTable -> The raw datatable as a pandas multi-index dataframe, or the application's DataStore
+        specs -> list of (DatasetInternalID, resampleString, resampleMethod) tuples. 'custom' 
+                 specs add the custom function as a 4th item, e.g. (100101, 'R/1978-03-01/P1M/F1Y', 'custom', 'np.max(x)')
+
+    Output:
+        predictorMatrix -> pandas DataFrame indexed by year with one column per spec. Columns are a MultiIndex 
+                           of (DatasetInternalID, ResampleString, ResampleMethod)
+    """
+
+    # Get today's date
+    today = datetime.now()
+
+    # Create a new empty matrix
+    columns = pd.MultiIndex.from_tuples([tuple(spec[:3]) for spec in specs], names=['DatasetInternalID', 'ResampleString', 'ResampleMethod'])
+    predictorMatrix = pd.DataFrame(index = pd.Index([], dtype=int, name='Year'), columns = columns, dtype=float)
+
+    # Parse every resample string once and group the specs by dataset and period grid
+    grids = {}
+    groups = {}
+    for i, spec in enumerate(specs):
+        ID, resampleString, resampleMethod = spec[:3]
+
+        if resampleMethod not in RESAMPLE_METHODS:
+            return predictorMatrix, 1, "Invalid resampling method for {0}. Provide one of 'accumulation', 'average', 'first', 'last', 'max', 'min', 'custom'".format(spec)
+
+        if resampleString not in grids:
+            parsed, code, message = parseResampleString(resampleString)
+            if code != 0:
+                return predictorMatrix, code, message
+            startDate, period, frequency = parsed
+            if startDate + frequency < startDate + isodate.Duration(years=1):
+                return predictorMatrix, 1, 'Invalid Resample String {0}. Predictors must repeat once a year or less often (e.g. F1Y)'.format(resampleString)
+            grids[resampleString] = resamplePeriods(startDate, period, frequency, today)
+
+        groups.setdefault(int(ID), {}).setdefault(resampleString, []).append(i)
+
+    # Pull each required dataset out of the dataTable once
+    if isinstance(dataTable, DataStore):
+        datasets = {ID: dataTable.series(ID) for ID in groups if ID in dataTable}
+    else:
+        values = dataTable['Value']
+        values = values[values.index.get_level_values('DatasetInternalID').isin(list(groups.keys()))]
+        datasets = {ID: series.droplevel('DatasetInternalID').sort_index() for ID, series in values.groupby(level='DatasetInternalID')}
+
+    # Compute the reductions
+    results = {}
+    for ID, gridGroups in groups.items():
+        dailyData = datasets.get(ID, pd.Series([], index = pd.DatetimeIndex([]), dtype=float))
+        dailyValues = np.ascontiguousarray(dailyData.values, dtype=float)
+        shared = {}
+
+        for resampleString, specIndices in gridGroups.items():
+            lefts, rights = grids[resampleString]
+            lo, hi = periodPositions(dailyData.index, lefts, rights)
+            shared.clear()
+
+            for i in specIndices:
+                resampleMethod = specs[i][2]
+                if resampleMethod == 'custom':
+                    try:
+                        reduced = evaluateCustomFunction(compileCustomFunction(specs[i][3]), dailyValues, lo, hi)
+                    except Exception as E:
+                        return predictorMatrix, 1, 'Invalid custom function for {0}: {1}'.format(specs[i], E)
+                else:
+                    reduced = reducePeriods(dailyValues, lo, hi, resampleMethod, shared).copy()
+                maskIncompletePeriods(reduced, rights, dailyData.index, today)
+                results[i] = pd.Series(reduced, index = pd.Index(lefts.astype('datetime64[Y]').astype(int) + 1970, name='Year'))
+
+    # Assemble the matrix in the order the specs were given
+    predictorMatrix = pd.concat([results[i] for i in range(len(specs))], axis=1) if specs else predictorMatrix
+    predictorMatrix.columns = columns
+
+    return predictorMatrix, 0, 'Procedure Exited Normally'
+
+
+def parseResampleString(resampleString):
+    """
+    Parses and validates a resample string (see resampleDataSet)
+
+    Output:
+        (startDate, period, frequency) -> datetime, and timedelta / isodate.Duration objects
+        code -> 0 if the string is valid, 1 otherwise
+        message -> description of any error
+    """
+    resampleList = resampleString.split('/') # Converts 'R/1978-10-01/P1M/F1Y' into ['R', '1978-10-01', 'P1M', 'F1Y']
+
+    # Validate the list
+    if len(resampleList) != 4 or resampleList[0] != 'R' or len(resampleList[1]) != 10 or resampleList[2][:1] != 'P' or resampleList[3][:1] != 'F':
+        return None, 1, 'Invalid Resample String. Format should be similar to R/1978-10-01/P1M/F1Y'
+
+    # Parse into values
+    try:
+        startDate = datetime.strptime(resampleList[1], '%Y-%m-%d') # >>> datetime.date(1978, 10, 1)
+        period = isodate.parse_duration(resampleList[2]) # >>> isodate.duration.Duration(0, 0, 0, years=0, months=1)
+        frequency = isodate.parse_duration(resampleList[3].replace('F', 'P')) # >>> isodate.duration.Duration(0, 0, 0, years=1, months=1)
+    except (ValueError, isodate.ISO8601Error):
+        return None, 1, 'Invalid Resample String. Format should be similar to R/1978-10-01/P1M/F1Y'
+
+    # The data is daily, so periods and frequencies must be whole days (or months / years)
+    if not (isWholeDays(period) and isWholeDays(frequency)):
+        return None, 1, 'Invalid Resample String. The period and frequency must be whole numbers of days, months or years (e.g. P1D, not PT12H)'
+
+    # Make sure the periods actually advance and cover at least a day
+    if startDate + frequency <= startDate:
+        return None, 1, 'Invalid Resample String. The frequency must be a positive duration'
+    if startDate + period <= startDate:
+        return None, 1, 'Invalid Resample String. The period must be at least one day long'
+
+    return (startDate, period, frequency), 0, 'Procedure Exited Normally'
+
+
+def isWholeDays(duration):
+    """
+    Returns True if a timedelta or isodate.Duration has no sub-day part (hours, minutes, ...) and whole
+    numbers of months and years
+    """
+    if isinstance(duration, isodate.Duration):
+        if duration.years != int(duration.years) or duration.months != int(duration.months):
+            return False
+        duration = duration.tdelta
+
+    return duration.seconds == 0 and duration.microseconds == 0
+
+
+def maskIncompletePeriods(values, rights, dailyIndex, today):
+    """
+    Sets periods that end before the data starts, or that haven't finished yet, to NaN (in place)
+    """
+    if len(dailyIndex) > 0:
+        values[(rights < np.datetime64(dailyIndex[0], 'ns')) | (rights > np.datetime64(today, 'ns'))] = np.nan
+    else:
+        values[:] = np.nan
+
+    return
+
+
+def resamplePeriods(startDate, period, frequency, today):
+    """
+    Computes the boundaries of every resampling period that starts on or before 'today'.
+
+    The n-th period starts at startDate + n*frequency and ends at (start + period). Whole-month
+    frequencies and pure day/week frequencies are computed directly with datetime64 arithmetic.
+    Month frequencies starting after the 28th of a month are stepped one period at a time so that
+    the day-of-month clamping matches repeated calendar addition (e.g. Jan 31 -> Feb 28 -> Mar 28).
+
+    Input:
+        startDate -> datetime of the first period's start
+        period -> timedelta or isodate.Duration of each period
+        frequency -> timedelta or isodate.Duration between period starts
+        today -> datetime. No period starts after this date.
+
+    Output:
+        lefts -> datetime64[ns] array of period start dates
+        rights -> datetime64[ns] array of period end dates
+    """
+
+    start = np.datetime64(startDate, 'D')
+    todayDay = np.datetime64(today, 'D')
+    freqMonths, freqDays = durationParts(frequency)
+    perMonths, perDays = durationParts(period)
+
+    if freqMonths == 0:
+        # Fixed length frequency, e.g. F7D
+        count = max(int((todayDay - start) // np.timedelta64(freqDays, 'D')) + 1, 0)
+        lefts = start + np.arange(count) * np.timedelta64(freqDays, 'D')
+
+    elif freqDays == 0 and startDate.day <= 28:
+        # Whole month frequency, e.g. F1Y or F3M. No day-of-month clamping can occur.
+        monthsElapsed = (todayDay.astype('datetime64[M]') - start.astype('datetime64[M]')).astype(int)
+        count = max(monthsElapsed // freqMonths + 1, 0)
+        lefts = addMonths(np.full(count, start), np.arange(count) * freqMonths)
+
+    else:
+        # Step through the calendar one period at a time
+        starts = []
+        tracker = startDate
+        while tracker <= today:
+            starts.append(tracker)
+            tracker += frequency
+        lefts = np.array(starts, dtype='datetime64[D]')
+
+    lefts = lefts[lefts <= todayDay]
+    rights = addMonths(lefts, perMonths) + np.timedelta64(perDays, 'D')
+
+    return lefts.astype('datetime64[ns]'), rights.astype('datetime64[ns]')
+
+
+def durationParts(duration):
+    """
+    Splits a timedelta or isodate.Duration into a whole number of months and a whole number of days
+    """
+    if isinstance(duration, isodate.Duration):
+        return int(duration.years*12 + duration.months), duration.tdelta.days
+
+    return 0, duration.days
+
+
+def addMonths(dates, months):
+    """
+    Adds a number of calendar months to an array of datetime64[D] dates. Days that
+    don't exist in the resulting month are clamped to the end of the month (the same 
+    way isodate adds months to a date).
+    """
+    monthStart = dates.astype('datetime64[M]')
+    dayOfMonth = (dates - monthStart.astype('datetime64[D]')).astype(int)
+    newMonth = monthStart + np.asarray(months).astype('timedelta64[M]')
+    daysInNewMonth = ((newMonth + 1).astype('datetime64[D]') - newMonth.astype('datetime64[D]')).astype(int)
+
+    return newMonth.astype('datetime64[D]') + np.minimum(dayOfMonth, daysInNewMonth - 1).astype('timedelta64[D]')
+
+
+def periodPositions(dailyIndex, lefts, rights):
+    """
+    Maps period boundaries onto integer positions in a sorted DatetimeIndex. 
+    Period 'i' covers dailyIndex[lo[i]:hi[i]], which includes both the left and right dates.
+    """
+    indexValues = np.asarray(dailyIndex.values, dtype='datetime64[ns]')
+    lo = np.searchsorted(indexValues, lefts, side='left')
+    hi = np.searchsorted(indexValues, rights, side='right')
+
+    return lo, hi
+
+
+def segmentReduce(ufunc, values, lo, hi, identity):
+    """
+    Applies a numpy ufunc reduction (e.g. np.add or np.maximum) over every segment values[lo[i]:hi[i]]
+    with a single call to ufunc.reduceat. Empty segments return the identity value.
+    """
+    # Pad the array so that an end position equal to len(values) is still a valid reduceat index
+    padded = np.append(values, identity)
+
+    # Interleave the start and end positions. Every even reduceat result is a lo:hi segment.
+    indices = np.empty(2*len(lo), dtype=np.intp)
+    indices[0::2] = lo
+    indices[1::2] = hi
+    if len(indices) == 0:
+        return np.array([], dtype=padded.dtype)
+    reduced = ufunc.reduceat(padded, indices)[0::2]
+
+    return np.where(hi > lo, reduced, identity)
+
+
+def reducePeriods(values, lo, hi, resampleMethod, shared = None):
+    """
+    Reduces a float array of daily values over every period values[lo[i]:hi[i]]. 
+    Missing values (NaN's) are skipped for all methods except 'first' and 'last'.
+
+    Input:
+        values -> float numpy array of daily data
+        lo, hi -> integer arrays of period positions (see periodPositions)
+        resampleMethod -> One of 'accumulation', 'average', 'first', 'last', 'max', 'min'
+        shared (optional) -> dictionary used to share intermediate arrays (missing value counts, 
+                             period sums) between calls over the same values and periods
+
+    Output:
+        reduced -> float numpy array with one value per period
+    """
+    if shared is None:
+        shared = {}
+
+    if 'counts' not in shared:
+        notMissing = ~np.isnan(values)
+        shared['notMissing'] = notMissing
+        shared['counts'] = segmentReduce(np.add, notMissing.astype(np.int64), lo, hi, 0)
+    notMissing = shared['notMissing']
+    counts = shared['counts']
+
+    if resampleMethod in ['accumulation', 'average'] and 'sums' not in shared:
+        shared['sums'] = segmentReduce(np.add, np.where(notMissing, values, 0.0), lo, hi, 0.0)
+
+    if resampleMethod == 'accumulation':
+        return shared['sums']
+
+    elif resampleMethod == 'average':
+        sums = shared['sums']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    elif resampleMethod == 'max':
+        reduced = segmentReduce(np.maximum, np.where(notMissing, values, -np.inf), lo, hi, -np.inf)
+        return np.where(counts > 0, reduced, np.nan)
+
+    elif resampleMethod == 'min':
+        reduced = segmentReduce(np.minimum, np.where(notMissing, values, np.inf), lo, hi, np.inf)
+        return np.where(counts > 0, reduced, np.nan)
+
+    elif resampleMethod == 'first':
+        padded = np.append(values, np.nan)
+        return np.where(hi > lo, padded[lo], np.nan)
+
+    elif resampleMethod == 'last':
+        padded = np.append(values, np.nan)
+        return np.where(hi > lo, padded[np.maximum(hi - 1, 0)], np.nan)
+
+
+@lru_cache(maxsize=256)
+def compileCustomFunction(customFunction):
+    """
+    Validates and compiles a custom resample function (e.g. "np.nanmax(x) / abs(x[0])").
+
+    The expression is parsed and checked against a whitelist: numbers, arithmetic and comparison 
+    operators, the variable 'x', subscripts of 'x' (e.g. x[0], x[-5:]), and calls to the numpy 
+    functions in CUSTOM_FUNCTION_NUMPY or the builtins in CUSTOM_FUNCTION_BUILTINS. Anything else
+    (attribute access, other names, lambdas, comprehensions, etc.) raises a ValueError.
+
+    The expression is rewritten to operate on a 2-D (periods x days) array: reductions are given 
+    'axis=-1, keepdims=True' and subscripts of x index the day axis. An axis given for a reduction
+    (e.g. np.max(x, 0)) must be 0, -1 or None, which all meant the whole period when x was a Series.
+    Builtins (max(x), len(x), ...) take the data as their only argument. Numpy reductions that used to
+    skip missing values on a Series (np.mean, np.sum, ...) run as their nan-versions (see 
+    CUSTOM_FUNCTION_NAN_SKIPPING). Exponents must be numbers no bigger than CUSTOM_FUNCTION_MAX_EXPONENT.
+    Compiled expressions are cached by their text.
+
+    Output:
+        code -> compiled code object for evaluateCustomFunction
+    """
+    try:
+        tree = ast.parse(customFunction.strip(), mode='eval')
+    except SyntaxError as E:
+        raise ValueError("could not parse '{0}' ({1})".format(customFunction, E.msg))
+
+    tree = ast.fix_missing_locations(CustomFunctionTransformer().visit(tree))
+
+    return compile(tree, '<custom resample function>', 'eval')
+
+
+class CustomFunctionTransformer(ast.NodeTransformer):
+    """
+    Checks custom resample functions against the whitelist and rewrites them to operate on 
+    a 2-D (periods x days) array. See compileCustomFunction.
+    """
+    allowedNodes = (
+        ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Attribute, ast.Subscript, ast.Slice, ast.Constant, ast.Load,
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd,
+        ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.keyword)
+
+    def generic_visit(self, node):
+        if not isinstance(node, self.allowedNodes):
+            raise ValueError("'{0}' is not allowed in custom functions".format(type(node).__name__))
+        return super(CustomFunctionTransformer, self).generic_visit(node)
+
+    def visit_BinOp(self, node):
+        if isinstance(node.op, ast.Pow):
+            exponent = node.right.operand if isinstance(node.right, ast.UnaryOp) and isinstance(node.right.op, (ast.USub, ast.UAdd)) else node.right
+            if not isinstance(exponent, ast.Constant) or not isinstance(exponent.value, (int, float)) or abs(exponent.value) > CUSTOM_FUNCTION_MAX_EXPONENT:
+                raise ValueError("exponents must be numbers between -{0} and {0}".format(CUSTOM_FUNCTION_MAX_EXPONENT))
+        return self.generic_visit(node)
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+            raise ValueError("only numeric constants are allowed in custom functions")
+        return node
+
+    def visit_Name(self, node):
+        if node.id != 'x':
+            raise ValueError("unknown name '{0}'. Use 'x' for the data and 'np' for numpy".format(node.id))
+        return node
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.value, ast.Name) or node.value.id != 'np' or node.attr not in CUSTOM_FUNCTION_NUMPY:
+            raise ValueError("'{0}' is not an allowed function".format(node.attr))
+        return node
+
+    def visit_Subscript(self, node):
+        if not isinstance(node.value, ast.Name) or node.value.id != 'x':
+            raise ValueError("only 'x' can be indexed in custom functions")
+        index = self.visit(node.slice)
+        if any(isinstance(child, (ast.Name, ast.Call)) for child in ast.walk(index)):
+            raise ValueError("subscripts of 'x' must be numbers or slices, e.g. x[0] or x[-5:]")
+
+        # Index the day axis. Single positions are wrapped in a list so that the day axis is kept.
+        if not isinstance(index, ast.Slice):
+            index = ast.List(elts=[index], ctx=ast.Load())
+        node.slice = ast.Tuple(elts=[ast.Constant(value=Ellipsis), index], ctx=ast.Load())
+        return node
+
+    @staticmethod
+    def isDayAxis(axis):
+        """
+        Returns True if an axis argument is 0, -1 or None (the whole of a 1-D Series)
+        """
+        if isinstance(axis, ast.UnaryOp) and isinstance(axis.op, ast.USub) and isinstance(axis.operand, ast.Constant):
+            return type(axis.operand.value) is int and axis.operand.value == 1
+        return isinstance(axis, ast.Constant) and (axis.value is None or (type(axis.value) is int and axis.value == 0))
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and node.func.id in CUSTOM_FUNCTION_BUILTINS:
+            if len(node.args) != 1 or node.keywords != []:
+                raise ValueError("{0}() takes one argument in custom functions, e.g. {0}(x)".format(node.func.id))
+            name = CUSTOM_FUNCTION_BUILTINS[node.func.id]
+        elif isinstance(node.func, ast.Attribute):
+            self.visit_Attribute(node.func)
+            name = CUSTOM_FUNCTION_NAN_SKIPPING.get(node.func.attr, node.func.attr)
+        else:
+            raise ValueError("'{0}' is not an allowed function".format(getattr(node.func, 'id', type(node.func).__name__)))
+
+        if any(kw.arg in ['keepdims', 'out', 'where'] or kw.arg is None for kw in node.keywords):
+            raise ValueError("the 'keepdims', 'out' and 'where' arguments are set automatically")
+
+        # Reductions always run over each period's days, so an axis the expression gives is taken out
+        if name in CUSTOM_FUNCTION_REDUCTIONS:
+            axisPosition = CUSTOM_FUNCTION_AXIS_POSITION.get(name, 1)
+            if len(node.args) > axisPosition + 1:
+                raise ValueError("too many arguments for np.{0}".format(node.func.attr))
+            axes = node.args[axisPosition:] + [kw.value for kw in node.keywords if kw.arg == 'axis']
+            for axis in axes:
+                if not self.isDayAxis(axis):
+                    raise ValueError("'x' only has one axis, so the axis of np.{0} can only be 0, -1 or None".format(node.func.attr))
+            node.args = node.args[:axisPosition]
+            node.keywords = [kw for kw in node.keywords if kw.arg != 'axis']
+        elif any(kw.arg == 'axis' for kw in node.keywords):
+            raise ValueError("np.{0} doesn't take an axis in custom functions".format(node.func.attr))
+
+        node.func = ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()), attr=name, ctx=ast.Load())
+        node.args = [self.visit(arg) for arg in node.args]
+        node.keywords = [ast.keyword(arg=kw.arg, value=self.visit(kw.value)) for kw in node.keywords]
+
+        # Reduce each period separately
+        if name in CUSTOM_FUNCTION_REDUCTIONS or name == 'size':
+            node.keywords += [ast.keyword(arg='axis', value=ast.Constant(value=-1))]
+            if name == 'size':
+                node.func.attr = 'sum'
+                node.args = [ast.Call(func=ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()), attr='ones_like', ctx=ast.Load()), args=node.args, keywords=[])]
+            node.keywords += [ast.keyword(arg='keepdims', value=ast.Constant(value=True))]
+
+        return node
+
+
+def evaluateCustomFunction(code, values, lo, hi):
+    """
+    Evaluates a compiled custom function (see compileCustomFunction) over every period values[lo[i]:hi[i]].
+
+    Periods that have the same number of days are stacked into a 2-D (periods x days) array and 
+    reduced with a single evaluation, so a typical record (where almost every period is the same
+    length) only needs a handful of evaluations. Empty periods return NaN.
+
+    Output:
+        reduced -> float numpy array with one value per period
+    """
+    reduced = np.full(len(lo), np.nan)
+    lengths = hi - lo
+
+    for length in np.unique(lengths):
+        if length <= 0:
+            continue
+
+        # Stack every period of this length into a 2-D array
+        periodIdx = np.flatnonzero(lengths == length)
+        x = values[lo[periodIdx, np.newaxis] + np.arange(length)]
+
+        # (All-missing periods return NaN without warnings)
+        with np.errstate(all='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result = np.asarray(eval(code, {'__builtins__': {}, 'np': np}, {'x': x}), dtype=float)
+
+        # Every period must reduce to a single value
+        if result.ndim > 0 and result.shape[-1] != 1:
+            raise ValueError('the function must reduce each period to a single value (e.g. np.nanmean(x))')
+        reduced[periodIdx] = np.broadcast_to(result.reshape(result.shape[:-1]) if result.ndim > 0 else result, periodIdx.shape)
 
-    return resampleData, 0, 'Procedure Exited Normally'
\ No newline at end of file
+    return reduced
@@ -0,0 +1,499 @@
+"""
+Script name:    DataStore.py
+Description:    The DataStore.py script defines the columnar store that holds all of the raw daily data
+                in the application. Data is stored in one dense float64 array (daily dates x datasets)
+                along with a parallel boolean array of edit flags. The store can also produce the long
+                (Datetime, DatasetInternalID) MultiIndex 'dataTable' view for code that expects it.
+"""
+
+import pandas as pd
+import numpy as np
+
+# Number of extra days / datasets to allocate whenever the arrays need to grow, so
+# that appending a few days of data or a single dataset doesn't copy the whole store.
+DATE_HEADROOM = 366
+COLUMN_HEADROOM = 16
+
+
+class DataStore(object):
+    """
+    Columnar store of daily data.
+
+    Rows are a contiguous daily DatetimeIndex (starting at 'startDate'), so finding the row of a date
+    is a subtraction. Columns are datasets (by DatasetInternalID). The arrays are stored column-major,
+    so a dataset's data is a contiguous, zero-copy slice of the values array.
+
+    Missing data is stored as NaN. The 'version' counter increases every time the data changes.
+    """
+
+    def __init__(self):
+        self.startDate = None # numpy datetime64[D] of row 0
+        self.numDates = 0
+        self.values = np.full((0, 0), np.nan, order='F')
+        self.editFlags = np.zeros((0, 0), dtype=bool, order='F')
+        self.columnIDs = [] # DatasetInternalID of each column, in column order
+        self.columnIndex = {} # DatasetInternalID -> column position
+        self.version = 0
+        self.cachedLongView = None
+        self.cachedLongViewVersion = -1
+
+    @classmethod
+    def fromLongTable(cls, dataTable):
+        """
+        Builds a store from a long (Datetime, DatasetInternalID) MultiIndex dataframe with 'Value' and 'EditFlag' columns
+        """
+        store = cls()
+        if dataTable is None or dataTable.empty:
+            return store
+
+        dates = dataTable.index.get_level_values('Datetime')
+        IDs = dataTable.index.get_level_values('DatasetInternalID')
+        editFlags = dataTable['EditFlag'].fillna(False).values.astype(bool) if 'EditFlag' in dataTable.columns else None
+        store.setValues(dates, IDs, dataTable['Value'].values, editFlags)
+
+        return store
+
+    # ------------------------------------------------------------------
+    # Shape and lookups
+    # ------------------------------------------------------------------
+
+    @property
+    def empty(self):
+        return self.numDates == 0 or len(self.columnIDs) == 0
+
+    @property
+    def dates(self):
+        """
+        The daily DatetimeIndex of the rows
+        """
+        if self.startDate is None:
+            return pd.DatetimeIndex([], name='Datetime')
+        return pd.DatetimeIndex(self.startDate + np.arange(self.numDates), name='Datetime')
+
+    @property
+    def datasetIDs(self):
+        return list(self.columnIDs)
+
+    def __contains__(self, datasetID):
+        return datasetID in self.columnIndex
+
+    def rowsOf(self, dates):
+        """
+        Converts dates (anything pd.to_datetime accepts) into row positions. Dates are floored to the day.
+        Rows can be negative or past the end for dates outside the store.
+        """
+        dates = np.asarray(pd.to_datetime(dates).values).astype('datetime64[D]')
+        if self.startDate is None:
+            return np.zeros(dates.shape, dtype=np.intp)
+        return (dates - self.startDate).astype(np.intp)
+
+    def columnsOf(self, datasetIDs):
+        """
+        Converts an array of DatasetInternalIDs into column positions (-1 for datasets that aren't in the store).
+        Each distinct ID is only looked up once.
+        """
+        codes, uniqueIDs = pd.factorize(np.asarray(datasetIDs))
+        positions = np.array([self.columnIndex.get(ID, -1) for ID in uniqueIDs.tolist()] + [-1], dtype=np.intp)
+
+        return positions[codes]
+
+    def cellOf(self, date, datasetID):
+        """
+        Returns the (row, column) of a single cell without any array conversions, or (-1, -1) if it is outside the store
+        """
+        col = self.columnIndex.get(datasetID, -1)
+        if col < 0:
+            return -1, -1
+        row = int((np.datetime64(pd.Timestamp(date).normalize(), 'D') - self.startDate).astype(np.int64))
+        if not 0 <= row < self.numDates:
+            return -1, -1
+        return row, col
+
+    def getValue(self, date, datasetID):
+        """
+        Returns a single value (NaN if the cell is outside the store)
+        """
+        row, col = self.cellOf(date, datasetID)
+        return np.nan if row < 0 else self.values[row, col]
+
+    def column(self, datasetID):
+        """
+        Returns the values for a dataset as a (writable) view into the store
+        """
+        return self.values[:self.numDates, self.columnIndex[datasetID]]
+
+    def editFlagColumn(self, datasetID):
+        """
+        Returns the edit flags for a dataset as a (writable) view into the store
+        """
+        return self.editFlags[:self.numDates, self.columnIndex[datasetID]]
+
+    def validRange(self, datasetID):
+        """
+        Returns the (first, last + 1) rows that contain data for a dataset, or (0, 0) if there is no data
+        """
+        if datasetID not in self.columnIndex:
+            return 0, 0
+        valid = np.flatnonzero(~np.isnan(self.column(datasetID)))
+        if len(valid) == 0:
+            return 0, 0
+        return valid[0], valid[-1] + 1
+
+    def lastStoredDates(self, datasetIDs):
+        """
+        Returns the last date with a downloaded (non-NaN, non-edited) value for each dataset.
+        Edited values are skipped because they don't say anything about what the agency has published.
+
+        Output:
+            lastDates -> pd.Series (NaT for datasets with no stored data), indexed by DatasetInternalID
+        """
+        lastDates = pd.Series(pd.NaT, index=pd.Index(list(datasetIDs)), dtype='datetime64[ns]')
+        for datasetID in lastDates.index:
+            if datasetID not in self.columnIndex:
+                continue
+            downloaded = np.flatnonzero(~np.isnan(self.column(datasetID)) & ~self.editFlagColumn(datasetID))
+            if len(downloaded) > 0:
+                lastDates[datasetID] = pd.Timestamp(self.startDate + downloaded[-1])
+
+        return lastDates
+
+    def series(self, datasetID):
+        """
+        Returns a dataset as a daily pandas Series spanning the first to the last date with data.
+        The series shares memory with the store.
+        """
+        first, last = self.validRange(datasetID)
+        if last == 0:
+            return pd.Series([], index=pd.DatetimeIndex([]), dtype=float, name=str(datasetID))
+        return pd.Series(self.column(datasetID)[first:last], index=self.dates[first:last], name=str(datasetID), copy=False)
+
+    def getValues(self, dates, datasetIDs):
+        """
+        Bulk lookup of (date, DatasetInternalID) pairs. Missing pairs return (NaN, False).
+
+        Output:
+            values -> float array
+            editFlags -> bool array
+        """
+        rows = self.rowsOf(dates)
+        cols = self.columnsOf(datasetIDs).reshape(rows.shape)
+        found = (rows >= 0) & (rows < self.numDates) & (cols >= 0)
+
+        values = np.full(rows.shape, np.nan)
+        editFlags = np.zeros(rows.shape, dtype=bool)
+        values[found] = self.values[rows[found], cols[found]]
+        editFlags[found] = self.editFlags[rows[found], cols[found]]
+
+        return values, editFlags
+
+    # ------------------------------------------------------------------
+    # Growing and shrinking the store
+    # ------------------------------------------------------------------
+
+    def reallocate(self, numRows, numColumns, rowOffset = 0):
+        """
+        Copies the data into new arrays with room for numRows x numColumns (plus headroom).
+        Existing rows are shifted down by rowOffset rows.
+        """
+        rowCapacity = max(numRows + DATE_HEADROOM, self.values.shape[0] + rowOffset)
+        columnCapacity = max(numColumns + COLUMN_HEADROOM, self.values.shape[1])
+
+        values = np.full((rowCapacity, columnCapacity), np.nan, order='F')
+        editFlags = np.zeros((rowCapacity, columnCapacity), dtype=bool, order='F')
+        values[rowOffset:rowOffset + self.numDates, :len(self.columnIDs)] = self.values[:self.numDates, :len(self.columnIDs)]
+        editFlags[rowOffset:rowOffset + self.numDates, :len(self.columnIDs)] = self.editFlags[:self.numDates, :len(self.columnIDs)]
+        self.values = values
+        self.editFlags = editFlags
+
+        return
+
+    def extendDates(self, firstDate, lastDate):
+        """
+        Grows the daily date range of the store so that it covers firstDate through lastDate
+        """
+        firstDate = np.datetime64(pd.Timestamp(firstDate), 'D')
+        lastDate = np.datetime64(pd.Timestamp(lastDate), 'D')
+
+        if self.startDate is None:
+            self.startDate = firstDate
+            self.reallocate(int((lastDate - firstDate).astype(int)) + 1, len(self.columnIDs))
+            self.numDates = int((lastDate - firstDate).astype(int)) + 1
+            self.version += 1
+            return
+
+        # Add rows to the beginning of the store
+        if firstDate < self.startDate:
+            offset = int((self.startDate - firstDate).astype(int))
+            self.reallocate(self.numDates + offset, len(self.columnIDs), rowOffset=offset)
+            self.startDate = firstDate
+            self.numDates += offset
+            self.version += 1
+
+        # Add rows to the end of the store
+        numDates = int((lastDate - self.startDate).astype(int)) + 1
+        if numDates > self.numDates:
+            if numDates > self.values.shape[0]:
+                self.reallocate(numDates, len(self.columnIDs))
+            self.numDates = numDates
+            self.version += 1
+
+        return
+
+    def addColumn(self, datasetID):
+        """
+        Adds an empty (all NaN) column for a dataset. Does nothing if the dataset already exists.
+        """
+        if datasetID in self.columnIndex:
+            return
+        if len(self.columnIDs) >= self.values.shape[1]:
+            self.reallocate(self.numDates, len(self.columnIDs) + 1)
+
+        position = len(self.columnIDs)
+        self.values[:, position] = np.nan
+        self.editFlags[:, position] = False
+        self.columnIDs.append(datasetID)
+        self.columnIndex[datasetID] = position
+        self.version += 1
+
+        return
+
+    def removeColumn(self, datasetID):
+        """
+        Removes a dataset (and all of its data) from the store
+        """
+        if datasetID not in self.columnIndex:
+            return
+
+        position = self.columnIndex[datasetID]
+        numColumns = len(self.columnIDs)
+        self.values[:, position:numColumns - 1] = self.values[:, position + 1:numColumns]
+        self.editFlags[:, position:numColumns - 1] = self.editFlags[:, position + 1:numColumns]
+        self.values[:, numColumns - 1] = np.nan
+        self.editFlags[:, numColumns - 1] = False
+
+        del self.columnIDs[position]
+        self.columnIndex = {ID: i for i, ID in enumerate(self.columnIDs)}
+        self.version += 1
+
+        return
+
+    # ------------------------------------------------------------------
+    # Writing data
+    # ------------------------------------------------------------------
+
+    def setValue(self, date, datasetID, value, editFlag = None):
+        """
+        Sets a single value. The edit flag is left alone unless one is given.
+        """
+        row, col = self.cellOf(date, datasetID)
+        if row < 0:
+            self.setValues([date], [datasetID], [value], None if editFlag is None else [editFlag])
+            return
+
+        self.values[row, col] = value
+        if editFlag is not None:
+            self.editFlags[row, col] = editFlag
+        self.version += 1
+
+        return
+
+    def setValues(self, dates, datasetIDs, values, editFlags = None):
+        """
+        Bulk-writes values for (date, DatasetInternalID) pairs, growing the store to fit any new dates or datasets.
+        Edit flags are left alone unless they're given. If a pair appears more than once, the last value is kept.
+        """
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+
+        # Make room for any new dates and datasets
+        rows, cols = self.makeRoomFor(dates, datasetIDs)
+
+        # Write the data
+        self.values[rows, cols] = values
+        if editFlags is not None:
+            self.editFlags[rows, cols] = np.asarray(editFlags, dtype=bool)
+        self.version += 1
+
+        return
+
+    def makeRoomFor(self, dates, datasetIDs):
+        """
+        Grows the store to fit the given (date, DatasetInternalID) pairs and returns their row and column positions
+        """
+        dates = pd.DatetimeIndex(pd.to_datetime(dates))
+        self.extendDates(dates.min(), dates.max())
+        for ID in pd.unique(np.asarray(datasetIDs)).tolist():
+            self.addColumn(ID)
+
+        return self.rowsOf(dates), self.columnsOf(datasetIDs)
+
+    def merge(self, newDataTable):
+        """
+        Merges newly downloaded (or imported / computed) data into the store in place.
+
+        Incoming (Datetime, DatasetInternalID) keys are aligned against the store using integer row and column 
+        positions, and every incoming cell is classified in one vectorized pass:
+            new      -> the store had no value for this cell
+            updated  -> the store had a different, unedited value
+            conflict -> the store had a different value that the user edited
+        Changed cells are written to the store. Edited cells keep their edit flag.
+
+        Input:
+            newDataTable -> long (Datetime, DatasetInternalID) MultiIndex dataframe with a 'Value' column. 
+                            If a key appears more than once, the last value is used.
+
+        Output:
+            changes -> ChangeSet describing every cell that changed
+        """
+        if newDataTable.empty:
+            return ChangeSet.emptyChangeSet()
+
+        dates = newDataTable.index.get_level_values('Datetime')
+        IDs = newDataTable.index.get_level_values('DatasetInternalID')
+        newValues = newDataTable['Value'].values.astype(float)
+
+        # Find the position of every incoming cell
+        rows, cols = self.makeRoomFor(dates, IDs)
+
+        # Keep the last of any duplicated keys
+        flatKeys = rows.astype(np.int64) * self.values.shape[1] + cols
+        reversedUnique = np.unique(flatKeys[::-1], return_index=True)[1]
+        keep = np.sort(len(flatKeys) - 1 - reversedUnique)
+        rows, cols, newValues = rows[keep], cols[keep], newValues[keep]
+
+        # Classify the incoming cells
+        oldValues = self.values[rows, cols]
+        editFlags = self.editFlags[rows, cols]
+        oldMissing = np.isnan(oldValues)
+        changed = (oldValues != newValues) & ~(oldMissing & np.isnan(newValues))
+        changeTypes = np.where(editFlags, ChangeSet.CONFLICT, np.where(oldMissing, ChangeSet.NEW, ChangeSet.UPDATED))
+
+        # Write the changes in place
+        rows, cols = rows[changed], cols[changed]
+        self.values[rows, cols] = newValues[changed]
+        if changed.any():
+            self.version += 1
+
+        return ChangeSet(
+            dates = self.startDate + rows.astype('timedelta64[D]'),
+            datasetIDs = np.array(self.columnIDs, dtype=object)[cols] if len(cols) > 0 else np.array([], dtype=object),
+            oldValues = oldValues[changed],
+            newValues = newValues[changed],
+            editFlags = editFlags[changed],
+            changeTypes = changeTypes[changed])
+
+    # ------------------------------------------------------------------
+    # Views for code that hasn't moved over to the store
+    # ------------------------------------------------------------------
+
+    def wideView(self, datasetIDs = None):
+        """
+        Returns the data as a wide dataframe (Datetime x DatasetInternalID)
+        """
+        datasetIDs = self.columnIDs if datasetIDs is None else datasetIDs
+        cols = [self.columnIndex[ID] for ID in datasetIDs]
+        return pd.DataFrame(self.values[:self.numDates, cols], index=self.dates, columns=pd.Index(datasetIDs, name='DatasetInternalID'))
+
+    def longView(self):
+        """
+        Returns the data as the long (Datetime, DatasetInternalID) MultiIndex dataframe with 'Value'
+        and 'EditFlag' columns. Each dataset has a row for every day from its first to its last value.
+
+        The view is rebuilt only when the store changes, and every caller gets its own (shallow) copy
+        of it. The copies share read-only arrays, so changing one can't change what later callers get.
+        Changes made to the view are not written back to the store.
+        """
+        if self.cachedLongViewVersion == self.version:
+            return self.cachedLongView.copy(deep = False)
+
+        numColumns = len(self.columnIDs)
+        values = self.values[:self.numDates, :numColumns]
+        editFlags = self.editFlags[:self.numDates, :numColumns]
+
+        # Keep every row between each dataset's first and last value
+        hasData = ~np.isnan(values) | editFlags
+        cumulative = np.cumsum(hasData, axis=0)
+        keep = (cumulative > 0) & (cumulative < cumulative[-1:, :] + hasData) if self.numDates > 0 else hasData
+        rows, cols = np.nonzero(keep)
+
+        index = pd.MultiIndex.from_arrays([self.dates[rows], np.array(self.columnIDs, dtype=object)[cols].astype(int) if numColumns > 0 else np.array([], dtype=int)], names=['Datetime', 'DatasetInternalID'])
+        columns = {'Value': values[rows, cols], 'EditFlag': editFlags[rows, cols]}
+        for column in columns.values():
+            column.flags.writeable = False
+        longView = pd.DataFrame(columns, index=index, copy=False)
+
+        self.cachedLongView = longView
+        self.cachedLongViewVersion = self.version
+
+        return longView.copy(deep = False)
+
+
+class ChangeSet(object):
+    """
+    A compact description of the cells changed by DataStore.merge. Each changed cell has a date, 
+    a DatasetInternalID, its old and new values, its edit flag, and a change type (NEW, UPDATED or CONFLICT).
+    """
+
+    NEW = 0
+    UPDATED = 1
+    CONFLICT = 2
+
+    def __init__(self, dates, datasetIDs, oldValues, newValues, editFlags, changeTypes):
+        self.dates = np.asarray(dates).astype('datetime64[ns]')
+        self.datasetIDs = np.asarray(datasetIDs)
+        self.oldValues = np.asarray(oldValues, dtype=float)
+        self.newValues = np.asarray(newValues, dtype=float)
+        self.editFlags = np.asarray(editFlags, dtype=bool)
+        self.changeTypes = np.asarray(changeTypes, dtype=np.int8)
+
+    @classmethod
+    def emptyChangeSet(cls):
+        return cls(np.array([], dtype='datetime64[ns]'), np.array([], dtype=object), [], [], [], [])
+
+    @classmethod
+    def concatenate(cls, changeSets):
+        """
+        Combines several change-sets (e.g. from successive merges) into one
+        """
+        changeSets = [changes for changes in changeSets if not changes.empty]
+        if len(changeSets) == 0:
+            return cls.emptyChangeSet()
+        return cls(*[np.concatenate([getattr(changes, attr) for changes in changeSets]) for attr in ['dates', 'datasetIDs', 'oldValues', 'newValues', 'editFlags', 'changeTypes']])
+
+    def __len__(self):
+        return len(self.dates)
+
+    @property
+    def empty(self):
+        return len(self.dates) == 0
+
+    def changedDatasets(self):
+        """
+        Returns the list of DatasetInternalIDs with at least one changed cell
+        """
+        return pd.unique(self.datasetIDs).tolist()
+
+    def dateRanges(self):
+        """
+        Returns a dictionary of {DatasetInternalID: (firstChangedDate, lastChangedDate)}
+        """
+        if self.empty:
+            return {}
+        ranges = pd.Series(self.dates).groupby(self.datasetIDs.astype(int)).agg(['min', 'max'])
+        return {ID: (row['min'], row['max']) for ID, row in ranges.iterrows()}
+
+    def toDataFrame(self, changeTypes = None):
+        """
+        Returns the changes as a long (Datetime, DatasetInternalID) dataframe with 'Value_old', 'Value_new' and 
+        'EditFlag' columns, optionally filtered to certain change types (e.g. [ChangeSet.CONFLICT])
+        """
+        keep = np.ones(len(self), dtype=bool) if changeTypes is None else np.isin(self.changeTypes, changeTypes)
+        index = pd.MultiIndex.from_arrays([pd.DatetimeIndex(self.dates[keep]), self.datasetIDs[keep].astype(int)], names=['Datetime', 'DatasetInternalID'])
+        return pd.DataFrame({'Value_old': self.oldValues[keep], 'Value_new': self.newValues[keep], 'EditFlag': self.editFlags[keep]}, index=index)
+
+    def conflicts(self):
+        """
+        Returns the changes that overwrote user-edited data, in the format used by the conflict review dialog
+        """
+        return self.toDataFrame([ChangeSet.CONFLICT])
@@ -0,0 +1,41 @@
+"""
+Script name:    forecastFile.py
+Description:    The forecastFile.py script reads and writes forecast (.fcst) files. A forecast file is a
+                series of pickles: the datasetTable, the dataTable (long Datetime x DatasetInternalID form),
+                the modelRunsTable, the forecastEquationsTable, the forecastsTable and the text of the
+                user options file.
+"""
+
+import os
+import pickle
+
+# The objects in a forecast file, in the order they're stored
+FORECAST_FILE_CONTENTS = ['datasetTable', 'dataTable', 'modelRunsTable', 'forecastEquationsTable', 'forecastsTable', 'userOptions']
+
+
+def readForecastFile(fileName):
+    """
+    Reads a forecast file
+
+    Output:
+        tables -> dict of name (see FORECAST_FILE_CONTENTS) -> the stored table ('userOptions' is the options text)
+    """
+    with open(fileName, 'rb') as readfile:
+        return {name: pickle.load(readfile) for name in FORECAST_FILE_CONTENTS}
+
+
+def writeForecastFile(fileName, tables):
+    """
+    Writes a forecast file. The file is written next to the old one and then moved into place, so 
+    a failed write doesn't leave a half-written file behind.
+
+    Input:
+        tables -> dict of name (see FORECAST_FILE_CONTENTS) -> table
+    """
+    temporaryName = fileName + '.tmp'
+    with open(temporaryName, 'wb') as writefile:
+        for name in FORECAST_FILE_CONTENTS:
+            pickle.dump(tables[name], writefile, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporaryName, fileName)
+
+    return
@@ -24,4 +24,14 @@ file_name={0}\\untitled.fcst
 [DATA TAB]
 por_start=
 current_plotted_columns=
-current_plot_bounds=""".format(expanduser("~")))
\ No newline at end of file
+current_plot_bounds=
+resample_cache_mb=64
+composite_nan_handling=propagate
+download_threads=8
+download_processes=2
+download_timeout=600
+http_cache_mb=200
+offline_mode=False
+incremental_download=True
+download_lookback_days=30
+downloaded_por_start=""".format(expanduser("~")))
\ No newline at end of file